@@ -7,7 +7,8 @@ from abc import ABCMeta, abstractmethod
 from math import floor, ceil
 
 from event import FillEvent, OrderEvent
-from performance import create_sharpe_ratio, create_drawdowns
+from performance import create_sharpe_ratio, create_drawdowns, StreamingPerformance, EquityCurve
+from history import SparseHistory
 
 from portfolio import Portfolio
 
@@ -20,7 +21,8 @@ class SimplePortfolio(Portfolio):
         used to test simpler strategies such as BuyAndHoldStrategy.
         """
     
-    def __init__(self, bars, events, start_date, initial_capital=100000.0):
+    def __init__(self, bars, events, start_date, initial_capital=100000.0,
+                 sizer=None):
         """
             Initialises the portfolio with bars and an event queue.
             Also includes a starting datetime index and initial capital
@@ -31,41 +33,61 @@ class SimplePortfolio(Portfolio):
             events - The Event Queue object.
             start_date - The start date (bar) of the portfolio.
             initial_capital - The starting capital in USD.
+            sizer - Optional sizing.CovarianceSizer, sizing the orders
+                    from the covariance of the book instead of the
+                    fixed percentage caps.
             """
         self.bars = bars
         self.events = events
         self.symbol_list = self.bars.symbol_list
         self.start_date = start_date
         self.initial_capital = initial_capital
+        self.sizer = sizer
         
         self.all_positions = self.construct_all_positions()
         self.current_positions = dict( (k,v) for k, v in [(s, 0) for s in self.symbol_list] )
         
         self.all_holdings = self.construct_all_holdings()
         self.current_holdings = self.construct_current_holdings()
+        
+        # Market values of the non-zero positions, their sums and the
+        # symbols filled since the last bar, see revalue_positions
+        self.market_values = {}
+        self.market_value = 0.0
+        self.gross_value = 0.0
+        self.dirty_symbols = set()
+
+        # Performance statistics kept up to date on every bar and fill
+        self.analytics = StreamingPerformance(self.initial_capital)
+
+        # Equity curve and returns, built in place on every bar
+        self.equity = EquityCurve(self.initial_capital, self.start_date)
     
     
     def construct_all_positions(self):
         """
-            Constructs the positions list using the start_date
-            to determine when the time index will begin.
+            Constructs the positions history using the start_date
+            to determine when the time index will begin. Only the
+            non-zero positions of each bar are stored.
             """
-        d = dict( (k,v) for k, v in [(s, 0) for s in self.symbol_list] )
-        d['datetime'] = self.start_date
-        return [d]
+        history = SparseHistory(self.symbol_list)
+        history.append({'datetime': self.start_date})
+        return history
     
     
     def construct_all_holdings(self):
         """
-            Constructs the holdings list using the start_date
-            to determine when the time index will begin.
+            Constructs the holdings history using the start_date
+            to determine when the time index will begin. Only the
+            non-zero holdings of each bar are stored.
             """
-        d = dict( (k,v) for k, v in [(s, 0.0) for s in self.symbol_list] )
-        d['datetime'] = self.start_date
-        d['cash'] = self.initial_capital
-        d['commission'] = 0.0
-        d['total'] = self.initial_capital
-        return [d]
+        history = SparseHistory(self.symbol_list,
+                                ['cash', 'commission', 'total'], zero=0.0)
+        history.append({'datetime': self.start_date,
+                        'cash': self.initial_capital,
+                        'commission': 0.0,
+                        'total': self.initial_capital})
+        return history
     
     def construct_current_holdings(self):
         """
@@ -86,35 +108,33 @@ class SimplePortfolio(Portfolio):
             
             Makes use of a MarketEvent from the events queue.
             """
-        bars = {}
-        for sym in self.symbol_list:
-            bars[sym] = self.bars.get_latest_bars(sym, N=1)
+        dt = self.bars.get_latest_bars(self.symbol_list[0], N=1)[0][1]
+
+        # Revalue the active positions, market_values then holds
+        # exactly the symbols with a non-zero position
+        self.revalue_positions()
     
         # Update positions
-        dp = dict( (k,v) for k, v in [(s, 0) for s in self.symbol_list] )
-        dp['datetime'] = bars[self.symbol_list[0]][0][1]
-        
-        for s in self.symbol_list:
-            dp[s] = self.current_positions[s]
+        dp = dict((s, self.current_positions[s]) for s in self.market_values)
+        dp['datetime'] = dt
 
         # Append the current positions
         self.all_positions.append(dp)
     
         # Update holdings
-        dh = dict( (k,v) for k, v in [(s, 0) for s in self.symbol_list] )
-        dh['datetime'] = bars[self.symbol_list[0]][0][1]
+        dh = dict(self.market_values)
+        dh['datetime'] = dt
         dh['cash'] = self.current_holdings['cash']
         dh['commission'] = self.current_holdings['commission']
-        dh['total'] = self.current_holdings['cash']
-        
-        for s in self.symbol_list:
-            # Approximation to the real value
-            market_value = self.current_positions[s] * bars[s][0][5]
-            dh[s] = market_value
-            dh['total'] += market_value
+        dh['total'] = self.current_holdings['cash'] + self.market_value
 
         # Append the current holdings
         self.all_holdings.append(dh)
+        self.analytics.update_bar(dh['total'], self.gross_value,
+                                  self.market_value)
+        self.equity.append(dh['datetime'], dh['total'])
+        if self.sizer is not None:
+            self.sizer.update(self.bars)
 
 
     def update_positions_from_fill(self, fill):
@@ -134,6 +154,7 @@ class SimplePortfolio(Portfolio):
                                 
         # Update positions list with new quantities
         self.current_positions[fill.symbol] += fill_dir*fill.quantity
+        self.dirty_symbols.add(fill.symbol)
 
 
     def update_holdings_from_fill(self, fill):
@@ -153,6 +174,8 @@ class SimplePortfolio(Portfolio):
                                 
         # Update holdings list with new quantities
         fill_cost = self.bars.get_latest_bars(fill.symbol)[0][5]  # Close price
+        # Kept on the fill, so that a journal can replay it at this price
+        fill.valued_at = fill_cost
         cost = fill_dir * fill_cost * fill.quantity
         self.current_holdings[fill.symbol] += cost
         self.current_holdings['commission'] += fill.commission
@@ -160,6 +183,7 @@ class SimplePortfolio(Portfolio):
         #self.current_holdings['total'] -= (cost + fill.commission)
         self.current_holdings['total'] -= fill.commission # the total capital only lost the commission 
                                                           # at the very moment an order is filled
+        self.analytics.update_fill(cost)
 
     def update_fill(self, event):
         """
@@ -178,6 +202,8 @@ class SimplePortfolio(Portfolio):
         1. For any security, its holding proportion cannot exceed 40 percent of the total capital
         2. For cash, we always make sure it accounts for at least 30 percent of the total capital
         3. Only send Market order
+        With a sizer, the signalled name is instead traded towards the
+        target given by the sizer, once its covariance is ready.
         """
         order = None
         
@@ -185,6 +211,16 @@ class SimplePortfolio(Portfolio):
         direction = signal.signal_type
         strength = signal.strength
 
+        if self.sizer is not None:
+            quantity = self.sizer.order_quantity(self, signal)
+            if quantity is not None:
+                # Only trade in the direction of the signal
+                if direction == 'LONG' and quantity > 0:
+                    order = OrderEvent(symbol, 'MKT', quantity, 'BUY')
+                elif direction == 'SHORT' and quantity < 0:
+                    order = OrderEvent(symbol, 'MKT', -quantity, 'SELL')
+                return order
+
         ## Decide order size
         # First stage: only consider signal strength
         if strength == "strong":
@@ -196,7 +232,7 @@ class SimplePortfolio(Portfolio):
 
         cur_position = self.current_positions[symbol]
         cur_holding = self.current_holdings[symbol]
-        cur_capital = self.all_holdings[-1]['total']    
+        cur_capital = self.all_holdings.get(-1, 'total')    
 
         if cur_position != 0:
             # Second stage: make sure absolute holding of the current security
@@ -221,7 +257,7 @@ class SimplePortfolio(Portfolio):
             # since if we are shorting, cash will always increase, so only need to check the
             # "longing" situation
             if direction == "LONG":
-                cur_cash = self.all_holdings[-1]['cash']
+                cur_cash = self.all_holdings.get(-1, 'cash')
                 tmp_cash = cur_cash - mkt_quantity/cur_position*cur_holding
 
                 tmp_ratio = tmp_cash / cur_capital
@@ -252,29 +288,17 @@ class SimplePortfolio(Portfolio):
       
     def create_equity_curve_dataframe(self):
         """
-            Creates a pandas DataFrame from the all_holdings
-            list of dictionaries.
+            Creates a pandas DataFrame of the totals, returns and
+            equity curve so far. It is a view on the equity curve
+            kept during the run, not a copy of the history.
             """
-        curve = pd.DataFrame(self.all_holdings)
-        curve.set_index('datetime', inplace=True)
-        curve['returns'] = curve['total'].pct_change()
-        curve['equity_curve'] = (1.0+curve['returns']).cumprod()
-        self.equity_curve = curve
+        self.equity_curve = self.equity.to_dataframe()
 
     def output_summary_stats(self):
         """
             Creates a list of summary statistics for the portfolio such
-            as Sharpe Ratio and drawdown information.
+            as Sharpe Ratio and drawdown information. The statistics
+            are maintained bar by bar, so this can be called mid-run,
+            without create_equity_curve_dataframe.
             """
-        total_return = self.equity_curve['equity_curve'][-1]
-        returns = self.equity_curve['returns']
-        pnl = self.equity_curve['equity_curve']
-                        
-        sharpe_ratio = create_sharpe_ratio(returns)
-        max_dd, dd_duration = create_drawdowns(pnl)
-                                
-        stats = [("Total Return", "%0.2f%%" % ((total_return - 1.0) * 100.0)),
-                ("Sharpe Ratio", "%0.2f" % sharpe_ratio),
-                ("Max Drawdown", "%0.2f%%" % (max_dd * 100.0)),
-                ("Drawdown Duration", "%d" % dd_duration)]
-        return stats
+        return self.equity.get_stats()
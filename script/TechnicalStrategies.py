@@ -8,16 +8,18 @@ class RSI(Strategy):
     Relative Strength Index strategy 
     """
 
-    def __init__(self, bars, events):
+    def __init__(self, bars, events, periods=12):
         """
         Initialises the strategy,
         Params:
         bars: The DataHandler object that provides bar information
         events: The Event Queue object
+        periods: default parameter of RSI, number of periods
         """
         self.bars = bars
         self.symbol_list = self.bars.symbol_list
         self.events = events
+        self.periods = periods
 
         # Initialize the holding status to False
         self.bought = self._calculate_initial_bought()
@@ -33,14 +35,18 @@ class RSI(Strategy):
         return bought
 
  
-    def calculate_signals(self, event, periods=12):
+    def calculate_signals(self, event, periods=None):
         """
         params:
         event: 
-        periods: parameter of RSI, number of periods 
+        periods: parameter of RSI, number of periods (defaults to the
+                 value given at initialisation)
         """
+        if periods is None:
+            periods = self.periods
         if event.type == "MARKET":
-            for s in self.symbol_list:
+            # Only the symbols passing the screener, if any
+            for s in self.bars.get_eligible_symbols():
                 bars = self.bars.get_latest_bars(s, periods+1)
                 # Wait until at least "periods"+1 time periods market data is available
                 if len(bars) == periods+1:
@@ -92,20 +98,31 @@ class Mean_Reversion(Strategy):
     to Bollinger Band to construct accurate signals.
     """
 
-    def __init__(self, bars, events):
+    def __init__(self, bars, events, periods=20, width=2, resolution=None):
         """
         Initialises the strategy,
         Params:
         bars: The DataHandler object that provides bar information
         events: The Event Queue object
+        periods: default number of periods of the Bollinger Band
+        width: default width of band
+        resolution: resolution of the bands, e.g. 'W-FRI' for weekly
+                    bars from daily data, None for the data's own
         """
         self.bars = bars
         self.symbol_list = self.bars.symbol_list
         self.events = events
+        self.periods = periods
+        self.width = width
+        self.resolution = resolution
+        self.bars.check_resolution(resolution)
 
         # Initialize the holding status to False
         self.bought = self._calculate_initial_bought()
 
+        # Time of the latest coarse bar evaluated, per symbol
+        self.last_bar_time = {}
+
 
     def _calculate_initial_bought(self):
         """
@@ -117,18 +134,29 @@ class Mean_Reversion(Strategy):
         return bought
 
  
-    def calculate_signals(self, event, periods=20, width=2):
+    def calculate_signals(self, event, periods=None, width=None):
         """
         params:
         event: 
         periods: parameter of Bollinger Band, number of periods, 
                  usually use "day" as the unit of period
         width: width of band
+        Both default to the values given at initialisation.
         Very few constrains is added to Bollinger Band for now
         """
+        if periods is None:
+            periods = self.periods
+        if width is None:
+            width = self.width
         if event.type == "MARKET":
-            for s in self.symbol_list:
-                bars = self.bars.get_latest_bars(s, periods)
+            # Only the symbols passing the screener, if any
+            for s in self.bars.get_eligible_symbols():
+                bars = self.bars.get_latest_bars(s, periods, self.resolution)
+                if self.resolution is not None:
+                    # Only once per coarse bar, when it closes
+                    if not bars or self.last_bar_time.get(s) == bars[-1][1]:
+                        continue
+                    self.last_bar_time[s] = bars[-1][1]
                 # Wait until at least "periods" time periods market data is available
                 if len(bars) == periods:
                     close_price = [x[5] for x in bars] # close price for "periods" periods 
@@ -0,0 +1,121 @@
+# backtest.py
+
+import time
+import Queue
+
+
+def run_backtest(events, bars, strategy, port, broker,
+                 heartbeat=0.0, verbose=False, risk=None, checkpoint=None):
+    """
+        Runs the event-driven backtest loop until the data handler
+        runs out of bars.
+
+        Each heartbeat pushes one new bar and then drains the event
+        queue, routing MARKET events to the strategy and portfolio,
+        SIGNAL events to the portfolio, ORDER events to the broker
+        (through the risk stage, if any), FILL events back to the
+        portfolio and CANCEL events to the risk stage.
+
+        Parameters:
+        events - The Event Queue.
+        bars - The DataHandler object that provides bar information.
+        strategy - The Strategy object generating signals.
+        port - The Portfolio object.
+        broker - The ExecutionHandler object.
+        heartbeat - Seconds to sleep between bars.
+        verbose - Whether to print every handled event.
+        risk - Optional pre-trade risk stage approving every order
+               before it reaches the broker.
+        checkpoint - Optional Checkpointer saving the state of the
+                     run between bars.
+
+        Returns:
+        port - The portfolio, after the final bar.
+        """
+    while True:
+        # Update the bars (specific backtest code, as opposed to live trading)
+        if bars.continue_backtest == True:
+            bars.update_bars()
+        else:
+            break
+
+        # Handle the events
+        while True:
+            try:
+                event = events.get(False)
+            except Queue.Empty:
+                break
+            else:
+                if event is not None:
+                    if event.type == 'MARKET':
+                        strategy.calculate_signals(event)
+                        if verbose:
+                            print "Market Event"
+                        port.update_timeindex(event)
+                        if risk is not None:
+                            risk.update_timeindex(event)
+                        if verbose:
+                            print "Portfolio Update"
+
+                    elif event.type == 'SIGNAL':
+                        port.update_signal(event)
+                        if verbose:
+                            print "Portfolio Event"
+
+                    elif event.type == 'ORDER':
+                        if risk is not None and not risk.approve_order(event):
+                            if verbose:
+                                print "Order Rejected"
+                            continue
+                        broker.execute_order(event)
+                        if verbose:
+                            print "Order Event"
+
+                    elif event.type == 'FILL':
+                        port.update_fill(event)
+                        if risk is not None:
+                            risk.update_fill(event)
+                        if verbose:
+                            print "Order Done"
+
+                    elif event.type == 'CANCEL':
+                        if risk is not None:
+                            risk.update_cancel(event)
+                        if verbose:
+                            print "Order Cancelled"
+
+        if checkpoint is not None:
+            checkpoint.maybe_save(bars, strategy, port, broker, risk)
+
+        if heartbeat > 0.0:
+            time.sleep(heartbeat)
+    return port
+
+
+def extend_backtest(state, events, bars, strategy, port, broker, risk=None):
+    """
+        Extends a finished backtest with the bars added to its data
+        since it ran, instead of rerunning it from the first bar.
+
+        The components must be built as for the original run, with
+        the data handler loading the extended bars. The end state of
+        the previous run is restored into them, only the new bars are
+        replayed, and the new end state replaces the old one.
+
+        Parameters:
+        state - The Checkpointer whose end_path holds the end state
+                of the previous run.
+        events, bars, strategy, port, broker, risk - As for
+                run_backtest.
+
+        Returns:
+        new_bars - The number of bars replayed.
+        """
+    if not state.restore(bars, strategy, port, broker, risk, state.end_path):
+        raise IOError("No end state found in %s" % state.end_path)
+    new_bars = bars.bars_left()
+    # Run even without new bars, to end on the final MarketEvent as a
+    # full run does
+    run_backtest(events, bars, strategy, port, broker, risk=risk,
+                 checkpoint=state)
+    return new_bars
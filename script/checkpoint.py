@@ -0,0 +1,224 @@
+# checkpoint.py
+
+import cPickle as pickle
+import os, os.path
+import time
+
+
+# Attributes linking the components to each other. They are not saved
+# and keep pointing at the live objects on restore.
+SHARED_ATTRIBUTES = ('bars', 'events')
+
+# Order in which the components are saved and restored
+COMPONENTS = ('bars', 'strategy', 'portfolio', 'broker', 'risk')
+
+
+def component_state(component):
+    """
+        Returns the state of a backtest component: the result of its
+        get_state() method if it has one, otherwise its attributes
+        except the shared ones.
+        """
+    if hasattr(component, 'get_state'):
+        return component.get_state()
+    return dict((k, v) for k, v in component.__dict__.items()
+                if k not in SHARED_ATTRIBUTES)
+
+
+def restore_component(component, state):
+    """
+        Restores a state returned by component_state into a freshly
+        constructed component.
+        """
+    if hasattr(component, 'set_state'):
+        component.set_state(state)
+    else:
+        component.__dict__.update(state)
+
+
+class Checkpointer(object):
+    """
+        Saves the full state of a backtest (data handler cursor,
+        strategy, portfolio, broker and optional risk stage) every
+        `every` bars, so that an interrupted run can resume from its
+        latest checkpoint and end with identical results.
+
+        A checkpoint is only taken between bars, once the event queue
+        is empty, so the queue itself never needs saving. The state is
+        written with the binary pickle protocol to a temporary file
+        which then replaces the previous checkpoint, so a crash while
+        writing leaves the previous one intact.
+
+        The histories which grow with the run (attributes with a
+        rows_since method, e.g. the positions and holdings histories
+        and the equity curve of the portfolio) are not pickled whole
+        each time: the rows appended since the previous checkpoint are
+        appended to a history file next to the checkpoint, which
+        records the length of that file it was written with, and the
+        checkpoint only keeps the histories without their rows. The
+        cost of a checkpoint thus no longer grows with the length of
+        the run.
+        """
+
+    def __init__(self, path, every=1000, end_path=None):
+        """
+            Parameters:
+            path - The checkpoint file.
+            every - Number of bars between two checkpoints.
+            end_path - Optional file keeping the state after the last
+                       bar of the run, from which the run can later be
+                       extended with new bars (see extend_backtest).
+            """
+        self.path = path
+        self.every = every
+        self.end_path = end_path
+        self.bars_since = 0
+        # Checkpoint path -> history file name, its length and the
+        # number of rows of every history written to it
+        self.histories = {}
+
+    def _history_files(self, path):
+        """
+            Returns the paths of the history files of a checkpoint.
+            """
+        directory, name = os.path.split(os.path.abspath(path))
+        return [os.path.join(directory, f) for f in os.listdir(directory)
+                if f.startswith(name + '.history.')]
+
+    def _append_rows(self, path, state):
+        """
+            Appends the rows of the growing histories of state written
+            since the last checkpoint to the history file of path, and
+            replaces the histories by copies without rows.
+
+            Returns:
+            The history record of the checkpoint.
+            """
+        record = self.histories.get(path)
+        rows, lengths = {}, {}
+        for name in COMPONENTS:
+            component = state[name]
+            if not isinstance(component, dict):
+                continue
+            for attr, value in component.items():
+                if hasattr(value, 'rows_since'):
+                    key = (name, attr)
+                    lengths[key] = len(value)
+                    written = record["lengths"].get(key, 0) if record else 0
+                    if written > len(value):
+                        # Not the history of this run: start a new file
+                        record = None
+                    rows[key] = value
+                    component[attr] = value.without_rows()
+        if record is None:
+            # A new file, so that the previous checkpoint stays valid
+            # until it is replaced
+            record = {"file": "%s.history.%x" % (os.path.basename(path),
+                                                 int(time.time() * 1e6)),
+                      "offset": 0, "lengths": {}}
+        chunk = dict((key, value.rows_since(record["lengths"].get(key, 0)))
+                     for key, value in rows.items())
+        history_path = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                    record["file"])
+        with open(history_path, 'ab') as f:
+            # Drops anything written after the checkpoint, e.g. by a
+            # run which crashed before replacing it
+            f.truncate(record["offset"])
+            f.seek(record["offset"])
+            pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+            offset = f.tell()
+        return {"file": record["file"], "offset": offset, "lengths": lengths}
+
+    def save(self, bars, strategy, port, broker, risk=None, path=None):
+        """
+            Writes the state of every component to the checkpoint, or
+            to path if given.
+            """
+        if path is None:
+            path = self.path
+        state = {
+            "bars": component_state(bars),
+            "strategy": component_state(strategy),
+            "portfolio": component_state(port),
+            "broker": component_state(broker),
+            "risk": component_state(risk) if risk is not None else None
+        }
+        state["history"] = self._append_rows(path, state)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+        self.histories[path] = state["history"]
+        for history_path in self._history_files(path):
+            if os.path.basename(history_path) != state["history"]["file"]:
+                os.remove(history_path)
+        self.bars_since = 0
+
+    def maybe_save(self, bars, strategy, port, broker, risk=None):
+        """
+            Counts a bar and saves a checkpoint every `every` bars,
+            and the end state once the data handler has replayed its
+            last bar (before its final, empty MarketEvent).
+            """
+        self.bars_since += 1
+        if self.bars_since >= self.every:
+            self.save(bars, strategy, port, broker, risk)
+        if self.end_path is not None and bars.continue_backtest and \
+           bars.bars_left() == 0:
+            self.save(bars, strategy, port, broker, risk, self.end_path)
+
+    def restore(self, bars, strategy, port, broker, risk=None, path=None):
+        """
+            Restores the latest checkpoint (or the state in path, if
+            given), if any, into freshly constructed components, built
+            with the same parameters as those of the saved run.
+
+            Returns:
+            True if a checkpoint was restored.
+            """
+        if path is None:
+            path = self.path
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        record = state.get("history")
+        if record is not None:
+            self._read_rows(path, state, record)
+            self.histories[path] = record
+        restore_component(bars, state["bars"])
+        restore_component(strategy, state["strategy"])
+        restore_component(port, state["portfolio"])
+        restore_component(broker, state["broker"])
+        if risk is not None and state["risk"] is not None:
+            restore_component(risk, state["risk"])
+        return True
+
+    def _read_rows(self, path, state, record):
+        """
+            Fills the histories of a loaded state with their rows, read
+            from the history file up to the length the checkpoint was
+            written with.
+            """
+        history_path = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                    record["file"])
+        with open(history_path, 'rb') as f:
+            while f.tell() < record["offset"]:
+                chunk = pickle.load(f)
+                for (name, attr), rows in chunk.items():
+                    state[name][attr].extend_rows(rows)
+        for (name, attr), length in record["lengths"].items():
+            if len(state[name][attr]) != length:
+                raise IOError("The history file of %s is incomplete" % path)
+
+    def clear(self):
+        """
+            Deletes the checkpoint, e.g. once a run has completed.
+            """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        for history_path in self._history_files(self.path):
+            os.remove(history_path)
+        self.histories.pop(self.path, None)
@@ -0,0 +1,174 @@
+# covariance.py
+
+import numpy as np
+
+
+class RollingCovariance(object):
+    """
+        Maintains the covariance matrix of the close-to-close returns
+        of a list of symbols, updated bar by bar without recomputing it
+        from the whole window.
+
+        With a rolling window, the sum of the returns and the sum of
+        their outer products are kept: a new bar adds one outer product
+        and the bar leaving the window subtracts one, a single rank-two
+        update costing O(N^2). The sums are recomputed from the window
+        every `window` bars so that rounding errors cannot build up.
+
+        With a halflife instead, the mean and covariance are
+        exponentially weighted, a rank-one update per bar.
+        """
+
+    def __init__(self, symbol_list, window=None, halflife=None):
+        """
+            Parameters:
+            symbol_list - The symbols, in the order of the matrix.
+            window - Number of returns in the rolling window.
+            halflife - Half-life in bars of the exponential weights,
+                       used instead of a window.
+            """
+        if (window is None) == (halflife is None):
+            raise ValueError("Give exactly one of window and halflife")
+        self.symbol_list = list(symbol_list)
+        self.symbol_index = dict((s, i) for i, s in enumerate(self.symbol_list))
+        n = len(self.symbol_list)
+        self.window = window
+        self.halflife = halflife
+
+        self.last_prices = None
+        self.count = 0
+        self.updates = 0
+        self.sums = np.zeros(n)
+        self.cross = np.zeros((n, n))
+        self.product = np.empty((n, n))
+        if window is not None:
+            self.returns = np.zeros((window, n))
+        else:
+            self.decay = 0.5 ** (1.0 / halflife)
+            self.mean = np.zeros(n)
+
+    def update_bars(self, bars):
+        """
+            Adds the returns of the latest bars of a data handler.
+            """
+        prices = np.array([bars.get_latest_bars(s)[-1][5] for s in self.symbol_list],
+                          dtype=float)
+        self.update_prices(prices)
+
+    def update_prices(self, prices):
+        """
+            Adds the returns from the previous prices to the new ones.
+            Symbols without a valid price on either bar get a zero
+            return.
+
+            Parameters:
+            prices - Array of the prices of symbol_list.
+            """
+        prices = np.asarray(prices, dtype=float)
+        if self.last_prices is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ret = prices / self.last_prices - 1.0
+            ret[~np.isfinite(ret)] = 0.0
+            self.update_returns(ret)
+        self.last_prices = prices
+
+    def update_returns(self, ret):
+        """
+            Adds one vector of returns.
+            """
+        if self.window is None:
+            self._update_weighted(ret)
+            return
+
+        slot = self.updates % self.window
+        old = self.returns[slot].copy()
+        self.returns[slot] = ret
+        self.updates += 1
+
+        if self.updates % self.window == 0:
+            # Full recomputation, bounding the rounding errors
+            self.sums = self.returns.sum(axis=0)
+            np.dot(self.returns.T, self.returns, out=self.cross)
+            self.count = self.window
+        elif self.count < self.window:
+            self.count += 1
+            self.sums += ret
+            np.multiply.outer(ret, ret, out=self.product)
+            self.cross += self.product
+        else:
+            # Rank-two update: add the new bar, drop the oldest one
+            self.sums += ret - old
+            np.dot(np.column_stack((ret, old)), np.column_stack((ret, -old)).T,
+                   out=self.product)
+            self.cross += self.product
+
+    def _update_weighted(self, ret):
+        """
+            Exponentially weighted update of the mean and covariance.
+            """
+        self.count += 1
+        if self.count == 1:
+            self.mean[:] = ret
+            self.cross[:] = 0.0
+            return
+        delta = ret - self.mean
+        self.mean += (1.0 - self.decay) * delta
+        np.multiply.outer(delta, delta, out=self.product)
+        self.product *= 1.0 - self.decay
+        self.cross += self.product
+        self.cross *= self.decay
+
+    def ready(self):
+        """
+            Whether there are enough returns for a covariance.
+            """
+        return self.count >= 2
+
+    def covariance(self):
+        """
+            Returns the current covariance matrix of the returns.
+            """
+        if self.window is None:
+            return self.cross.copy()
+        k = float(self.count)
+        if k < 2:
+            return np.zeros_like(self.cross)
+        return (self.cross - np.outer(self.sums, self.sums) / k) / (k - 1.0)
+
+    def volatility(self):
+        """
+            Returns the standard deviation of the returns of each symbol.
+            """
+        if self.window is None:
+            var = np.diag(self.cross).copy()
+        else:
+            k = float(self.count)
+            if k < 2:
+                return np.zeros(len(self.symbol_list))
+            var = (np.diag(self.cross) - self.sums * self.sums / k) / (k - 1.0)
+        return np.sqrt(np.maximum(var, 0.0))
+
+    def correlation(self):
+        """
+            Returns the current correlation matrix of the returns.
+            """
+        cov = self.covariance()
+        vol = np.sqrt(np.maximum(np.diag(cov), 0.0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = cov / np.outer(vol, vol)
+        corr[~np.isfinite(corr)] = 0.0
+        return corr
+
+    def sub_covariance(self, symbols):
+        """
+            Returns the covariance matrix of a subset of the symbols,
+            computed from the sums of those symbols only.
+            """
+        idx = np.array([self.symbol_index[s] for s in symbols], dtype=int)
+        if self.window is None:
+            return self.cross[np.ix_(idx, idx)].copy()
+        k = float(self.count)
+        if k < 2:
+            return np.zeros((len(idx), len(idx)))
+        sums = self.sums[idx]
+        return (self.cross[np.ix_(idx, idx)] - np.outer(sums, sums) / k) / (k - 1.0)
@@ -1,12 +1,23 @@
 # data.py
-from pandas.io.data import DataReader
 from datetime import datetime
 import os, os.path
+import numpy as np
 import pandas as pd
-import urllib2
 from abc import ABCMeta, abstractmethod
 
 from event import MarketEvent
+from resample import ResampleCache
+
+# Columns of the bar arrays returned by DataHandler.get_bars_between
+BAR_FIELDS = ['open', 'high', 'low', 'close', 'volume']
+
+
+def _to_datetime64(ts):
+    """
+        Converts a datetime, Timestamp or date string to datetime64[us].
+        """
+    return pd.Timestamp(ts).to_datetime64().astype('datetime64[us]')
+
 
 class DataHandler(object):
     """
@@ -23,14 +34,132 @@ class DataHandler(object):
     
     __metaclass__ = ABCMeta
     
+    # Optional screening.UniverseScreener fed with every new bar
+    screener = None
+    
+    def attach_screener(self, screener):
+        """
+            Attaches a UniverseScreener, updated on every new bar and
+            deciding the symbols returned by get_eligible_symbols().
+            The bars the handler already holds warm it up.
+            """
+        self.screener = screener
+        screener.warm_up(self)
+    
+    def get_eligible_symbols(self):
+        """
+            Returns the symbols that strategies should evaluate on the
+            current bar: those passing the attached screener, or the
+            whole symbol list.
+            """
+        if self.screener is None:
+            return self.symbol_list
+        return self.screener.get_eligible_symbols()
+    
+    # Per-symbol time index of the bars received so far, see _bar_index
+    _bar_arrays = None
+    
+    def _bar_index(self, symbol):
+        """
+            Returns the sorted datetime64 array of the bars of symbol
+            received so far and the array of their BAR_FIELDS, one row
+            per bar.
+            
+            The arrays are built from latest_symbol_data and extended
+            with the bars received since the last call, in growable
+            buffers, so the conversion is paid once per bar. As they
+            only hold received bars, nothing past the current bar can
+            be returned.
+            """
+        if self._bar_arrays is None:
+            self._bar_arrays = {}
+        bars_list = self.latest_symbol_data[symbol]
+        entry = self._bar_arrays.get(symbol)
+        if entry is None or entry[3] is not bars_list or entry[2] > len(bars_list):
+            # New symbol, or the list was rebuilt (e.g. a restored checkpoint)
+            entry = [np.empty(0, dtype='datetime64[us]'),
+                     np.empty((0, len(BAR_FIELDS))), 0, bars_list]
+            self._bar_arrays[symbol] = entry
+        times, values, n = entry[0], entry[1], entry[2]
+        m = len(bars_list)
+        if m > n:
+            if m > len(times):
+                size = max(m, 2 * len(times), 16)
+                grown_times = np.empty(size, dtype='datetime64[us]')
+                grown_values = np.empty((size, len(BAR_FIELDS)))
+                grown_times[:n] = times[:n]
+                grown_values[:n] = values[:n]
+                times, values = grown_times, grown_values
+                entry[0], entry[1] = times, values
+            new_bars = bars_list[n:m]
+            times[n:m] = [_to_datetime64(b[1]) for b in new_bars]
+            values[n:m] = [b[2:7] for b in new_bars]
+            entry[2] = m
+        return times[:m], values[:m]
+    
+    def get_bars_between(self, symbol, start=None, end=None):
+        """
+            Returns the bars of symbol with start <= datetime <= end,
+            among the bars received so far, found by binary search.
+            
+            Parameters:
+            symbol - The ticker symbol.
+            start - First datetime, or None for the first bar.
+            end - Last datetime, or None for the current bar.
+            
+            Returns:
+            times, values - Views on the datetime64 index and on the
+            BAR_FIELDS of the bars, one row per bar.
+            """
+        times, values = self._bar_index(symbol)
+        lo = 0 if start is None else np.searchsorted(times, _to_datetime64(start), 'left')
+        hi = len(times) if end is None else np.searchsorted(times, _to_datetime64(end), 'right')
+        return times[lo:hi], values[lo:hi]
+    
+    def get_bar_at(self, symbol, ts):
+        """
+            Returns the bar of symbol in effect at ts, i.e. the last
+            bar received with datetime <= ts, or None if there is none.
+            """
+        times, values = self._bar_index(symbol)
+        i = np.searchsorted(times, _to_datetime64(ts), 'right')
+        if i == 0:
+            return None
+        return self.latest_symbol_data[symbol][i - 1]
+    
+    # Whether get_latest_bars resamples to coarser resolutions
+    supports_resolution = False
+    
+    def check_resolution(self, resolution):
+        """
+            Raises a ValueError for a resolution this handler cannot
+            resample to, i.e. any but None if it does not resample.
+            """
+        if resolution is not None and not self.supports_resolution:
+            raise ValueError("%s does not resample bars, resolution %r "
+                             "is not available" % (self.__class__.__name__, resolution))
+    
     @abstractmethod
-    def get_latest_bars(self, symbol, N=1):
+    def get_latest_bars(self, symbol, N=1, resolution=None):
         """
             Returns the last N bars from the latest_symbol list,
             or fewer if less bars are available.
+            
+            With a resolution, e.g. 'W-FRI' or '5T', returns the last N
+            bars resampled to it instead, among those that have closed,
+            for handlers with supports_resolution (see
+            check_resolution).
             """
         raise NotImplementedError("Should implement get_latest_bars()")
     
+    def get_latest_adjusted_bars(self, symbol, N=1):
+        """
+            Returns the last N bars adjusted for splits and dividends.
+            Handlers without adjustment data return the raw bars of
+            get_latest_bars.
+            """
+        return self.get_latest_bars(symbol, N)
+    
     @abstractmethod
     def update_bars(self):
         """
@@ -40,7 +169,301 @@ class DataHandler(object):
         raise NotImplementedError("Should implement update_bars()")
 
 
-class HistoricCSVDataHandler(DataHandler):
+class InMemoryDataHandler(DataHandler):
+    """
+        InMemoryDataHandler replays bars that have already been loaded
+        into memory, one list of bar tuples per symbol, all aligned on
+        the same time index.
+        
+        Only a [start, end) window of the lists is replayed, so many
+        handlers can share the same loaded lists (e.g. the windows of a
+        walk-forward optimisation) without copying or re-parsing them.
+        The bars just before the window can be pre-loaded as warm-up so
+        that indicators are already primed on the first replayed bar.
+        """
+    
+    def __init__(self, events, symbol_bars, symbol_list=None,
+                 start=0, end=None, warmup=0, adjusted_bars=None):
+        """
+            Initialises the in-memory data handler.
+            
+            Parameters:
+            events - The Event Queue.
+            symbol_bars - A dictionary of symbol -> list of bar tuples.
+            symbol_list - A list of symbol strings (defaults to all keys).
+            start - Index of the first bar to replay.
+            end - Index one past the last bar to replay (defaults to all).
+            warmup - Number of bars before start to pre-load as history.
+            adjusted_bars - Optional dictionary of symbol -> list of
+                            adjusted bar tuples, aligned with
+                            symbol_bars (see adjust_bars).
+            """
+        self.events = events
+        self.symbol_bars = symbol_bars
+        self.adjusted_bars = adjusted_bars
+        if symbol_list is None:
+            symbol_list = sorted(symbol_bars.keys())
+        self.symbol_list = symbol_list
+        
+        num_bars = min(len(symbol_bars[s]) for s in self.symbol_list)
+        if end is None or end > num_bars:
+            end = num_bars
+        self.start = start
+        self.end = end
+        self.first = max(0, start - warmup)
+        self.bar_index = start
+        
+        self.latest_symbol_data = {}
+        for s in self.symbol_list:
+            self.latest_symbol_data[s] = list(
+                symbol_bars[s][self.first:start]
+            )
+        self.continue_backtest = True
+    
+    
+    def get_state(self):
+        """
+            Returns the replay cursor, from which set_state rebuilds
+            the latest bars, and the screener, for checkpointing.
+            """
+        return {"bar_index": self.bar_index,
+                "continue_backtest": self.continue_backtest,
+                "last_bars": self._last_bars(self.bar_index),
+                "screener": self.screener}
+    
+    
+    def _last_bars(self, bar_index):
+        """
+            Returns the last bar replayed of every symbol, up to
+            bar_index, None before the first bar.
+            """
+        if bar_index == 0:
+            return dict((s, None) for s in self.symbol_list)
+        return dict((s, self.symbol_bars[s][bar_index - 1]) for s in self.symbol_list)
+    
+    
+    def set_state(self, state):
+        """
+            Moves the replay cursor to a state returned by get_state.
+            The bars may since have been extended, but the bars
+            already replayed must be unchanged, for every symbol.
+            """
+        for s in self.symbol_list:
+            if state["bar_index"] > len(self.symbol_bars[s]):
+                raise ValueError("The saved state is beyond the last bar of %s" % s)
+        # The last replayed bar of every symbol, times and prices, must
+        # be those of the saved run (e.g. loaded with the same validator)
+        if self._last_bars(state["bar_index"]) != state["last_bars"]:
+            raise ValueError("The bars replayed by the saved state have changed")
+        self.bar_index = state["bar_index"]
+        self.continue_backtest = state["continue_backtest"]
+        self.screener = state["screener"]
+        for s in self.symbol_list:
+            self.latest_symbol_data[s] = list(
+                self.symbol_bars[s][self.first:self.bar_index]
+            )
+        if self.screener is not None:
+            self._precompute_screener()
+    
+    
+    def attach_screener(self, screener):
+        """
+            Attaches a UniverseScreener, whose statistics are computed
+            for every bar of the window at once, including the warm-up
+            bars.
+            """
+        self.screener = screener
+        if self._precompute_screener():
+            screener.screen()
+    
+    
+    def _precompute_screener(self):
+        """
+            Precomputes the screener statistics of the bars from first
+            to end and moves it to the current bar. Returns whether a
+            bar has been replayed or pre-loaded.
+            """
+        fields = np.array([[b[5:7] for b in self.symbol_bars[s][self.first:self.end]]
+                           for s in self.screener.symbol_list], dtype=float)
+        fields = fields.reshape(len(self.screener.symbol_list), -1, 2)
+        self.screener.precompute(fields[:, :, 0].T, fields[:, :, 1].T)
+        if self.bar_index > self.first:
+            self.screener.seek(self.bar_index - 1 - self.first)
+            return True
+        return False
+    
+    
+    # ResampleCache of the coarser resolutions, created on first use
+    resample_cache = None
+    supports_resolution = True
+    
+    def get_latest_bars(self, symbol, N=1, resolution=None):
+        """
+            Returns the last N bars from the latest_symbol list,
+            or N-k if less available.
+            
+            With a resolution, e.g. 'W-FRI' or '5T', returns the last N
+            bars resampled to it instead, among those that have closed
+            (see resample.resample_bars).
+            """
+        try:
+            bars_list = self.latest_symbol_data[symbol]
+        except KeyError:
+            print "That symbol is not available in the historical data set."
+        else:
+            if resolution is None:
+                return bars_list[-N:]
+            if self.resample_cache is None:
+                self.resample_cache = ResampleCache()
+            return self.resample_cache.get_latest_bars(
+                symbol, resolution, self.symbol_bars[symbol],
+                self.first + len(bars_list), N
+            )
+    
+    
+    def get_latest_adjusted_bars(self, symbol, N=1):
+        """
+            Returns the last N adjusted bars, sliced from the
+            precomputed adjusted_bars at the replay cursor, so the
+            bar loop does no adjustment work.
+            """
+        if self.adjusted_bars is None:
+            return self.get_latest_bars(symbol, N)
+        end = self.first + len(self.latest_symbol_data[symbol])
+        return self.adjusted_bars[symbol][max(self.first, end - N):end]
+    
+    
+    def bars_left(self):
+        """
+            Returns the number of bars still to be replayed.
+            """
+        return self.end - self.bar_index
+    
+    
+    def update_bars(self):
+        """
+            Pushes the latest bar to the latest_symbol_data structure
+            for all symbols in the symbol list.
+            """
+        if self.bar_index >= self.end:
+            self.continue_backtest = False
+        else:
+            for s in self.symbol_list:
+                self.latest_symbol_data[s].append(
+                    self.symbol_bars[s][self.bar_index]
+                )
+            self.bar_index += 1
+            if self.screener is not None:
+                self.screener.update_at(self.bar_index - 1 - self.first)
+        self.events.put(MarketEvent())
+
+
+# Column names of the CSV headers (lower case), and the names they
+# are loaded under
+CSV_COLUMNS = {'date': 'datetime', 'datetime': 'datetime', 'time': 'datetime',
+               'open': 'open', 'high': 'high', 'low': 'low', 'close': 'close',
+               'volume': 'volume', 'adj close': 'adj_close',
+               'adj_close': 'adj_close', 'oi': 'oi', 'open interest': 'oi'}
+
+
+def load_csv_bars(csv_dir, symbol_list, validator=None):
+    """
+        Opens the CSV files from the data directory and converts
+        them into lists of bar tuples of the form
+        (symbol, datetime, open, high, low, close, volume), all
+        padded forward onto a common time index.
+        
+        It will be assumed that all files are of the form
+        'symbol.csv', where symbol is a string in the list, with a
+        header line naming the columns, e.g.
+        Date,Open,High,Low,Close,Volume,Adj Close.
+        
+        Parameters:
+        csv_dir - Absolute directory path to the CSV files.
+        symbol_list - A list of symbol strings.
+        validator - Optional validation.DataValidator run on the
+                    bars of each symbol before they are combined.
+        
+        Returns:
+        symbol_data, symbol_bars - The raw DataFrames and the bar lists,
+        both keyed by symbol.
+        """
+    symbol_data = {}
+    comb_index = None
+    for s in symbol_list:
+        # Load the CSV file indexed on date, the columns being mapped
+        # by their header names rather than their positions
+        frame = pd.io.parsers.read_csv(
+                                       os.path.join(csv_dir, '%s.csv' % s),
+                                       header=0, index_col=0, parse_dates=True
+                                       )
+        frame.columns = [CSV_COLUMNS.get(c.strip().lower(), c.strip().lower())
+                         for c in frame.columns]
+        frame.index.name = 'datetime'
+        missing = [f for f in BAR_FIELDS if f not in frame.columns]
+        if missing:
+            raise ValueError("%s.csv has no %s column" % (s, ", ".join(missing)))
+        if validator is not None:
+            frame = validator.validate(s, frame)
+        symbol_data[s] = frame
+        
+        # Combine the index to pad forward values
+        if comb_index is None:
+            comb_index = symbol_data[s].index
+        else:
+            comb_index = comb_index.union(symbol_data[s].index)
+    
+    # Reindex the dataframes and convert them once into bar tuples,
+    # so that the bar loop never has to touch pandas again
+    times = comb_index.to_pydatetime()
+    symbol_bars = {}
+    for s in symbol_list:
+        symbol_data[s] = symbol_data[s].reindex(index=comb_index, method='pad')
+        columns = [symbol_data[s][f].tolist() for f in BAR_FIELDS]
+        symbol_bars[s] = [(s,) + r for r in zip(times, *columns)]
+    return symbol_data, symbol_bars
+
+
+def adjust_bars(symbol_data, symbol_bars):
+    """
+        Derives the split and dividend adjustment factor of every bar
+        from the 'adj_close' column, as adj_close / close, and applies
+        it to the bars of each symbol with whole-array operations:
+        prices are multiplied by the factor and volumes divided by it.
+        The factors are also kept in a 'factor' column of symbol_data.
+        
+        The adjustment is backwards from the latest bar, so the level
+        of the adjusted prices depends on later events, but not their
+        ratios: returns of adjusted bars use no future data.
+        
+        Parameters:
+        symbol_data, symbol_bars - As returned by load_csv_bars.
+        
+        Returns:
+        A dictionary of symbol -> list of adjusted bar tuples, aligned
+        with symbol_bars. Symbols without an 'adj_close' column keep
+        their raw bars.
+        """
+    symbol_adjusted = {}
+    for s, bars_list in symbol_bars.items():
+        frame = symbol_data[s]
+        if 'adj_close' not in frame.columns:
+            symbol_adjusted[s] = bars_list
+            continue
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = frame['adj_close'].values / frame['close'].values
+        factor[~(factor > 0) | ~np.isfinite(factor)] = 1.0
+        frame['factor'] = factor
+        
+        prices = frame[BAR_FIELDS[:4]].values * factor[:, None]
+        columns = [p.tolist() for p in prices.T]
+        columns.append((frame['volume'].values / factor).tolist())
+        times = [b[1] for b in bars_list]
+        symbol_adjusted[s] = [(s,) + r for r in zip(times, *columns)]
+    return symbol_adjusted
+
+
+class HistoricCSVDataHandler(InMemoryDataHandler):
     """
         HistoricCSVDataHandler is designed to read CSV files for
         each requested symbol from disk and provide an interface
@@ -48,7 +471,7 @@ class HistoricCSVDataHandler(DataHandler):
         trading interface.
         """
     
-    def __init__(self, events, csv_dir, symbol_list):
+    def __init__(self, events, csv_dir, symbol_list, validator=None):
         """
             Initialises the historic data handler by requesting
             the location of the CSV files and a list of symbols.
@@ -60,66 +483,276 @@ class HistoricCSVDataHandler(DataHandler):
             events - The Event Queue.
             csv_dir - Absolute directory path to the CSV files.
             symbol_list - A list of symbol strings.
+            validator - Optional validation.DataValidator checking
+                        the bars as they are loaded.
+            
+            The bars adjusted with the 'Adj Close' column, if any, are
+            computed once here, see get_latest_adjusted_bars.
             """
-        self.events = events
         self.csv_dir = csv_dir
-        self.symbol_list = symbol_list
-        
+        self.validator = validator
         self.symbol_data = {}
-        self.latest_symbol_data = {}
-        self.continue_backtest = True
-        self._open_convert_csv_files()
+        symbol_bars = self._open_convert_csv_files(symbol_list)
+        super(HistoricCSVDataHandler, self).__init__(
+            events, symbol_bars, symbol_list,
+            adjusted_bars=adjust_bars(self.symbol_data, symbol_bars)
+        )
     
     
-    def _open_convert_csv_files(self):
+    def _open_convert_csv_files(self, symbol_list):
         """
             Opens the CSV files from the data directory, converting
-            them into pandas DataFrames within a symbol dictionary.
+            them into pandas DataFrames within a symbol dictionary
+            and into the bar tuples that are replayed.
             
             For this handler it will be assumed that the data is
             taken from DTN IQFeed. Thus its format will be respected.
             """
-        comb_index = None
-        for s in self.symbol_list:
-            # Load the CSV file with no header information, indexed on date
-            self.symbol_data[s] = pd.io.parsers.read_csv(
-                                                         os.path.join(self.csv_dir, '%s.csv' % s),
-                                                         header=0, index_col=0,
-                                                         names=['datetime','open','low','high','close','volume','oi']
-                                                         )
-                
-            # Combine the index to pad forward values
-            if comb_index is None:
-                comb_index = self.symbol_data[s].index
-            else:
-                comb_index.union(self.symbol_data[s].index)
-                                                                 
-            # Set the latest symbol_data to None
-            self.latest_symbol_data[s] = []
-                                                             
-        # Reindex the dataframes
-        for s in self.symbol_list:
-            self.symbol_data[s] = self.symbol_data[s].reindex(index=comb_index, method='pad').iterrows()
+        self.symbol_data, symbol_bars = load_csv_bars(self.csv_dir, symbol_list,
+                                                      self.validator)
+        return symbol_bars
+
+
+
+# Columns read from columnar datasets, in bar tuple order after 'symbol'
+COLUMNAR_FIELDS = ['symbol', 'datetime', 'open', 'high', 'low', 'close', 'volume']
 
 
-    def _get_new_bar(self, symbol):
+class _ColumnarStream(object):
+    """
+        Lazily walks the chunks (row groups) of one file of a columnar
+        dataset, in datetime order, keeping a single chunk in memory.
         """
-            Returns the latest bar from the data feed as a tuple of
-            (sybmbol, datetime, open, high, low, close, volume).
-            """
-        for b in self.symbol_data[symbol]:
-            yield tuple([symbol, datetime.strptime(b[0], '%Y-%m-%d'),
-                         b[1][0], b[1][1], b[1][2], b[1][3], b[1][4]])
-        #used to be:%Y-%m-%d %H:%M:%S
-        # Made some change on Jan-3-2016, changed datetime.datetime.strptime to
-        # datetime.strptime. Must due to the update of python library
+    
+    def __init__(self, chunks):
+        """
+            Parameters:
+            chunks - An iterator of DataFrames with the COLUMNAR_FIELDS
+                     columns, each sorted on datetime and following on
+                     from the previous one.
+            """
+        self.chunks = chunks
+        self.pos = 0
+        self.times = None
+        self._load_next_chunk()
+    
+    def _load_next_chunk(self):
+        """
+            Replaces the current chunk with the next non-empty one,
+            or sets times to None when the stream is exhausted.
+            """
+        self.times = None
+        for frame in self.chunks:
+            if len(frame) == 0:
+                continue
+            self.times = frame['datetime'].values.astype('datetime64[ns]')
+            self.symbols = frame['symbol'].values
+            self.values = frame[COLUMNAR_FIELDS[2:]].values.astype(np.float64)
+            self.pos = 0
+            return
+    
+    def head_time(self):
+        """
+            Returns the timestamp of the next unread row, or None.
+            """
+        if self.times is None:
+            return None
+        return self.times[self.pos]
+    
+    def pop_rows(self, ts):
+        """
+            Returns the (symbol, values) pairs of all rows stamped ts,
+            moving on to the following chunks as needed.
+            """
+        rows = []
+        while self.times is not None and self.times[self.pos] == ts:
+            end = self.pos + np.searchsorted(self.times[self.pos:], ts, side='right')
+            for i in range(self.pos, end):
+                rows.append((self.symbols[i], self.values[i]))
+            self.pos = end
+            if self.pos >= len(self.times):
+                self._load_next_chunk()
+        return rows
+
+
+class HistoricColumnarDataHandler(DataHandler):
+    """
+        HistoricColumnarDataHandler streams bars for many symbols from
+        a partitioned columnar dataset (a directory tree of Parquet
+        files, or an HDF5 table) and provides the same "latest" bar
+        interface as HistoricCSVDataHandler.
         
+        Only the requested symbols, the requested date range and the
+        OHLCV columns are read: Parquet row groups whose statistics
+        (or hive-style 'symbol=...' partition directories) cannot match
+        are skipped without being read, and HDF5 selections are pushed
+        down to PyTables. Chunks are read lazily as the backtest moves
+        forward and the files are merged on their timestamps, so the
+        whole universe never sits in memory at once.
         
-    def get_latest_bars(self, symbol, N=1):
+        Each file (or the HDF5 table) must be sorted on datetime and
+        have the columns symbol, datetime, open, high, low, close and
+        volume.
+        """
+    
+    def __init__(self, events, dataset_path, symbol_list,
+                 start_date=None, end_date=None, fmt='parquet',
+                 hdf_key='bars', chunksize=100000):
+        """
+            Initialises the columnar data handler.
+            
+            Parameters:
+            events - The Event Queue.
+            dataset_path - Root directory of the Parquet dataset, or
+                           path of the HDF5 file.
+            symbol_list - A list of symbol strings.
+            start_date - Optional first datetime to replay.
+            end_date - Optional last datetime to replay.
+            fmt - 'parquet' or 'hdf5'.
+            hdf_key - Key of the table inside the HDF5 file.
+            chunksize - Rows per chunk read from the HDF5 table.
+            """
+        self.events = events
+        self.dataset_path = dataset_path
+        self.symbol_list = symbol_list
+        self.start_date = None if start_date is None else pd.Timestamp(start_date)
+        self.end_date = None if end_date is None else pd.Timestamp(end_date)
+        self.fmt = fmt
+        self.hdf_key = hdf_key
+        self.chunksize = chunksize
+        
+        self._symbols = set(symbol_list)
+        self.latest_symbol_data = {}
+        for s in self.symbol_list:
+            self.latest_symbol_data[s] = []
+        self.continue_backtest = True
+        
+        if fmt == 'parquet':
+            chunk_iters = self._parquet_chunk_iters()
+        elif fmt == 'hdf5':
+            chunk_iters = self._hdf5_chunk_iters()
+        else:
+            raise ValueError("Unknown columnar format: %s" % fmt)
+        self.streams = [_ColumnarStream(c) for c in chunk_iters]
+    
+    
+    def _filter_frame(self, frame):
+        """
+            Drops the rows of a chunk outside the symbols and dates,
+            for the rows that statistics could not rule out.
+            """
+        mask = frame['symbol'].isin(self._symbols).values
+        if self.start_date is not None:
+            mask &= (frame['datetime'] >= self.start_date).values
+        if self.end_date is not None:
+            mask &= (frame['datetime'] <= self.end_date).values
+        return frame[mask]
+    
+    
+    def _row_group_may_match(self, metadata, index, names):
+        """
+            Uses the min/max statistics of a Parquet row group to
+            decide whether it can hold any requested row.
+            """
+        row_group = metadata.row_group(index)
+        for i in range(row_group.num_columns):
+            column = row_group.column(i)
+            name = names[i]
+            stats = column.statistics
+            if stats is None or not stats.has_min_max:
+                continue
+            if name == 'symbol':
+                lo, hi = stats.min, stats.max
+                if isinstance(lo, bytes) and not isinstance(lo, str):
+                    lo, hi = lo.decode('utf-8'), hi.decode('utf-8')
+                if not any(lo <= s <= hi for s in self._symbols):
+                    return False
+            elif name == 'datetime':
+                if self.start_date is not None and pd.Timestamp(stats.max) < self.start_date:
+                    return False
+                if self.end_date is not None and pd.Timestamp(stats.min) > self.end_date:
+                    return False
+        return True
+    
+    
+    def _parquet_file_chunks(self, path, partition_symbol):
+        """
+            Yields the matching row groups of one Parquet file as
+            DataFrames, reading only the OHLCV columns.
+            """
+        import pyarrow.parquet as pq
+        
+        parquet_file = pq.ParquetFile(path)
+        names = [parquet_file.schema.column(i).name
+                 for i in range(len(parquet_file.schema))]
+        columns = [c for c in COLUMNAR_FIELDS if c in names]
+        for i in range(parquet_file.num_row_groups):
+            if not self._row_group_may_match(parquet_file.metadata, i, names):
+                continue
+            frame = parquet_file.read_row_group(i, columns=columns).to_pandas()
+            if 'symbol' not in frame:
+                frame['symbol'] = partition_symbol
+            yield self._filter_frame(frame)
+    
+    
+    def _parquet_chunk_iters(self):
+        """
+            Returns one lazy chunk iterator per Parquet file of the
+            dataset, pruning 'symbol=...' partitions by name.
+            """
+        chunk_iters = []
+        for root, dirs, files in os.walk(self.dataset_path):
+            dirs.sort()
+            partition_symbol = None
+            for part in os.path.relpath(root, self.dataset_path).split(os.sep):
+                if part.startswith('symbol='):
+                    partition_symbol = part[len('symbol='):]
+            if partition_symbol is not None and partition_symbol not in self._symbols:
+                dirs[:] = []
+                continue
+            for name in sorted(files):
+                if name.endswith('.parquet'):
+                    chunk_iters.append(self._parquet_file_chunks(
+                        os.path.join(root, name), partition_symbol
+                    ))
+        return chunk_iters
+    
+    
+    def _hdf5_chunk_iters(self):
+        """
+            Returns a lazy chunk iterator over the HDF5 table, with the
+            symbol and date selection pushed down to PyTables. The
+            table must be stored in 'table' format with symbol and
+            datetime as data columns.
+            """
+        def chunks():
+            # The conditions refer to these local variables, which
+            # PyTables resolves, rather than formatting the values
+            # into the query
+            symbol_list = list(self.symbol_list)
+            start_date, end_date = self.start_date, self.end_date
+            where = ["symbol in symbol_list"]
+            if start_date is not None:
+                where.append("datetime >= start_date")
+            if end_date is not None:
+                where.append("datetime <= end_date")
+            store = pd.HDFStore(self.dataset_path, mode='r')
+            try:
+                for frame in store.select(self.hdf_key, where=where,
+                                          columns=COLUMNAR_FIELDS,
+                                          chunksize=self.chunksize):
+                    yield frame
+            finally:
+                store.close()
+        return [chunks()]
+    
+    
+    def get_latest_bars(self, symbol, N=1, resolution=None):
         """
             Returns the last N bars from the latest_symbol list,
             or N-k if less available.
             """
+        self.check_resolution(resolution)
         try:
             bars_list = self.latest_symbol_data[symbol]
         except KeyError:
@@ -130,17 +763,29 @@ class HistoricCSVDataHandler(DataHandler):
     
     def update_bars(self):
         """
-            Pushes the latest bar to the latest_symbol_data structure
-            for all symbols in the symbol list.
+            Pushes the bars of the next timestamp found in the dataset
+            to the latest_symbol_data structure. Symbols without a bar
+            at that timestamp are padded forward from their last bar.
             """
-        for s in self.symbol_list:
-            try:
-                bar = self._get_new_bar(s).next()
-            except StopIteration:
-                self.continue_backtest = False
-            else:
+        heads = [st.head_time() for st in self.streams]
+        heads = [h for h in heads if h is not None]
+        if len(heads) == 0:
+            self.continue_backtest = False
+        else:
+            ts = min(heads)
+            dt = pd.Timestamp(ts).to_pydatetime()
+            new_bars = {}
+            for st in self.streams:
+                for symbol, v in st.pop_rows(ts):
+                    new_bars[symbol] = (symbol, dt, v[0], v[1], v[2], v[3], v[4])
+            for s in self.symbol_list:
+                bar = new_bars.get(s)
+                if bar is None and self.latest_symbol_data[s]:
+                    bar = (s, dt) + self.latest_symbol_data[s][-1][2:]
                 if bar is not None:
                     self.latest_symbol_data[s].append(bar)
+            if self.screener is not None:
+                self.screener.update(self)
         self.events.put(MarketEvent())
 
 
@@ -152,6 +797,8 @@ class GoogleFinanceAPI:
     
     
     def get(self,symbol,period,days):
+        # Only live runs fetch web data, so urllib2 is imported here
+        import urllib2
         url = self.prefix+"i=%s&p=%s&&f=d,o,h,l,c,v&df=cpct&q=%s"%(period,days,symbol)
         u = urllib2.urlopen(url)
         content = u.read()
@@ -200,7 +847,9 @@ class RealTimeDataHandler(DataHandler):
         """
         
     def _init_download_dataframe(self):
-        
+        # pandas.io.data is slow to import and only needed here
+        from pandas.io.data import DataReader
+
         comb_index = None
         start_date = datetime(2011,12,5)
         end_date = datetime(2011,12,16)
@@ -231,17 +880,36 @@ class RealTimeDataHandler(DataHandler):
             Pushes the latest bar to the latest_symbol_data structure
             for all symbols in the symbol list.
             """
-        for s in self.symbol_list:
-            bar = self._get_new_bar(s)
+        self.push_bars(self.fetch_bars())
+    
+    
+    def fetch_bars(self):
+        """
+            Downloads the latest bar of every symbol, without changing
+            the handler, so that it can run on another thread than
+            the one reading the bars (see live.LiveRunner).
+            """
+        return [self._get_new_bar(s) for s in self.symbol_list]
+    
+    
+    def push_bars(self, new_bars):
+        """
+            Appends the bars returned by fetch_bars and puts a
+            MarketEvent.
+            """
+        for s, bar in zip(self.symbol_list, new_bars):
             self.latest_symbol_data[s].append(bar)
+        if self.screener is not None:
+            self.screener.update(self)
         self.events.put(MarketEvent())
 
 
-    def get_latest_bars(self, symbol, N=1):
+    def get_latest_bars(self, symbol, N=1, resolution=None):
         """
             Returns the last N bars from the latest_symbol list,
             or N-k if less available.
             """
+        self.check_resolution(resolution)
         try:
             bars_list = self.latest_symbol_data[symbol]
         except KeyError:
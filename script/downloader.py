@@ -0,0 +1,500 @@
+# downloader.py
+
+import csv
+import json
+import os, os.path
+import threading
+import time
+import traceback
+import urllib2
+import Queue
+from datetime import datetime, timedelta
+
+from ratelimit import TokenBucket, SlidingWindowLimit
+
+
+# IB historical data pacing: no more than 60 requests in any ten
+# minutes, and fewer than 6 requests for the same contract in two
+# seconds. A bucket of capacity C refilled at rate R lets through at
+# most C + R * 600 requests in ten minutes, so it is tuned to 6 + 50,
+# and the per-contract window is widened, leaving a margin for the
+# jitter between sending a request and the server receiving it.
+IB_HISTORICAL_RATE = 50.0 / 600.0
+IB_HISTORICAL_BURST = 6
+IB_SAME_CONTRACT_REQUESTS = 5
+IB_SAME_CONTRACT_PERIOD = 2.5
+IB_MAX_IN_FLIGHT = 50
+
+# Error 162 covers both pacing violations and empty results
+IB_PACING_MESSAGE = "pacing violation"
+IB_NO_DATA_MESSAGE = "HMDS query returned no data"
+
+# Column layout of the 'symbol.csv' files read by HistoricCSVDataHandler
+CSV_HEADER = ['Date', 'Open', 'High', 'Low', 'Close', 'Volume', 'Adj Close']
+
+
+class PacingViolation(Exception):
+    """
+        Raised by a historical data source when the server rejected a
+        request for exceeding its pacing limits.
+        """
+    pass
+
+
+class HTTPCSVSource(object):
+    """
+        Fetches daily bars as CSV over HTTP, one symbol and date range
+        per request, e.g. from a Yahoo-style endpoint or a local fake
+        server. The response must use the CSV_HEADER layout.
+        """
+
+    def __init__(self, base_url, timeout=30):
+        """
+            Parameters:
+            base_url - URL queried with ?s=symbol&start=...&end=...
+            timeout - Socket timeout of each request in seconds.
+            """
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def fetch(self, symbol, start, end):
+        """
+            Returns the bars of symbol between the start and end dates
+            (inclusive) as a list of rows in CSV_HEADER order.
+            """
+        url = "%s?s=%s&start=%s&end=%s" % (self.base_url, symbol,
+                                          start.strftime('%Y-%m-%d'),
+                                          end.strftime('%Y-%m-%d'))
+        try:
+            u = urllib2.urlopen(url, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code in (429, 503):
+                raise PacingViolation("%s: HTTP %d" % (symbol, e.code))
+            raise
+        content = u.read()
+        rows = list(csv.reader(content.splitlines()))
+        return [r for r in rows[1:] if len(r) == len(CSV_HEADER)]
+
+
+class IBHistoricalSource(object):
+    """
+        Fetches daily bars with reqHistoricalData over an IbPy
+        connection. Requests from several threads are matched to
+        their replies by request id.
+        """
+
+    def __init__(self, connection, sec_type="STK", exchange="SMART",
+                 currency="USD", what_to_show="TRADES", timeout=120):
+        """
+            Parameters:
+            connection - A connected IbPy connection.
+            sec_type - Security type of the contracts.
+            exchange - Exchange of the contracts.
+            currency - Currency of the contracts.
+            what_to_show - IB data type, e.g. 'TRADES' or 'MIDPOINT'.
+            timeout - Seconds to wait for each request to complete.
+            """
+        self.connection = connection
+        self.sec_type = sec_type
+        self.exchange = exchange
+        self.currency = currency
+        self.what_to_show = what_to_show
+        self.timeout = timeout
+
+        self.next_req_id = 1
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.connection.register(self._historical_data_handler, 'HistoricalData')
+        self.connection.register(self._error_handler, 'Error')
+
+    def _historical_data_handler(self, msg):
+        """
+            Collects the bars of a request until IB sends 'finished'.
+            """
+        request = self.requests.get(msg.reqId)
+        if request is None:
+            return
+        if str(msg.date).startswith('finished'):
+            request["done"].set()
+        else:
+            day = datetime.strptime(str(msg.date), '%Y%m%d').strftime('%Y-%m-%d')
+            request["rows"].append([day, msg.open, msg.high, msg.low,
+                                    msg.close, msg.volume, msg.close])
+
+    def _error_handler(self, msg):
+        """
+            Flags pacing violations, empty results (both error 162)
+            and other request errors.
+            """
+        request = self.requests.get(msg.id)
+        if request is None:
+            return
+        request["error"] = msg
+        request["done"].set()
+
+    def fetch(self, symbol, start, end):
+        """
+            Returns the bars of symbol between the start and end dates
+            (inclusive) as a list of rows in CSV_HEADER order.
+            """
+        from ib.ext.Contract import Contract
+
+        contract = Contract()
+        contract.m_symbol = symbol
+        contract.m_secType = self.sec_type
+        contract.m_exchange = self.exchange
+        contract.m_currency = self.currency
+
+        with self.lock:
+            req_id = self.next_req_id
+            self.next_req_id += 1
+        request = {"rows": [], "error": None, "done": threading.Event()}
+        self.requests[req_id] = request
+        try:
+            duration = "%d D" % ((end - start).days + 1)
+            self.connection.reqHistoricalData(
+                req_id, contract, end.strftime('%Y%m%d 23:59:59'), duration,
+                "1 day", self.what_to_show, 1, 1
+            )
+            if not request["done"].wait(self.timeout):
+                raise IOError("%s: historical data request timed out" % symbol)
+            error = request["error"]
+            if error is not None:
+                text = str(error.errorMsg)
+                if error.errorCode == 162 and IB_PACING_MESSAGE in text.lower():
+                    raise PacingViolation("%s: %s" % (symbol, text))
+                if error.errorCode == 162 and IB_NO_DATA_MESSAGE in text:
+                    # No bars in the range, e.g. only holidays
+                    return []
+                raise IOError("%s: %s" % (symbol, text))
+        finally:
+            del self.requests[req_id]
+        first = start.strftime('%Y-%m-%d')
+        return [r for r in request["rows"] if r[0] >= first]
+
+
+def _missing_ranges(start, end, covered):
+    """
+        Returns the (start, end) date ranges within [start, end] that
+        are not covered by any of the covered (start, end) ranges.
+        """
+    missing = []
+    cursor = start
+    for lo, hi in sorted(covered):
+        if hi < cursor:
+            continue
+        if lo > end:
+            break
+        if lo > cursor:
+            missing.append((cursor, lo - timedelta(days=1)))
+        cursor = max(cursor, hi + timedelta(days=1))
+    if cursor <= end:
+        missing.append((cursor, end))
+    return missing
+
+
+def _atomic_write(path, text):
+    """
+        Writes text to path through a temporary file, so that an
+        interrupted download never leaves a truncated file behind.
+        """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(text)
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+class BulkHistoricalDownloader(object):
+    """
+        Downloads daily bars for many symbols into the 'symbol.csv'
+        files read by HistoricCSVDataHandler.
+
+        Only the date ranges not already in a symbol's file (or
+        recorded in the checkpoint as fetched, e.g. ranges where there
+        was no trading) are requested, split into chunks of at most
+        chunk_days. The file covers the days between two consecutive
+        stored bars up to max_gap_days apart, i.e. weekends and
+        holidays; a longer gap is fetched again, once. Chunks are
+        fetched by max_in_flight threads, paced by a token bucket
+        shared by all of them plus a per-symbol window limit. A chunk
+        rejected for pacing is queued again to be retried after an
+        exponential backoff, leaving its thread to the other chunks
+        meanwhile. Each chunk is merged into the symbol's file and
+        recorded in the checkpoint as soon as it arrives, so an
+        interrupted download resumes where it stopped. A chunk after
+        the last stored bar, the usual case, is appended to the file;
+        the file is only rewritten for a chunk which falls before it.
+        """
+
+    def __init__(self, source, csv_dir, checkpoint_path=None,
+                 bucket=None, symbol_limit=None, max_in_flight=10,
+                 chunk_days=365, max_retries=5, backoff=2.0,
+                 max_gap_days=5):
+        """
+            Initialises the downloader.
+
+            Parameters:
+            source - Object with a fetch(symbol, start, end) method,
+                     e.g. HTTPCSVSource or IBHistoricalSource.
+            csv_dir - Directory of the 'symbol.csv' files.
+            checkpoint_path - JSON file of the fetched ranges (defaults
+                              to 'download_checkpoint.json' in csv_dir).
+            bucket - TokenBucket pacing all requests (defaults to the
+                     IB historical data limits).
+            symbol_limit - SlidingWindowLimit per symbol (defaults to
+                           the IB same-contract limit).
+            max_in_flight - Number of concurrent requests.
+            chunk_days - Maximum number of days per request.
+            max_retries - Attempts per chunk before giving up.
+            backoff - Base of the exponential backoff in seconds after
+                      a pacing violation.
+            max_gap_days - Most calendar days between two stored bars
+                           still considered covered, e.g. a weekend
+                           followed by a holiday.
+            """
+        self.source = source
+        self.csv_dir = csv_dir
+        if checkpoint_path is None:
+            checkpoint_path = os.path.join(csv_dir, 'download_checkpoint.json')
+        self.checkpoint_path = checkpoint_path
+        if bucket is None:
+            bucket = TokenBucket(IB_HISTORICAL_RATE, IB_HISTORICAL_BURST)
+        self.bucket = bucket
+        if symbol_limit is None:
+            symbol_limit = SlidingWindowLimit(IB_SAME_CONTRACT_REQUESTS,
+                                              IB_SAME_CONTRACT_PERIOD)
+        self.symbol_limit = symbol_limit
+        self.max_in_flight = min(max_in_flight, IB_MAX_IN_FLIGHT)
+        self.chunk_days = chunk_days
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_gap_days = max_gap_days
+
+        self.lock = threading.Lock()
+        self.checkpoint = self._load_checkpoint()
+        self.stores = {}
+        self.last_days = {}
+        self.failures = {}
+
+    def _load_checkpoint(self):
+        """
+            Reads the fetched ranges of the previous runs.
+            """
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path) as f:
+            return json.load(f)
+
+    def _save_checkpoint(self):
+        """
+            Writes the fetched ranges. Must be called with the lock held.
+            """
+        _atomic_write(self.checkpoint_path, json.dumps(self.checkpoint, sort_keys=True))
+
+    def _csv_path(self, symbol):
+        """
+            Returns the path of the file of symbol.
+            """
+        return os.path.join(self.csv_dir, '%s.csv' % symbol)
+
+    def _load_store(self, symbol):
+        """
+            Reads the rows already stored for symbol, keyed by date.
+            A last line cut short by an interrupted append is removed
+            from the file; its bars are fetched again.
+            """
+        store = {}
+        path = self._csv_path(symbol)
+        if os.path.exists(path):
+            with open(path, 'r+b') as f:
+                text = f.read()
+                if text and not text.endswith('\n'):
+                    text = text[:text.rfind('\n') + 1]
+                    f.truncate(len(text))
+            for r in list(csv.reader(text.splitlines()))[1:]:
+                if len(r) == len(CSV_HEADER):
+                    store[r[0]] = r
+        return store
+
+    def _write_store(self, symbol):
+        """
+            Writes the rows of symbol, in date order, in the format of
+            HistoricCSVDataHandler. Must be called with the lock held.
+            """
+        lines = [','.join(CSV_HEADER)]
+        store = self.stores[symbol]
+        for day in sorted(store.keys()):
+            lines.append(','.join(str(x) for x in store[day]))
+        _atomic_write(self._csv_path(symbol), '\n'.join(lines) + '\n')
+
+    def _append_store(self, symbol, rows):
+        """
+            Appends rows, in date order and all after the last stored
+            row, to the file of symbol. Must be called with the lock
+            held.
+            """
+        path = self._csv_path(symbol)
+        lines = [] if os.path.exists(path) else [','.join(CSV_HEADER)]
+        for r in sorted(rows):
+            lines.append(','.join(str(x) for x in r))
+        # One write per chunk, ending with the newline that marks the
+        # last line as complete
+        with open(path, 'ab') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def _last_day(self, symbol):
+        """
+            Returns the date of the last stored row of symbol, '' if
+            there is none.
+            """
+        if symbol not in self.last_days:
+            store = self.stores[symbol]
+            self.last_days[symbol] = max(store.keys()) if store else ''
+        return self.last_days[symbol]
+
+    def plan(self, symbol, start, end):
+        """
+            Returns the (start, end) chunks still to fetch for symbol.
+            """
+        store = self.stores[symbol]
+        covered = []
+        days = [datetime.strptime(d, '%Y-%m-%d').date() for d in sorted(store.keys())]
+        max_gap = timedelta(days=self.max_gap_days)
+        for i, day in enumerate(days):
+            if i > 0 and day - days[i - 1] <= max_gap:
+                covered[-1] = (covered[-1][0], day)
+            else:
+                covered.append((day, day))
+        for lo, hi in self.checkpoint.get(symbol, []):
+            covered.append((datetime.strptime(lo, '%Y-%m-%d').date(),
+                            datetime.strptime(hi, '%Y-%m-%d').date()))
+
+        chunks = []
+        for lo, hi in _missing_ranges(start, end, covered):
+            while lo <= hi:
+                chunk_end = min(hi, lo + timedelta(days=self.chunk_days - 1))
+                chunks.append((lo, chunk_end))
+                lo = chunk_end + timedelta(days=1)
+        return chunks
+
+    def _complete_chunk(self, symbol, lo, hi, rows):
+        """
+            Merges the rows of a fetched chunk into the symbol's file
+            and records the chunk in the checkpoint.
+            """
+        with self.lock:
+            store = self.stores[symbol]
+            new_rows = [r for r in rows if store.get(r[0]) != r]
+            if new_rows:
+                last_day = self._last_day(symbol)
+                for r in new_rows:
+                    store[r[0]] = r
+                if min(r[0] for r in new_rows) > last_day:
+                    self._append_store(symbol, new_rows)
+                else:
+                    # Before the end of the file, e.g. a chunk which
+                    # completed after a later one
+                    self._write_store(symbol)
+                self.last_days[symbol] = max(store.keys())
+            self.checkpoint.setdefault(symbol, []).append(
+                [lo.strftime('%Y-%m-%d'), hi.strftime('%Y-%m-%d')]
+            )
+            self._save_checkpoint()
+
+    def _fail(self, symbol, lo, hi, reason):
+        """
+            Records a chunk given up on.
+            """
+        with self.lock:
+            self.failures[(symbol, lo, hi)] = reason
+
+    def _worker(self, tasks):
+        """
+            Fetches chunks from the task queue until it is empty. The
+            tasks are ordered by the time before which they must not
+            be retried.
+            """
+        while True:
+            try:
+                task = tasks.get(False)
+            except Queue.Empty:
+                return
+            not_before, seq, (symbol, lo, hi, attempt) = task
+            wait = not_before - time.time()
+            if wait > 0.0:
+                # Every queued chunk is backing off: put it back and
+                # check again shortly, or when it is due
+                tasks.put(task)
+                time.sleep(min(wait, 0.5))
+                continue
+            wait = self.symbol_limit.delay(symbol)
+            while wait > 0.0:
+                time.sleep(wait)
+                wait = self.symbol_limit.delay(symbol)
+            self.bucket.acquire()
+            try:
+                rows = self.source.fetch(symbol, lo, hi)
+            except PacingViolation:
+                if attempt + 1 >= self.max_retries:
+                    self._fail(symbol, lo, hi, "pacing violation")
+                else:
+                    tasks.put((time.time() + self.backoff ** attempt, seq,
+                               (symbol, lo, hi, attempt + 1)))
+            except Exception as e:
+                # Any other error only costs this chunk, never the worker
+                print "Failed to fetch %s from %s to %s: %s" % (symbol, lo, hi, e)
+                if attempt + 1 >= self.max_retries:
+                    self._fail(symbol, lo, hi, str(e))
+                else:
+                    tasks.put((0.0, seq, (symbol, lo, hi, attempt + 1)))
+            else:
+                try:
+                    self._complete_chunk(symbol, lo, hi, rows)
+                except Exception as e:
+                    print "Failed to store %s from %s to %s:" % (symbol, lo, hi)
+                    traceback.print_exc()
+                    self._fail(symbol, lo, hi, str(e))
+
+    def download(self, symbol_list, start, end):
+        """
+            Brings the files of all symbols up to date over the
+            [start, end] date range.
+
+            Parameters:
+            symbol_list - A list of symbol strings.
+            start - First date (datetime.date) to cover.
+            end - Last date (datetime.date) to cover.
+
+            Returns:
+            The number of chunks requested.
+            """
+        if isinstance(start, datetime):
+            start = start.date()
+        if isinstance(end, datetime):
+            end = end.date()
+
+        plans = []
+        for s in symbol_list:
+            self.stores[s] = self._load_store(s)
+            plans.append([(s, lo, hi, 0) for lo, hi in self.plan(s, start, end)])
+
+        # Interleave the symbols, so that consecutive requests are for
+        # different contracts and rarely wait on the per-symbol limit
+        tasks = Queue.PriorityQueue()
+        n_chunks = 0
+        for i in range(max([len(p) for p in plans] + [0])):
+            for p in plans:
+                if i < len(p):
+                    tasks.put((0.0, n_chunks, p[i]))
+                    n_chunks += 1
+
+        threads = [threading.Thread(target=self._worker, args=(tasks,))
+                   for i in range(min(self.max_in_flight, max(n_chunks, 1)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return n_chunks
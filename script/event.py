@@ -51,7 +51,7 @@ class OrderEvent(Event):
         quantity and a direction.
         """
     
-    def __init__(self, symbol, order_type, quantity, direction):
+    def __init__(self, symbol, order_type, quantity, direction, price=None):
         """
             Initialises the order type, setting whether it is
             a Market order ('MKT') or Limit order ('LMT'), has
@@ -63,6 +63,7 @@ class OrderEvent(Event):
             order_type - 'MKT' or 'LMT' for Market or Limit.
             quantity - Non-negative integer for quantity.
             direction - 'BUY' or 'SELL' for long or short.
+            price - The limit price of a 'LMT' order.
             """
         
         self.type = 'ORDER'
@@ -70,6 +71,7 @@ class OrderEvent(Event):
         self.order_type = order_type
         self.quantity = quantity
         self.direction = direction
+        self.price = price
     
     def print_order(self):
         """
@@ -138,5 +140,30 @@ class FillEvent(Event):
             full_cost = max(1.3, 0.013 * self.quantity)
         else: # Greater than 500
             full_cost = max(1.3, 0.008 * self.quantity)
-            full_cost = min(full_cost, 0.5 / 100.0 * self.quantity * self.fill_cost)
-        return full_cost
\ No newline at end of file
+            if self.fill_cost is not None: # unknown for simulated fills
+                full_cost = min(full_cost, 0.5 / 100.0 * self.quantity * self.fill_cost)
+        return full_cost
+
+
+class CancelEvent(Event):
+    """
+        Handles the event of an order ending without being filled:
+        cancelled, rejected or expired at the brokerage.
+        """
+    
+    def __init__(self, symbol, quantity, direction, status):
+        """
+            Initialises the CancelEvent.
+            
+            Parameters:
+            symbol - The instrument of the order.
+            quantity - The quantity which will not be filled.
+            direction - The direction of the order ('BUY' or 'SELL').
+            status - The order status sent by the brokerage.
+            """
+        
+        self.type = 'CANCEL'
+        self.symbol = symbol
+        self.quantity = quantity
+        self.direction = direction
+        self.status = status
\ No newline at end of file
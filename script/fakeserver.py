@@ -0,0 +1,213 @@
+# fakeserver.py
+
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from ratelimit import SlidingWindowLimit
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeHistoricalServer(object):
+    """
+        A local HTTP server serving daily bars in the CSV format of
+        HTTPCSVSource, which enforces IB-style historical data pacing:
+        requests beyond max_requests per period, beyond the per-symbol
+        limit or beyond max_in_flight concurrent requests are answered
+        with HTTP 429 and counted as violations.
+
+        It allows the bulk downloader to be exercised without a
+        connection to IB.
+        """
+
+    def __init__(self, bars, max_requests=60, period=600.0,
+                 symbol_requests=5, symbol_period=2.0, max_in_flight=50,
+                 latency=0.0):
+        """
+            Parameters:
+            bars - Dictionary of symbol -> list of rows in CSV_HEADER
+                   order, with 'YYYY-MM-DD' dates.
+            max_requests - Requests allowed in any window of period.
+            period - Length of the pacing window in seconds.
+            symbol_requests - Requests allowed per symbol in symbol_period.
+            symbol_period - Length of the per-symbol window in seconds.
+            max_in_flight - Maximum number of concurrent requests.
+            latency - Seconds taken to answer each request.
+            """
+        self.bars = bars
+        self.limit = SlidingWindowLimit(max_requests, period)
+        self.symbol_limit = SlidingWindowLimit(symbol_requests, symbol_period)
+        self.max_in_flight = max_in_flight
+        self.latency = latency
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_seen_in_flight = 0
+        self.requests = []
+        self.violations = 0
+        self.server = None
+
+    def _serve(self, symbol, start, end):
+        """
+            Returns the HTTP status and body of a bar request.
+            """
+        with self.lock:
+            self.requests.append((symbol, start, end))
+            self.in_flight += 1
+            self.max_seen_in_flight = max(self.max_seen_in_flight, self.in_flight)
+            paced = self.in_flight > self.max_in_flight or \
+                self.limit.delay(None) > 0.0 or \
+                self.symbol_limit.delay(symbol) > 0.0
+            if paced:
+                self.violations += 1
+        try:
+            if paced:
+                return 429, "pacing violation\n"
+            if self.latency > 0.0:
+                time.sleep(self.latency)
+            lines = ["Date,Open,High,Low,Close,Volume,Adj Close"]
+            for r in self.bars.get(symbol, []):
+                if start <= r[0] <= end:
+                    lines.append(','.join(str(x) for x in r))
+            return 200, '\n'.join(lines) + '\n'
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def start(self):
+        """
+            Starts serving on a free localhost port in a background
+            thread.
+
+            Returns:
+            The base URL to give to HTTPCSVSource.
+            """
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+                status, body = fake._serve(query['s'][0], query['start'][0],
+                                           query['end'][0])
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/csv')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return "http://127.0.0.1:%d/" % self.server.server_address[1]
+
+    def stop(self):
+        """
+            Stops the server.
+            """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class FakeTWS(object):
+    """
+        An in-process stand-in for an IbPy connection to TWS which
+        enforces the TWS limit of max_messages API messages per
+        second: the first message over the limit in any one second
+        window disconnects the client, as TWS does.
+
+        Every request method (placeOrder, cancelOrder, reqMktData ...)
+        counts as one message and is recorded in `messages`.
+        """
+
+    def __init__(self, max_messages=50, period=1.0, clock=time.time):
+        """
+            Parameters:
+            max_messages - Messages allowed in any window of period.
+            period - Length of the window in seconds.
+            clock - Function returning the current time in seconds.
+            """
+        self.max_messages = max_messages
+        self.period = period
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.messages = []
+        self.handlers = []
+        self.connected = False
+        self.violations = 0
+
+    def register(self, handler, *types):
+        """
+            Registers a handler for the named message types.
+            """
+        self.handlers.append((handler, types))
+
+    def registerAll(self, handler):
+        """
+            Registers a handler for all messages.
+            """
+        self.handlers.append((handler, None))
+
+    def connect(self):
+        """
+            Accepts the connection.
+            """
+        self.connected = True
+        return True
+
+    def disconnect(self):
+        """
+            Closes the connection.
+            """
+        self.connected = False
+
+    def max_rate(self):
+        """
+            Returns the largest number of messages seen in any window.
+            """
+        times = [m[0] for m in self.messages]
+        best, lo = 0, 0
+        for hi in range(len(times)):
+            while times[hi] - times[lo] >= self.period:
+                lo += 1
+            best = max(best, hi - lo + 1)
+        return best
+
+    def _receive(self, name, args):
+        """
+            Records a message and disconnects the client when it
+            breaks the rate limit.
+            """
+        with self.lock:
+            if not self.connected:
+                raise IOError("FakeTWS: not connected")
+            now = self.clock()
+            self.messages.append((now, name, args))
+            recent = [m for m in self.messages[-(self.max_messages + 1):]
+                      if now - m[0] < self.period]
+            if len(recent) > self.max_messages:
+                self.violations += 1
+                self.connected = False
+        if not self.connected:
+            for handler, types in self.handlers:
+                if types is None or 'ConnectionClosed' in types:
+                    handler(None)
+
+    def __getattr__(self, name):
+        """
+            Accepts any other TWS request as a message.
+            """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def request(*args):
+            self._receive(name, args)
+        return request
@@ -0,0 +1,222 @@
+# history.py
+
+from array import array
+
+import numpy as np
+import pandas as pd
+
+
+class SparseRow(dict):
+    """
+        One bar of a SparseHistory: a dictionary of the fields and
+        the non-zero symbols, which returns zero for the other symbols
+        of the universe, as the dense row would.
+        """
+
+    def __init__(self, entries, symbol_index, zero):
+        dict.__init__(self, entries)
+        self.symbol_index = symbol_index
+        self.zero = zero
+
+    def __missing__(self, key):
+        if key in self.symbol_index:
+            return self.zero
+        raise KeyError(key)
+
+
+class SparseHistory(object):
+    """
+        A bar by bar history of per-symbol values (positions or
+        holdings) which only stores the non-zero entries of each bar.
+
+        The entries of all bars are kept in two flat arrays, symbol
+        indices and values, with the offset of every bar's first
+        entry, plus one float array per scalar field (cash, total...).
+        A book of 40 names in a universe of 8,000 thus stores 40
+        entries per bar instead of 8,000.
+
+        Indexing returns a bar as a SparseRow, which reads like the
+        dense dictionary the portfolios used to store, e.g.
+        history[-1]['total'] or history[-1]['SPY'], and snapshot()
+        rebuilds that dense dictionary on demand.
+        """
+
+    def __init__(self, symbol_list, fields=(), zero=0):
+        """
+            Parameters:
+            symbol_list - The list of symbols of the universe.
+            fields - Names of the scalar fields stored with every bar.
+            zero - Value of the symbols missing from a bar.
+            """
+        self.symbol_list = list(symbol_list)
+        self.symbol_index = dict((s, i) for i, s in enumerate(self.symbol_list))
+        self.fields = list(fields)
+        self.zero = zero
+
+        self.datetimes = []
+        self.offsets = array('l', [0])
+        self.indices = array('l')
+        self.values = array('d')
+        self.field_values = dict((f, array('d')) for f in self.fields)
+
+    def append(self, row):
+        """
+            Appends a bar.
+
+            Parameters:
+            row - Dictionary with 'datetime', every field and the
+                  values of any symbols, zeros being dropped. It only
+                  needs to hold the non-zero symbols.
+            """
+        for key, value in row.iteritems():
+            if key in self.symbol_index:
+                if value != 0:
+                    self.indices.append(self.symbol_index[key])
+                    self.values.append(value)
+        for f in self.fields:
+            self.field_values[f].append(row[f])
+        self.datetimes.append(row['datetime'])
+        self.offsets.append(len(self.indices))
+
+    def __len__(self):
+        return len(self.datetimes)
+
+    def __getstate__(self):
+        # Pickle the arrays as raw bytes rather than lists of numbers
+        state = self.__dict__.copy()
+        for name in ('offsets', 'indices', 'values'):
+            state[name] = getattr(self, name).tostring()
+        state['field_values'] = dict((f, v.tostring())
+                                     for f, v in self.field_values.items())
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, typecode in (('offsets', 'l'), ('indices', 'l'), ('values', 'd')):
+            setattr(self, name, array(typecode, state[name]))
+        self.field_values = dict((f, array('d', v))
+                                 for f, v in state['field_values'].items())
+
+    def rows_since(self, n):
+        """
+            Returns the bars from bar n on, in a picklable form for
+            extend_rows, e.g. to checkpoint only the bars appended
+            since the last checkpoint.
+            """
+        lo = self.offsets[n]
+        counts = array('l', [self.offsets[i + 1] - self.offsets[i]
+                             for i in xrange(n, len(self))])
+        return {'datetimes': self.datetimes[n:],
+                'counts': counts.tostring(),
+                'indices': self.indices[lo:].tostring(),
+                'values': self.values[lo:].tostring(),
+                'field_values': dict((f, v[n:].tostring())
+                                     for f, v in self.field_values.items())}
+
+    def extend_rows(self, rows):
+        """
+            Appends the bars returned by rows_since.
+            """
+        for count in array('l', rows['counts']):
+            self.offsets.append(self.offsets[-1] + count)
+        self.indices.fromstring(rows['indices'])
+        self.values.fromstring(rows['values'])
+        for f, v in rows['field_values'].items():
+            self.field_values[f].fromstring(v)
+        self.datetimes.extend(rows['datetimes'])
+
+    def without_rows(self):
+        """
+            Returns a copy of the history without its bars, which
+            extend_rows fills again.
+            """
+        # Not copy.copy, which would serialise the arrays through
+        # __getstate__
+        history = object.__new__(self.__class__)
+        history.__dict__.update(self.__dict__)
+        history.datetimes = []
+        history.offsets = array('l', [0])
+        history.indices = array('l')
+        history.values = array('d')
+        history.field_values = dict((f, array('d')) for f in self.fields)
+        return history
+
+    def entries(self, i):
+        """
+            Returns the non-zero entries of bar i as a dictionary of
+            symbol -> value.
+            """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("history index out of range")
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return dict((self.symbol_list[self.indices[k]], self.values[k])
+                    for k in xrange(lo, hi))
+
+    def __getitem__(self, i):
+        """
+            Returns bar i as a SparseRow, or a list of them for a
+            slice.
+            """
+        if isinstance(i, slice):
+            return [self[k] for k in xrange(*i.indices(len(self)))]
+        row = SparseRow(self.entries(i), self.symbol_index, self.zero)
+        row['datetime'] = self.datetimes[i]
+        for f in self.fields:
+            row[f] = self.field_values[f][i]
+        return row
+
+    def get(self, i, key):
+        """
+            Returns a single field or symbol value of bar i without
+            building the row, e.g. history.get(-1, 'total').
+            """
+        if key in self.field_values:
+            return self.field_values[key][i]
+        if key == 'datetime':
+            return self.datetimes[i]
+        return self.entries(i).get(key, self.zero)
+
+    def snapshot(self, i):
+        """
+            Returns the dense dictionary of bar i, with an entry for
+            every symbol of the universe.
+            """
+        row = dict.fromkeys(self.symbol_list, self.zero)
+        row.update(self[i])
+        return row
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def field(self, name):
+        """
+            Returns a field of every bar as a numpy array.
+            """
+        return np.array(self.field_values[name], dtype='d')
+
+    def to_dataframe(self, symbols=None):
+        """
+            Returns the history as a dense DataFrame indexed by
+            datetime, with one column per symbol (only the given
+            symbols, if any) and per field.
+            """
+        symbols = self.symbol_list if symbols is None else list(symbols)
+        columns = np.array([self.symbol_index[s] for s in symbols], dtype=int)
+        position = np.full(len(self.symbol_list), -1, dtype=int)
+        position[columns] = np.arange(len(columns))
+
+        dense = np.zeros((len(self), len(columns)))
+        indices = np.array(self.indices, dtype=int)
+        values = np.array(self.values, dtype='d')
+        rows = np.repeat(np.arange(len(self)), np.diff(np.array(self.offsets, dtype=int)))
+        keep = position[indices] >= 0
+        dense[rows[keep], position[indices[keep]]] = values[keep]
+
+        frame = pd.DataFrame(dense, columns=symbols,
+                             index=pd.Index(self.datetimes, name='datetime'))
+        for f in self.fields:
+            frame[f] = self.field(f)
+        return frame
@@ -0,0 +1,447 @@
+# ibconnection.py
+
+import threading
+import time
+
+from ratelimit import TokenBucket
+from throttle import IB_MESSAGE_RATE, IB_MESSAGE_BURST
+
+
+# TWS error codes signalling a lost or restored connection
+CONNECTIVITY_LOST = 1100
+CONNECTIVITY_RESTORED_DATA_LOST = 1101
+CONNECTIVITY_RESTORED = 1102
+NOT_CONNECTED = 504
+
+
+def _ib_connection_factory(host, port, client_id):
+    """
+        Returns a function creating a new IbPy connection.
+        """
+    def factory():
+        from ib.opt import ibConnection
+        return ibConnection(host=host, port=port, clientId=client_id)
+    return factory
+
+
+class ManagedConnection(object):
+    """
+        A long-lived connection to TWS for one client id, shared by the
+        market data and the order traffic of a process.
+
+        It remembers the registered message handlers and the market
+        data subscriptions. When the first connection fails, or TWS
+        closes the socket (or reports that it is not connected), the
+        connection is re-established in the background with
+        exponential backoff, the handlers are re-registered, the market
+        data is re-requested and the open orders are re-queried with
+        reqOpenOrders. Requests made while disconnected are queued and
+        sent after the reconnection; those older than pending_expiry
+        seconds (order_expiry for orders, which go stale much sooner),
+        or beyond max_pending, are dropped with a message and passed
+        to the handlers registered with on_dropped.
+
+        The socket is never connected, nor the state restored, with
+        the lock held, so that the IbPy reader thread and the senders
+        are not stalled meanwhile.
+
+        Every request sent, including those replayed after a
+        reconnection, is paced by self.bucket, which the
+        OutboundScheduler of the orders shares, so that together they
+        stay under the TWS message rate. The scheduler takes the
+        tokens of its messages itself and sends them with
+        send_prepaid.
+
+        Any other IbPy request is passed through to the live socket.
+        """
+
+    def __init__(self, host="localhost", port=7496, client_id=0,
+                 factory=None, initial_backoff=1.0, max_backoff=60.0,
+                 sleep=time.sleep, max_pending=1000, pending_expiry=300.0,
+                 order_expiry=5.0, clock=time.time, bucket=None):
+        """
+            Parameters:
+            host - Host of TWS / IB Gateway.
+            port - Port of TWS / IB Gateway.
+            client_id - The client id of the socket.
+            factory - Function returning a new, unconnected IbPy
+                      connection (defaults to ib.opt.ibConnection).
+            initial_backoff - First wait between reconnection attempts.
+            max_backoff - Longest wait between reconnection attempts.
+            sleep - Function used to wait between attempts.
+            max_pending - Most requests queued while disconnected.
+            pending_expiry - Seconds after which a queued request is
+                             dropped instead of sent.
+            order_expiry - Seconds after which a queued placeOrder is
+                           dropped instead of sent.
+            clock - Function returning the current time in seconds.
+            bucket - TokenBucket pacing the messages, created at the
+                     TWS rate by default.
+            """
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        if factory is None:
+            factory = _ib_connection_factory(host, port, client_id)
+        self.factory = factory
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.max_pending = max_pending
+        self.pending_expiry = pending_expiry
+        self.order_expiry = order_expiry
+        self.clock = clock
+        if bucket is None:
+            bucket = TokenBucket(IB_MESSAGE_RATE, IB_MESSAGE_BURST)
+        self.bucket = bucket
+
+        self.conn = None
+        self.connected = False
+        self.closed = False
+        self.reconnecting = False
+        self.reconnections = 0
+        self.lock = threading.RLock()
+
+        self.handlers = []
+        self.all_handlers = []
+        self.dropped_handlers = []
+        self.subscriptions = {}
+        self.pending = []
+
+    def _open(self):
+        """
+            Creates and connects a new socket, attaching the handlers.
+            Called without the lock, as connecting blocks.
+
+            Returns:
+            The connection, None if it failed.
+            """
+        with self.lock:
+            handlers = list(self.handlers)
+            all_handlers = list(self.all_handlers)
+        conn = self.factory()
+        conn.register(self._connection_closed_handler, 'ConnectionClosed')
+        conn.register(self._error_handler, 'Error')
+        for handler, types in handlers:
+            conn.register(handler, *types)
+        for handler in all_handlers:
+            conn.registerAll(handler)
+        if conn.connect() is False:
+            return None
+        with self.lock:
+            # Handlers registered while connecting
+            for handler, types in self.handlers[len(handlers):]:
+                conn.register(handler, *types)
+            for handler in self.all_handlers[len(all_handlers):]:
+                conn.registerAll(handler)
+        return conn
+
+    def connect(self):
+        """
+            Opens the socket if it is not open yet. If that fails, the
+            connection keeps being retried in the background.
+
+            Returns:
+            True if the socket is open.
+            """
+        with self.lock:
+            if self.connected or self.reconnecting:
+                return self.connected
+            self.closed = False
+            # Keeps other threads from connecting meanwhile
+            self.reconnecting = True
+        try:
+            conn = self._open()
+        except Exception, e:
+            print "Connection to TWS failed: %s" % e
+            conn = None
+        if conn is None:
+            with self.lock:
+                self.reconnecting = False
+            self._start_reconnect()
+            return False
+        with self.lock:
+            self.conn = conn
+        # Flushes the requests queued before the first connection
+        self._restore_state()
+        with self.lock:
+            self.reconnecting = False
+        return True
+
+    def disconnect(self):
+        """
+            Closes the socket for good, without reconnecting.
+            """
+        with self.lock:
+            self.connected = False
+            self.closed = True
+            if self.conn is not None:
+                self.conn.disconnect()
+                self.conn = None
+
+    def _connection_closed_handler(self, msg):
+        """
+            Starts reconnecting when TWS closes the socket.
+            """
+        self._start_reconnect()
+
+    def _error_handler(self, msg):
+        """
+            Reacts to the TWS connectivity error codes.
+            """
+        code = getattr(msg, 'errorCode', None)
+        if code == NOT_CONNECTED:
+            self._start_reconnect()
+        elif code == CONNECTIVITY_RESTORED_DATA_LOST:
+            # TWS is back but the market data subscriptions are gone
+            self._start_reconnect(restore_only=True)
+
+    def _start_reconnect(self, restore_only=False):
+        """
+            Runs _reconnect in a background thread, once.
+
+            Parameters:
+            restore_only - Whether the socket is still open and only
+                           the state has to be restored.
+            """
+        with self.lock:
+            if self.reconnecting or self.closed:
+                return
+            self.reconnecting = True
+            if not restore_only:
+                self.connected = False
+        thread = threading.Thread(target=self._reconnect, args=(restore_only,))
+        thread.daemon = True
+        thread.start()
+
+    def _reconnect(self, restore_only=False):
+        """
+            Re-opens the socket with exponential backoff, then restores
+            the subscriptions and flushes the queued requests.
+            """
+        backoff = self.initial_backoff
+        while not restore_only:
+            with self.lock:
+                if self.closed:
+                    self.reconnecting = False
+                    return
+                old, self.conn = self.conn, None
+            try:
+                if old is not None:
+                    old.disconnect()
+            except Exception:
+                pass
+            try:
+                conn = self._open()
+            except Exception:
+                conn = None
+            if conn is not None:
+                with self.lock:
+                    if self.closed:
+                        conn.disconnect()
+                        self.reconnecting = False
+                        return
+                    self.conn = conn
+                    self.reconnections += 1
+                break
+            self.sleep(backoff)
+            backoff = min(backoff * 2.0, self.max_backoff)
+        self._restore_state()
+        with self.lock:
+            self.reconnecting = False
+
+    def _restore_state(self):
+        """
+            Re-requests market data and open orders, then sends the
+            requests queued while disconnected, at the pace of the
+            bucket. Runs without the lock, on the reconnecting thread;
+            requests keep being queued until the queue has been
+            flushed, so that they are sent in order.
+            """
+        with self.lock:
+            conn = self.conn
+            subscriptions = sorted(self.subscriptions.items())
+        for ticker_id, args in subscriptions:
+            self.bucket.acquire()
+            conn.reqMktData(ticker_id, *args)
+        self.bucket.acquire()
+        conn.reqOpenOrders()
+        while True:
+            with self.lock:
+                pending, self.pending = self.pending, []
+                if not pending:
+                    self.connected = True
+                    return
+            for queued, name, args in pending:
+                age = self.clock() - queued
+                expiry = self.order_expiry if name == 'placeOrder' else self.pending_expiry
+                if age > expiry:
+                    print "Dropped %s%r, queued %0.0fs ago" % (name, args, age)
+                    self._dropped(name, args)
+                    continue
+                self.bucket.acquire()
+                getattr(conn, name)(*args)
+
+    def _dropped(self, name, args):
+        """
+            Passes a request dropped unsent to the on_dropped handlers.
+            """
+        for handler in list(self.dropped_handlers):
+            try:
+                handler(name, args)
+            except Exception, e:
+                print "Error handling dropped %s: %s" % (name, e)
+
+    def _send(self, name, *args):
+        """
+            Sends a request at the pace of the bucket, or queues it
+            while disconnected.
+            """
+        if self.connected:
+            # Waited for outside the lock
+            self.bucket.acquire()
+        self._deliver(name, args)
+
+    def send_prepaid(self, name, *args):
+        """
+            Sends a request whose token the caller has already taken
+            from self.bucket, or queues it while disconnected.
+            """
+        self._deliver(name, args)
+
+    def _deliver(self, name, args):
+        """
+            Sends a request, or queues it while disconnected.
+            """
+        dropped = None
+        with self.lock:
+            if self.connected:
+                getattr(self.conn, name)(*args)
+                return
+            if len(self.pending) >= self.max_pending:
+                _, dropped, dropped_args = self.pending.pop(0)
+                print "Dropped %s%r, %d requests queued" % (dropped, dropped_args,
+                                                          len(self.pending))
+            self.pending.append((self.clock(), name, args))
+            if len(self.pending) % 100 == 0:
+                print "Not connected to TWS, %d requests queued" % len(self.pending)
+        if dropped is not None:
+            self._dropped(dropped, dropped_args)
+
+    def register(self, handler, *types):
+        """
+            Registers a message handler, kept across reconnections.
+            """
+        with self.lock:
+            self.handlers.append((handler, types))
+            if self.conn is not None:
+                self.conn.register(handler, *types)
+
+    def registerAll(self, handler):
+        """
+            Registers a handler for all messages, kept across
+            reconnections.
+            """
+        with self.lock:
+            self.all_handlers.append(handler)
+            if self.conn is not None:
+                self.conn.registerAll(handler)
+
+    def on_dropped(self, handler):
+        """
+            Calls handler(name, args) for every request dropped unsent,
+            e.g. so that the orders never placed are released.
+            """
+        with self.lock:
+            self.dropped_handlers.append(handler)
+
+    def reqMktData(self, ticker_id, contract, generic_ticks='', snapshot=False):
+        """
+            Subscribes to market data, restored after reconnections.
+            """
+        with self.lock:
+            if not snapshot:
+                self.subscriptions[ticker_id] = (contract, generic_ticks, snapshot)
+        self._send('reqMktData', ticker_id, contract, generic_ticks, snapshot)
+
+    def cancelMktData(self, ticker_id):
+        """
+            Cancels a market data subscription.
+            """
+        with self.lock:
+            self.subscriptions.pop(ticker_id, None)
+        self._send('cancelMktData', ticker_id)
+
+    def cancelOrder(self, order_id):
+        """
+            Cancels an order.
+            """
+        self._send('cancelOrder', order_id)
+
+    def __getattr__(self, name):
+        """
+            Passes any other IbPy request through to the socket.
+            """
+        if name.startswith('_') or name in ('conn', 'lock', 'bucket'):
+            raise AttributeError(name)
+        def request(*args):
+            self._send(name, *args)
+        return request
+
+
+class ConnectionManager(object):
+    """
+        Keeps one ManagedConnection per (host, port, client id), so
+        that the data handler and the execution handler of a process
+        share the same socket instead of opening one each.
+        """
+
+    def __init__(self, factory=None):
+        """
+            Parameters:
+            factory - Optional function (host, port, client_id) ->
+                      connection factory, used in place of IbPy.
+            """
+        self.factory = factory
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, client_id=0, host="localhost", port=7496, **kwargs):
+        """
+            Returns the ManagedConnection for client_id, creating it on
+            first use. If it cannot connect yet, it is returned all the
+            same and keeps reconnecting in the background, queueing the
+            requests meanwhile.
+            """
+        key = (host, port, client_id)
+        with self.lock:
+            conn = self.connections.get(key)
+            if conn is None:
+                factory = None
+                if self.factory is not None:
+                    factory = self.factory(host, port, client_id)
+                conn = ManagedConnection(host, port, client_id,
+                                         factory=factory, **kwargs)
+                self.connections[key] = conn
+        conn.connect()
+        return conn
+
+    def close_all(self):
+        """
+            Disconnects every managed connection.
+            """
+        with self.lock:
+            for conn in self.connections.values():
+                conn.disconnect()
+            self.connections = {}
+
+
+# The connection manager shared by the whole process
+manager = ConnectionManager()
+
+
+def get_connection(client_id=0, host="localhost", port=7496, **kwargs):
+    """
+        Returns the process-wide connection for client_id.
+        """
+    return manager.get(client_id, host, port, **kwargs)
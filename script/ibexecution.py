@@ -1,13 +1,25 @@
 import datetime
-import time
+import os, os.path
 import sys
-sys.path.append("C:\Users\Ruimin\Anaconda2\IBtrading\IbPy")
+import threading
+
+# IbPy is not installed as a package, point IBPY_PATH at its checkout
+IBPY_PATH = os.environ.get("IBPY_PATH", "C:\Users\Ruimin\Anaconda2\IBtrading\IbPy")
+if os.path.isdir(IBPY_PATH) and IBPY_PATH not in sys.path:
+    sys.path.append(IBPY_PATH)
+
 from ib.ext.Contract import Contract
 from ib.ext.Order import Order
-from ib.opt import ibConnection, message
+from ib.opt import message
 
-from event import FillEvent, OrderEvent
+from event import CancelEvent, FillEvent, OrderEvent
 from execution import ExecutionHandler
+from ibconnection import get_connection
+from throttle import OutboundScheduler
+
+
+# Order statuses of TWS for orders that will not be (further) filled
+CANCELLED_STATUSES = ("Cancelled", "ApiCancelled", "Inactive")
 
 
 class IBExecutionHandler(ExecutionHandler):
@@ -19,18 +31,39 @@ class IBExecutionHandler(ExecutionHandler):
     
     def __init__(self, events,
                  order_routing="SMART",
-                 currency="USD"):
+                 currency="USD",
+                 host="localhost", port=7496, client_id=0,
+                 journal=None):
         """
             Initialises the IBExecutionHandler instance.
+            
+            If an OrderJournal is given, every order, order status
+            and fill is journalled, and the order state and order ids
+            of a previous session are recovered from it.
             """
         self.events = events
         self.order_routing = order_routing
         self.currency = currency
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.journal = journal
         self.fill_dict = {}
+        # order_id and fill_dict are used by the scheduler thread,
+        # which places the orders, and the IbPy reader thread
+        self.lock = threading.RLock()
+        if self.journal is not None:
+            self.journal.recover_broker(self)
         
         self.tws_conn = self.create_tws_connection()
         self.order_id = self.create_initial_order_id()
         self.register_handlers()
+        
+        # Replaces the fixed one second sleep after each order. It
+        # shares the message budget of the connection, which paces
+        # its replays after a reconnection
+        self.scheduler = OutboundScheduler(self.place_order, self._send_message,
+                                           bucket=self.tws_conn.bucket)
 
     def _error_handler(self, msg):
         """
@@ -44,40 +77,87 @@ class IBExecutionHandler(ExecutionHandler):
         """
             Handles of server replies
             """
-        # Handle open order orderId processing
-        if msg.typeName == "openOrder" and \
-            msg.orderId == self.order_id and \
-            not self.fill_dict.has_key(msg.orderId):
-            self.create_fill_dict_entry(msg)
-            # Handle Fills
-        if msg.typeName == "orderStatus" and \
-            msg.status == "Filled" and \
-            self.fill_dict[msg.orderId]["filled"] == False:
-            self.create_fill(msg)
+        with self.lock:
+            # Handle open order orderId processing, including the
+            # orders re-sent by reqOpenOrders after a reconnection
+            if msg.typeName == "openOrder" and \
+                not self.fill_dict.has_key(msg.orderId):
+                self.create_fill_dict_entry(msg)
+            # Journal the broker acknowledgements
+            if msg.typeName == "orderStatus" and self.journal is not None:
+                self.journal.record_ack(msg.orderId, msg.status,
+                                        msg.filled, msg.avgFillPrice)
+                # Handle Fills, of the orders this handler knows
+            if msg.typeName == "orderStatus" and msg.status == "Filled":
+                fd = self.fill_dict.get(msg.orderId)
+                if fd is not None and fd["filled"] == False:
+                    self.create_fill(msg)
+            # Orders which will not be (further) filled: the shares
+            # filled before the cancel are a fill, and the risk stage
+            # releases the pending quantity of the rest
+            if msg.typeName == "orderStatus" and msg.status in CANCELLED_STATUSES:
+                fd = self.fill_dict.get(msg.orderId)
+                if fd is not None and fd["filled"] == False:
+                    if msg.filled > 0:
+                        self.create_fill(msg)
+                    fd["filled"] = True
+                    if msg.remaining > 0:
+                        self.events.put(CancelEvent(fd["symbol"], msg.remaining,
+                                                    fd["direction"], msg.status))
         print "Server Response: %s, %s\n" % (msg.typeName, msg)
 
 
+    def _dropped_handler(self, name, args):
+        """
+            Handles a request the connection dropped without sending
+            it: an order never placed is cancelled, so that the risk
+            stage releases its pending quantity.
+            """
+        if name != "placeOrder":
+            return
+        order_id, ib_order = args[0], args[2]
+        with self.lock:
+            fd = self.fill_dict.get(order_id)
+            if fd is None or fd["filled"] == True:
+                return
+            fd["filled"] = True
+            if self.journal is not None:
+                self.journal.record_ack(order_id, "Dropped")
+            self.events.put(CancelEvent(fd["symbol"], ib_order.m_totalQuantity,
+                                        fd["direction"], "Dropped"))
+
     def create_tws_connection(self):
         """
             Connect to the Trader Workstation (TWS) running on the
-            usual port of 7496, with a clientId of 10.
-            The clientId is chosen by us and we will need
-            separate IDs for both the execution connection and
-            market data connection, if the latter is used elsewhere.
+            usual port of 7496, with the clientId given at
+            initialisation.
+            The connection is the process-wide one for that clientId,
+            shared with the market data path, kept open for the whole
+            session and transparently re-established if TWS drops it.
             """
-        tws_conn = ibConnection()
-        tws_conn.connect()
-        return tws_conn
+        return get_connection(self.client_id, self.host, self.port)
 
     def create_initial_order_id(self):
         """
             Creates the initial order ID used for Interactive
             Brokers to keep track of submitted orders.
+            
+            Without a journal this is "1"; with one, it follows the
+            last journalled order. In both cases it is raised to the
+            nextValidId sent by TWS as soon as that arrives.
             """
-            # There is scope for more logic here, but we
-            # will use "1" as the default for now.
+        if self.journal is not None:
+            return self.journal.next_order_id()
         return 1
 
+
+    def _next_valid_id_handler(self, msg):
+        """
+            Moves the order ID past every ID TWS has already seen.
+            """
+        with self.lock:
+            self.order_id = max(self.order_id, msg.orderId)
+
     def register_handlers(self):
         """
             Register the error and server reply
@@ -90,6 +170,13 @@ class IBExecutionHandler(ExecutionHandler):
                 # Assign all of the server reply messages to the
                 # reply_handler function defined above
         self.tws_conn.registerAll(self._reply_handler)
+        
+        # Orders the connection could not send in time
+        self.tws_conn.on_dropped(self._dropped_handler)
+        
+        # Ask TWS for the next valid order ID
+        self.tws_conn.register(self._next_valid_id_handler, 'NextValidId')
+        self.tws_conn.reqIds(1)
 
 
     def create_contract(self, symbol, sec_type, exch, prim_exch, curr):
@@ -164,33 +251,36 @@ class IBExecutionHandler(ExecutionHandler):
                         exchange, filled, direction, fill_cost
                 )
                                         
+        fill.order_id = msg.orderId
+                                        
         # Make sure that multiple messages don't create
         # additional fills.
         self.fill_dict[msg.orderId]["filled"] = True
-                                            
-        # Place the fill event onto the event queue
-        self.events.put(fill_event)
+        if self.journal is None:
+            self.events.put(fill)
+            return
+        # Journal the fill and place it onto the event queue at once,
+        # so that a snapshot never sees the one without the other
+        with self.journal.lock:
+            self.journal.record_fill(msg.orderId, fill)
+            self.events.put(fill)
 
 
-    def execute_order(self, event):
+    def place_order(self, event):
         """
             Creates the necessary InteractiveBrokers order object
-            and submits it to IB via their API.
-        
-            The results are then queried in order to generate a
-            corresponding Fill object, which is placed back on
-            the event queue.
+            and submits it to IB via their API. Called by the
+            outbound scheduler when the rate limit allows it.
         
             Parameters:
             event - Contains an Event object with order information.
             """
-        if event.type == 'ORDER':
         # Prepare the parameters for the asset order
-            asset = event.symbol
-            asset_type = "STK"
-            order_type = event.order_type
-            quantity = event.quantity
-            direction = event.direction
+        asset = event.symbol
+        asset_type = "STK"
+        order_type = event.order_type
+        quantity = event.quantity
+        direction = event.direction
             
         # Create the Interactive Brokers contract via the
         # passed Order event
@@ -204,16 +294,67 @@ class IBExecutionHandler(ExecutionHandler):
         ib_order = self.create_order(
                                     order_type, quantity, direction
                                     )
+        
+        with self.lock:
+            # Take the order ID for this order, and increment it
+            # for the next one of this session
+            order_id = self.order_id
+            self.order_id += 1
+            
+            # Record the order before sending it, since its replies
+            # may arrive before the next order is placed
+            self.fill_dict[order_id] = {
+                "symbol": asset,
+                "exchange": self.order_routing,
+                "direction": direction,
+                "filled": False
+                }
                                                
-        # Use the connection to the send the order to IB
-        self.tws_conn.placeOrder(
-                                 self.order_id, ib_contract, ib_order
-                                )
-                                               
-        # NOTE: This following line is crucial.
-        # It ensures the order goes through!
-        time.sleep(1)
+            # Journal the order before it can reach the broker
+            if self.journal is not None:
+                self.journal.record_order(order_id, event)
                                                
-        # Increment the order ID for this session
-        self.order_id += 1
+        # Use the connection to the send the order to IB, the
+        # scheduler has taken its token from the shared bucket
+        self.tws_conn.send_prepaid(
+                                   'placeOrder', order_id, ib_contract, ib_order
+                                  )
+
 
+    def _send_message(self, name, args):
+        """
+            Sends any other scheduled request (e.g. cancelOrder).
+            """
+        self.tws_conn.send_prepaid(name, *args)
+
+
+    def execute_order(self, event):
+        """
+            Schedules an OrderEvent for submission to IB.
+        
+            Orders are sent by the outbound scheduler, which keeps
+            the message rate under the TWS limit. Orders of the same
+            bar are held until flush_orders() and netted per symbol.
+            The results are then queried in order to generate a
+            corresponding Fill object, which is placed back on
+            the event queue.
+        
+            Parameters:
+            event - Contains an Event object with order information.
+            """
+        if event.type == 'ORDER':
+            self.scheduler.submit_order(event)
+
+
+    def cancel_order(self, order_id):
+        """
+            Cancels an order, ahead of any queued new order.
+            """
+        self.scheduler.submit_cancel(order_id)
+
+
+    def flush_orders(self):
+        """
+            Releases the orders generated during the current bar.
+            """
+        self.scheduler.release()
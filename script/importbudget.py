@@ -0,0 +1,62 @@
+# importbudget.py
+
+# Checks that the backtest path imports within its time budget and
+# does not pull in any live trading module, e.g. after adding an
+# import to one of the modules main.py needs in every mode:
+#
+#     python importbudget.py
+#
+# Exits with status 1 if the check fails.
+
+import os, os.path
+import subprocess
+import sys
+
+# Modules main.py imports in every mode
+BACKTEST_MODULES = ["event", "data", "TechnicalStrategies",
+                    "PortfolioWithSimpleRM", "execution", "backtest",
+                    "checkpoint", "validation", "robustness"]
+# Modules main.py only imports in the Realtime and DataServer modes
+LIVE_MODULES = ["ib", "ibexecution", "ibconnection", "throttle",
+                "journal", "risk", "valueatrisk", "sharedbars", "live",
+                "pandas.io.data"]
+
+# Seconds allowed to import BACKTEST_MODULES in a fresh interpreter
+IMPORT_BUDGET = 1.0
+
+
+def measure_imports(modules, runs=5):
+    """
+        Imports modules in fresh interpreters.
+
+        Parameters:
+        modules - The names of the modules imported.
+        runs - Number of interpreters started.
+
+        Returns:
+        elapsed, loaded - The best import time in seconds and the
+        names of all the modules then in sys.modules.
+        """
+    code = ("import sys, time\n"
+            "start = time.time()\n"
+            "import %s\n"
+            "print time.time() - start\n"
+            "print ' '.join(m for m in sys.modules if sys.modules[m] is not None)\n"
+            % ", ".join(modules))
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=script_dir)
+        elapsed, loaded = output.splitlines()[-2:]
+        timings.append(float(elapsed))
+    return min(timings), loaded.split()
+
+
+if __name__ == "__main__":
+    elapsed, loaded = measure_imports(BACKTEST_MODULES)
+    live = [m for m in LIVE_MODULES if m in loaded]
+
+    print "Backtest import time: %0.3fs (budget %0.3fs)" % (elapsed, IMPORT_BUDGET)
+    print "Live modules imported: %s" % (", ".join(live) or "none")
+    if elapsed > IMPORT_BUDGET or live:
+        sys.exit(1)
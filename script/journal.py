@@ -0,0 +1,302 @@
+# journal.py
+
+import json
+import os, os.path
+import threading
+import time
+
+
+def _write_synced(path, text):
+    """
+        Writes text to path through a temporary file, fsynced before
+        it replaces the previous file.
+        """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+class OrderJournal(object):
+    """
+        An append-only write-ahead journal of the orders sent to the
+        broker, the broker's acknowledgements (order status messages)
+        and the fills, used to rebuild the execution handler and the
+        portfolio after a crash.
+
+        Records are appended as JSON lines and fsynced in batches,
+        every fsync_every records or fsync_interval seconds, whichever
+        comes first. Every snapshot_every records a snapshot of the
+        portfolio and execution state is written at the next safe
+        point (maybe_snapshot, called when the event queue is empty)
+        and the journal is truncated, which bounds the replay time.
+        """
+
+    def __init__(self, path, fsync_every=50, fsync_interval=1.0,
+                 snapshot_every=1000, clock=time.time):
+        """
+            Opens (or creates) the journal.
+
+            Parameters:
+            path - Path of the journal file. The snapshot is kept in
+                   path + '.snapshot'.
+            fsync_every - Records written between two fsyncs.
+            fsync_interval - Longest time in seconds between fsyncs.
+            snapshot_every - Records written between two snapshots.
+            clock - Function returning the current time in seconds.
+            """
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.clock = clock
+
+        self.portfolio = None
+        self.broker = None
+        # Orders are journalled from the scheduler thread, acks and
+        # fills from the IbPy reader thread
+        self.lock = threading.RLock()
+
+        self.snapshot, self.records = self._read()
+        self.seq = self.snapshot["seq"] if self.snapshot else 0
+        if self.records:
+            self.seq = self.records[-1]["seq"]
+        self.unsynced = 0
+        self.since_snapshot = len(self.records)
+        self.last_sync = self.clock()
+        self.file = open(self.path, 'ab')
+
+    def _read(self):
+        """
+            Reads the last snapshot and the journal records that follow
+            it. A torn last line from a crash mid-write is dropped.
+            """
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = json.load(f)
+        first_seq = snapshot["seq"] if snapshot else 0
+
+        records = []
+        if os.path.exists(self.path):
+            valid = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    valid += len(line)
+                    if record["seq"] > first_seq:
+                        records.append(record)
+            # Cut the torn line off, so that new records follow the
+            # last complete one
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid)
+        return snapshot, records
+
+    def attach(self, portfolio, broker):
+        """
+            Sets the portfolio and execution handler whose state is
+            snapshotted and recovered.
+            """
+        self.portfolio = portfolio
+        self.broker = broker
+
+    def record(self, kind, **data):
+        """
+            Appends a record to the journal, fsyncing the batch when it
+            is full or old enough.
+            """
+        with self.lock:
+            self.seq += 1
+            data["seq"] = self.seq
+            data["kind"] = kind
+            self.file.write(json.dumps(data, default=str) + '\n')
+            self.unsynced += 1
+            self.since_snapshot += 1
+            if self.unsynced >= self.fsync_every or \
+               self.clock() - self.last_sync >= self.fsync_interval:
+                self.sync()
+
+    def sync(self):
+        """
+            Flushes and fsyncs the records written so far.
+            """
+        with self.lock:
+            if self.unsynced > 0:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.unsynced = 0
+            self.last_sync = self.clock()
+
+    def record_order(self, order_id, event):
+        """
+            Records an OrderEvent sent to the broker under order_id.
+            """
+        self.record("order", order_id=order_id, symbol=event.symbol,
+                    order_type=event.order_type, quantity=event.quantity,
+                    direction=event.direction)
+
+    def record_ack(self, order_id, status, filled=0, avg_fill_price=0.0):
+        """
+            Records an order status message from the broker.
+            """
+        self.record("ack", order_id=order_id, status=status,
+                    filled=filled, avg_fill_price=avg_fill_price)
+
+    def record_fill(self, order_id, fill):
+        """
+            Records a FillEvent created for order_id.
+            """
+        self.record("fill", order_id=order_id, symbol=fill.symbol,
+                    exchange=fill.exchange, quantity=fill.quantity,
+                    direction=fill.direction, fill_cost=fill.fill_cost,
+                    commission=fill.commission,
+                    timeindex=fill.timeindex)
+
+    def record_valuation(self, fill):
+        """
+            Records the price at which the portfolio has valued a fill
+            (fill.valued_at), so that recovery values it identically.
+            """
+        if getattr(fill, "order_id", None) is not None:
+            self.record("valued", order_id=fill.order_id, price=fill.valued_at)
+
+    def maybe_snapshot(self):
+        """
+            Takes a snapshot if enough records were written since the
+            last one. Must be called from the thread applying the
+            events to the portfolio, between two events.
+            """
+        if self.since_snapshot >= self.snapshot_every:
+            self.take_snapshot()
+        else:
+            self.sync()
+
+    def take_snapshot(self):
+        """
+            Writes the portfolio and execution state and truncates the
+            journal. Replay skips records older than the snapshot, so a
+            crash between the two steps is harmless.
+
+            Fills are journalled and queued under the lock (see
+            IBExecutionHandler.create_fill), so with the queue of the
+            broker empty under the lock, every journalled fill has been
+            applied to the portfolio. Otherwise the snapshot is put off.
+
+            The order id and fill dictionary, which the IbPy reader
+            and scheduler threads update, are copied under the lock of
+            the broker, taken before the journal's as the broker does.
+
+            Returns:
+            True if the snapshot was taken.
+            """
+        broker_lock = getattr(self.broker, "lock", None)
+        if broker_lock is None:
+            return self._take_snapshot()
+        with broker_lock:
+            return self._take_snapshot()
+
+    def _take_snapshot(self):
+        with self.lock:
+            events = getattr(self.broker, "events", None)
+            if events is not None and not events.empty():
+                self.sync()
+                return False
+            state = {"seq": self.seq}
+            if self.portfolio is not None:
+                state["positions"] = self.portfolio.current_positions
+                state["holdings"] = self.portfolio.current_holdings
+            if self.broker is not None:
+                state["order_id"] = self.broker.order_id
+                state["fill_dict"] = dict((str(k), dict(v))
+                                          for k, v in self.broker.fill_dict.items())
+            text = json.dumps(state, default=str)
+            self.sync()
+            _write_synced(self.snapshot_path, text)
+            self.snapshot = json.loads(text)
+
+            self.file.close()
+            self.file = open(self.path, 'wb')
+            self.records = []
+            self.since_snapshot = 0
+            return True
+
+    def next_order_id(self):
+        """
+            Returns the first order id not used by any journalled order.
+            """
+        order_id = 1
+        if self.snapshot is not None:
+            order_id = self.snapshot.get("order_id", 1)
+        for record in self.records:
+            if record["kind"] == "order":
+                order_id = max(order_id, record["order_id"] + 1)
+        return order_id
+
+    def recover_broker(self, broker):
+        """
+            Rebuilds the fill dictionary of an execution handler from
+            the snapshot and the journal.
+            """
+        if self.snapshot is not None:
+            for k, v in self.snapshot.get("fill_dict", {}).items():
+                broker.fill_dict[int(k)] = v
+        for record in self.records:
+            if record["kind"] == "order":
+                broker.fill_dict[record["order_id"]] = {
+                    "symbol": record["symbol"],
+                    "exchange": broker.order_routing,
+                    "direction": record["direction"],
+                    "filled": False
+                    }
+            elif record["kind"] == "fill" and record["order_id"] in broker.fill_dict:
+                broker.fill_dict[record["order_id"]]["filled"] = True
+
+    def recover_portfolio(self, portfolio):
+        """
+            Restores the current positions and holdings of a portfolio
+            from the snapshot, then applies the journalled fills.
+
+            A fill is valued at the price the portfolio valued it at
+            before the crash (its "valued" record). A fill it had not
+            applied yet is valued as the portfolio would: at the close
+            of the latest bar, or the fill price if there is no bar.
+            """
+        valued = dict((record["order_id"], record["price"])
+                      for record in self.records if record["kind"] == "valued")
+        if self.snapshot is not None and "positions" in self.snapshot:
+            portfolio.current_positions.update(self.snapshot["positions"])
+            portfolio.dirty_symbols.update(self.snapshot["positions"])
+            portfolio.current_holdings.update(self.snapshot["holdings"])
+        for record in self.records:
+            if record["kind"] != "fill":
+                continue
+            fill_dir = 1 if record["direction"] == 'BUY' else -1
+            price = valued.get(record["order_id"])
+            if price is None:
+                latest = portfolio.bars.get_latest_bars(record["symbol"])
+                price = latest[-1][5] if latest else record["fill_cost"]
+            cost = fill_dir * price * record["quantity"]
+            portfolio.current_positions[record["symbol"]] = \
+                portfolio.current_positions.get(record["symbol"], 0) + fill_dir * record["quantity"]
+            portfolio.dirty_symbols.add(record["symbol"])
+            portfolio.current_holdings[record["symbol"]] = \
+                portfolio.current_holdings.get(record["symbol"], 0.0) + cost
+            portfolio.current_holdings['commission'] += record["commission"]
+            portfolio.current_holdings['cash'] -= (cost + record["commission"])
+            portfolio.current_holdings['total'] -= record["commission"]
+
+    def close(self):
+        """
+            Fsyncs and closes the journal.
+            """
+        with self.lock:
+            self.sync()
+            self.file.close()
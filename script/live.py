@@ -0,0 +1,290 @@
+# live.py
+
+import heapq
+import threading
+import time
+import traceback
+import Queue
+
+from event import Event
+
+
+class CallbackEvent(Event):
+    """
+        Carries a function to call on the thread of the live loop,
+        see LiveRunner.call_soon_threadsafe.
+        """
+
+    def __init__(self, callback):
+        self.type = 'CALLBACK'
+        self.callback = callback
+
+
+class LiveRunner(object):
+    """
+        Runs live trading as a single event loop on one thread.
+
+        Market data, broker callbacks and timers all go through the
+        event queue: the loop blocks on the queue until the next timer
+        is due, so an event is handled as soon as it arrives instead of
+        at the next bar. This includes a fill put by the IbPy reader
+        thread. Functions of other threads are bridged in with
+        call_soon_threadsafe, and every strategy, portfolio and risk
+        call is made from the loop thread.
+
+        A repeating timer updates the bars at every bar close, aligned
+        on multiples of bar_interval. With a data handler that has
+        fetch_bars and push_bars (e.g. the download of
+        RealTimeDataHandler), the fetch runs on a worker thread, so
+        that fills keep being handled meanwhile, and the bars are
+        pushed on the loop, which then gets the MarketEvent. A data
+        handler notified of its bars (with wait_bars, bars_pending and
+        push_bars, e.g. sharedbars.SharedMemoryDataHandler) is watched
+        on a worker thread instead of the timer, which wakes the loop
+        as soon as a bar is published.
+
+        Once the events of a burst are handled, the orders of the bar
+        are flushed to the broker and the journal may snapshot, as no
+        fill is pending. Then, if the data handler has more bars
+        pending, the next one is pushed, so that the bars are handled
+        one burst each until the loop has caught up.
+
+        An exception raised while handling an event or running a
+        timer is printed and the loop goes on with the next one.
+        """
+
+    def __init__(self, events, bars, strategy, port, broker, risk=None,
+                 journal=None, bar_interval=60.0, clock=time.time,
+                 verbose=False):
+        """
+            Parameters:
+            events - The Event Queue, shared with the broker's threads.
+            bars - The DataHandler object that provides bar information.
+            strategy - The Strategy object generating signals.
+            port - The Portfolio object.
+            broker - The ExecutionHandler object.
+            risk - Optional pre-trade risk stage.
+            journal - Optional OrderJournal snapshotted between bursts.
+            bar_interval - Seconds between two bars.
+            clock - Function returning the current time in seconds.
+            verbose - Whether to print every handled event.
+            """
+        self.events = events
+        self.bars = bars
+        self.strategy = strategy
+        self.port = port
+        self.broker = broker
+        self.risk = risk
+        self.journal = journal
+        self.bar_interval = bar_interval
+        self.clock = clock
+        self.verbose = verbose
+
+        self.timers = []
+        self.timer_seq = 0
+        self.market_callbacks = []
+        self.running = False
+        self.fetching = False
+        self.errors = 0
+
+    def call_later(self, delay, callback, interval=None):
+        """
+            Calls callback() on the loop after delay seconds, then
+            every interval seconds if interval is given.
+            """
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (self.clock() + delay, self.timer_seq,
+                                     interval, callback))
+
+    def call_soon_threadsafe(self, callback):
+        """
+            Calls callback() on the loop as soon as possible. Safe to
+            call from any thread.
+            """
+        self.events.put(CallbackEvent(callback))
+
+    def on_market(self, callback):
+        """
+            Calls callback(bars) on the loop after every MarketEvent,
+            e.g. to update a VaR engine.
+            """
+        self.market_callbacks.append(callback)
+
+    def stop(self):
+        """
+            Stops the loop after the current event.
+            """
+        self.running = False
+
+    def _next_bar_delay(self):
+        now = self.clock()
+        return self.bar_interval - now % self.bar_interval
+
+    def _run_timers(self):
+        """
+            Runs the timers that are due and returns the seconds until
+            the next one, None if there is none.
+            """
+        while self.timers:
+            when, seq, interval, callback = self.timers[0]
+            now = self.clock()
+            if when > now:
+                return when - now
+            heapq.heappop(self.timers)
+            if interval is not None:
+                # Rescheduled from its due time, without drift, but
+                # skipping the periods missed
+                next_when = when + interval
+                if next_when <= now:
+                    next_when = now + interval - (now - when) % interval
+                heapq.heappush(self.timers, (next_when, seq, interval, callback))
+            self._call(callback, "timer")
+        return None
+
+    def _call(self, callback, what, *args):
+        """
+            Calls callback(*args), printing instead of raising any
+            exception, so that the loop survives it.
+            """
+        try:
+            callback(*args)
+        except Exception:
+            self.errors += 1
+            print "Error in %s:" % what
+            traceback.print_exc()
+
+    def _update_bars(self):
+        if not hasattr(self.bars, "fetch_bars"):
+            self.bars.update_bars()
+            return
+        if self.fetching:
+            print "Bar skipped: the previous bars are still being fetched"
+            return
+        self.fetching = True
+        fetcher = threading.Thread(target=self._fetch_bars)
+        fetcher.daemon = True
+        fetcher.start()
+
+    def _fetch_bars(self):
+        """
+            Fetches the bars on the worker thread and hands them to
+            the loop.
+            """
+        try:
+            new_bars = self.bars.fetch_bars()
+        except Exception:
+            print "Error fetching the bars:"
+            traceback.print_exc()
+            self.call_soon_threadsafe(self._fetch_failed)
+        else:
+            self.call_soon_threadsafe(lambda: self._push_bars(new_bars))
+
+    def _fetch_failed(self):
+        self.errors += 1
+        self.fetching = False
+
+    def _push_bars(self, new_bars):
+        self.fetching = False
+        self.bars.push_bars(new_bars)
+
+    def _watch_bars(self):
+        """
+            Waits for the notifications of the data handler on the
+            worker thread and wakes the loop when bars are pending,
+            which pushes them at the end of the burst.
+            """
+        while self.running:
+            try:
+                self.bars.wait_bars()
+            except Exception:
+                print "Error waiting for the bars:"
+                traceback.print_exc()
+                time.sleep(1.0)
+                continue
+            if self.bars.bars_pending():
+                self.call_soon_threadsafe(lambda: None)
+
+    def handle_event(self, event):
+        """
+            Routes an event as run_backtest does.
+            """
+        if event.type == 'MARKET':
+            self.strategy.calculate_signals(event)
+            self.port.update_timeindex(event)
+            if self.risk is not None:
+                self.risk.update_timeindex(event)
+            for callback in self.market_callbacks:
+                self._call(callback, "market callback", self.bars)
+            if self.verbose:
+                print "Market Event"
+
+        elif event.type == 'SIGNAL':
+            self.port.update_signal(event)
+            if self.verbose:
+                print "Portfolio Event"
+
+        elif event.type == 'ORDER':
+            if self.risk is not None and not self.risk.approve_order(event):
+                print "Order Rejected: %s" % self.risk.rejections[-1][1]
+                return
+            self.broker.execute_order(event)
+            if self.verbose:
+                print "Order Event"
+
+        elif event.type == 'FILL':
+            self.port.update_fill(event)
+            if self.journal is not None:
+                self.journal.record_valuation(event)
+            if self.risk is not None:
+                self.risk.update_fill(event)
+            if self.verbose:
+                print "Order Done"
+
+        elif event.type == 'CANCEL':
+            if self.risk is not None:
+                self.risk.update_cancel(event)
+            print "Order %s: %s %s %s" % (event.status, event.direction,
+                                          event.quantity, event.symbol)
+
+        elif event.type == 'CALLBACK':
+            event.callback()
+
+    def _end_of_burst(self):
+        """
+            Called when the queue has been drained.
+            """
+        if hasattr(self.broker, "flush_orders"):
+            # Send the orders of this bar, netted per symbol
+            self.broker.flush_orders()
+        if self.journal is not None:
+            # No fill is waiting in the queue, so the state can be snapshotted
+            self.journal.maybe_snapshot()
+        if hasattr(self.bars, "wait_bars") and self.bars.bars_pending():
+            # Next bar, once the events of this one are all handled
+            self.bars.push_bars()
+
+    def run(self):
+        """
+            Runs the loop until stop() is called.
+            """
+        self.running = True
+        if hasattr(self.bars, "wait_bars"):
+            watcher = threading.Thread(target=self._watch_bars)
+            watcher.daemon = True
+            watcher.start()
+        else:
+            self.call_later(self._next_bar_delay(), self._update_bars,
+                            self.bar_interval)
+        while self.running:
+            timeout = self._run_timers()
+            try:
+                if timeout is None:
+                    event = self.events.get(True)
+                else:
+                    event = self.events.get(True, timeout)
+            except Queue.Empty:
+                continue
+            if event is not None:
+                self._call(self.handle_event, "%s event" % event.type, event)
+            if self.events.empty():
+                self._call(self._end_of_burst, "end of burst")
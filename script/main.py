@@ -1,12 +1,28 @@
 # coding: utf-8
 
-import time, Queue
-import event, data
-import strategy, TechnicalStrategies
-import portfolio, PortfolioWithSimpleRM
-import execution, ibexecution
+import sys, time, Queue
 
-mode = "Backtesting"
+# Modules needed by every mode. The live trading modules (IbPy, the
+# journal, the risk stage) are only imported in the Realtime branch,
+# so that backtests and sweep workers start quickly; importbudget.py
+# checks it.
+import event, data
+import TechnicalStrategies
+import PortfolioWithSimpleRM
+import execution
+import backtest
+from checkpoint import Checkpointer
+from validation import DataValidator
+import robustness
+
+# Ring buffer published by the DataServer mode for the Realtime processes
+SHARED_BARS_PATH = "/dev/shm/IBtrading.bars"
+
+# "Backtesting", "Append", "Realtime" or "DataServer", from the command line
+mode = sys.argv[1] if len(sys.argv) > 1 else "Backtesting"
+# Bars of the Realtime mode: "direct" polls the feed in this process,
+# "shared" reads those published by a running DataServer process
+feed = sys.argv[2] if len(sys.argv) > 2 else "direct"
 
 if mode == "Backtesting":
     ##-------------Initialization-------------------------------------------
@@ -16,8 +32,11 @@ if mode == "Backtesting":
     # You need to change this to your directory
     rootpath = "C:/Users/Ruimin/Anaconda2/IBtrading/"
     symbol_list = ["chart"]
-    # (self, events, csv_dir, symbol_list)
-    bars = data.HistoricCSVDataHandler(events, rootpath, symbol_list) 
+    # (self, events, csv_dir, symbol_list, validator=None)
+    validator = DataValidator()
+    bars = data.HistoricCSVDataHandler(events, rootpath, symbol_list, validator)
+    for issue in validator.summary():
+        print "Data issue: %s %s" % issue
 
     strategy = TechnicalStrategies.Mean_Reversion(bars, events) #(self, bars, events)
 
@@ -26,50 +45,65 @@ if mode == "Backtesting":
 
     broker = execution.SimulatedExecutionHandler(events)
 
+    # Resume from the latest checkpoint of an interrupted run, if any.
+    # The state after the last bar is kept in backtest.state, for the
+    # Append mode.
+    checkpointer = Checkpointer("backtest.checkpoint", every=1000,
+                                end_path="backtest.state")
+    if checkpointer.restore(bars, strategy, port, broker):
+        print "Resuming from bar %d" % bars.bar_index
+
     ##--------------Start backtesting-----------------------------------------
-    while True:
-        # Update the bars (specific backtest code, as opposed to live trading)
-        if bars.continue_backtest == True:
-            bars.update_bars()
-        else:
-            break
-
-        # Handle the events
-        while True:
-            try:
-                event = events.get(False)
-            except Queue.Empty:
-                break
-            else:
-                if event is not None:
-                    if event.type == 'MARKET':
-                        strategy.calculate_signals(event)
-                        print "Market Event"
-                        port.update_timeindex(event)
-                        print "Portfolio Update"
-
-                    elif event.type == 'SIGNAL':
-                        port.update_signal(event)
-                        print "Portfolio Event"
-
-                    elif event.type == 'ORDER':
-                        broker.execute_order(event)
-                        print "Order Event"
-                        #time.sleep(3) # just to make sure the order could be filled by the broker
-                        
-                    elif event.type == 'FILL':
-                        port.update_fill(event)
-                        print "Order Done"
-                
-        # 0.1-Second heartbeat, accelerate backtesting
-        time.sleep(0.1)
+    # 0.1-Second heartbeat, accelerate backtesting
+    backtest.run_backtest(events, bars, strategy, port, broker,
+                          heartbeat=0.1, verbose=True,
+                          checkpoint=checkpointer)
+    checkpointer.clear()
         
     # performace evaluation
     port.create_equity_curve_dataframe()
     performace_stats = port.output_summary_stats()
     print performace_stats
+
+    # Bootstrap confidence intervals of the bar and trade returns
+    trades = robustness.trade_returns(port.all_positions,
+                                      port.all_holdings.field('total'))
+    print robustness.output_robustness_stats(port.equity_curve, trades)
     
+elif mode == "Append":
+    # Extends the last Backtesting run with the bars appended to the
+    # CSV files since, starting from its saved end state
+    events = Queue.Queue()
+    
+    # You need to change this to your directory
+    rootpath = "C:/Users/Ruimin/Anaconda2/IBtrading/"
+    symbol_list = ["chart"]
+    # The same validation as the Backtesting run, so that the bars
+    # replayed from its end state are repaired identically
+    validator = DataValidator()
+    bars = data.HistoricCSVDataHandler(events, rootpath, symbol_list, validator)
+    strategy = TechnicalStrategies.Mean_Reversion(bars, events)
+    port = PortfolioWithSimpleRM.SimplePortfolio(bars, events, "12-5-2014", 10000000)
+    broker = execution.SimulatedExecutionHandler(events)
+
+    checkpointer = Checkpointer("backtest.checkpoint", every=1000,
+                                end_path="backtest.state")
+    new_bars = backtest.extend_backtest(checkpointer, events, bars,
+                                        strategy, port, broker)
+    checkpointer.clear()
+    print "Replayed %d new bars" % new_bars
+
+    # performace evaluation
+    performace_stats = port.output_summary_stats()
+    print performace_stats
+
 elif mode == "Realtime":
+    import ibexecution
+    from journal import OrderJournal
+    from risk import PreTradeRiskManager
+    from valueatrisk import VaREngine
+    from live import LiveRunner
+
     # Must Run this while the market is not closed otherwise there will be a 0/0 problem, trying to fix this
     ##-------------Initialization-------------------------------------------
     # Declare the components with respective parameters
@@ -77,57 +111,70 @@ elif mode == "Realtime":
     
     # You need to change this to your directory
     symbol_list = ["SPY"]
-    # (self, events, csv_dir, symbol_list)
-    bars = data.RealTimeDataHandler(events, symbol_list)
+    if feed == "shared":
+        # Shares the feed and history of the DataServer process
+        from sharedbars import SharedMemoryDataHandler
+        bars = SharedMemoryDataHandler(events, SHARED_BARS_PATH, symbol_list)
+    elif feed == "direct":
+        # (self, events, csv_dir, symbol_list)
+        bars = data.RealTimeDataHandler(events, symbol_list)
+    else:
+        raise ValueError("Unknown feed %s, use direct or shared" % feed)
     
     strategy = TechnicalStrategies.Mean_Reversion(bars, events) #(self, bars, events)
     
     # (self, bars, events, start_date, initial_capital=100000.0)
     port = PortfolioWithSimpleRM.SimplePortfolio(bars, events, "12-5-2014", 10000000)
     
+    # Orders, acknowledgements and fills are journalled, so that a
+    # restart recovers the positions and the order IDs
+    journal = OrderJournal("orders.journal")
+
     #broker = execution.SimulatedExecutionHandler(events)
-    broker = ibexecution.IBExecutionHandler(events)
+    broker = ibexecution.IBExecutionHandler(events, journal=journal)
+    journal.recover_portfolio(port)
+    journal.attach(port, broker)
+
+    # Pre-trade checks between the portfolio and the broker
+    risk = PreTradeRiskManager(bars, max_gross_exposure=0.7*10000000,
+                               max_net_exposure=0.7*10000000,
+                               max_order_notional=0.4*10000000,
+                               price_band=0.05, max_orders_per_minute=30,
+                               clock=time.time)
+    risk.load_positions(port.current_positions)
+
+    # Value at Risk and Expected Shortfall of the book, over the
+    # returns of the last 500 bars
+    var_engine = VaREngine(symbol_list=symbol_list, window=500)
     
     ##--------------Start RealTime-----------------------------------------
-    while True:
-        # Update the bars (specific backtest code, as opposed to live trading)
-        bars.update_bars()
-    
-        # Handle the events
-        while True:
-            try:
-                event = events.get(False)
-            except Queue.Empty:
-                break
-            else:
-                if event is not None:
-                    if event.type == 'MARKET':
-                        strategy.calculate_signals(event)
-                        print "Market Event"
-                        port.update_timeindex(event)
-                        print "Portfolio Update"
-                    
-                    elif event.type == 'SIGNAL':
-                        port.update_signal(event)
-                        print "Portfolio Event"
-                    
-                    elif event.type == 'ORDER':
-                        broker.execute_order(event)
-                        print "Order Event"
-                    #time.sleep(3) # just to make sure the order could be filled by the broker
-                    
-                    elif event.type == 'FILL':
-                        port.update_fill(event)
-                        print "Order Done"
-
-        # 0.1-Second heartbeat, accelerate backtesting
-        time.sleep(60)
+    # One event loop: bars are pulled at every minute close, fills from
+    # the IbPy thread are handled as soon as they arrive
+    runner = LiveRunner(events, bars, strategy, port, broker, risk=risk,
+                        journal=journal, bar_interval=60, verbose=True)
+    runner.on_market(var_engine.update)
+
+    def print_stats():
+        # The statistics are maintained bar by bar, so they are
+        # available although this loop never ends
+        print port.analytics.get_stats()
+        print var_engine.get_stats(port)
+    runner.call_later(60, print_stats, 60)
+
+    runner.run()
 
     # performace evaluation
     port.create_equity_curve_dataframe()
     performace_stats = port.output_summary_stats()
     print performace_stats
 
+elif mode == "DataServer":
+    # Owns the feed and publishes its bars to the Realtime processes
+    # of this machine, see sharedbars.SharedBarServer
+    from sharedbars import SharedBarServer
 
-
-
+    events = Queue.Queue()
+    symbol_list = ["SPY"]
+    bars = data.RealTimeDataHandler(events, symbol_list)
+    server = SharedBarServer(SHARED_BARS_PATH, symbol_list, capacity=4096)
+    server.serve(bars, heartbeat=60)
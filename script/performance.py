@@ -1,5 +1,9 @@
 # performance.py
 
+import copy
+from collections import deque
+from math import sqrt
+
 import numpy as np
 import pandas as pd
 
@@ -44,4 +48,329 @@ def create_drawdowns(equity_curve):
         hwm.append(cur_hwm)
         drawdown[t]= hwm[t] - equity_curve[t]
         duration[t]= 0 if drawdown[t] == 0 else duration[t-1] + 1
-    return drawdown.max(), duration.max()
\ No newline at end of file
+    return drawdown.max(), duration.max()
+
+
+class StreamingPerformance(object):
+    """
+        Maintains performance statistics incrementally, one bar at a
+        time, so that they can be queried at any point of a run (in
+        particular in live trading, where the run never ends) without
+        building the equity curve DataFrame.
+
+        Every update costs O(1): the return moments are kept as running
+        sums (Welford's algorithm for the full history and a running
+        sum / sum of squares over a ring buffer for the rolling window).
+        The window sums are recomputed from the ring buffer every
+        `window` bars, so that rounding errors do not accumulate over
+        a long run.
+
+        The drawdown has the definitions of create_drawdowns and
+        EquityCurve: the fall of the total from its highest value, as
+        a fraction of the initial capital, so that the same curve
+        reports the same Max Drawdown in live trading and backtests.
+        """
+
+    def __init__(self, initial_capital, window=252, periods=252):
+        """
+            Initialises the statistics.
+
+            Parameters:
+            initial_capital - The starting capital of the portfolio.
+            window - Number of bars in the rolling Sharpe window.
+            periods - Daily (252), Hourly (252*6.5), Minutely(252*6.5*60) etc.
+            """
+        self.initial_capital = float(initial_capital)
+        self.window = window
+        self.periods = periods
+
+        self.last_total = self.initial_capital
+        self.bars = 0
+
+        # Full history return moments
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.downside_sq = 0.0
+
+        # Rolling window return moments
+        self.window_returns = deque()
+        self.window_sum = 0.0
+        self.window_sq = 0.0
+
+        # Drawdown, with the same definitions as create_drawdowns
+        self.hwm = 0.0
+        self.max_drawdown = 0.0
+        self.duration = 0
+        self.max_duration = 0
+
+        # Turnover and exposure
+        self.traded_notional = 0.0
+        self.total_sum = 0.0
+        self.gross_exposure = 0.0
+        self.net_exposure = 0.0
+
+    def update_bar(self, total, gross=0.0, net=0.0):
+        """
+            Adds the portfolio value at the close of a new bar.
+
+            Parameters:
+            total - The total portfolio value.
+            gross - The sum of the absolute market values of all positions.
+            net - The sum of the market values of all positions.
+            """
+        ret = total / self.last_total - 1.0 if self.last_total else 0.0
+        self.last_total = total
+        self.bars += 1
+
+        delta = ret - self.mean
+        self.mean += delta / self.bars
+        self.m2 += delta * (ret - self.mean)
+        if ret < 0.0:
+            self.downside_sq += ret * ret
+
+        self.window_returns.append(ret)
+        self.window_sum += ret
+        self.window_sq += ret * ret
+        if len(self.window_returns) > self.window:
+            old = self.window_returns.popleft()
+            self.window_sum -= old
+            self.window_sq -= old * old
+        if self.bars % self.window == 0:
+            self.window_sum = sum(self.window_returns)
+            self.window_sq = sum(r * r for r in self.window_returns)
+
+        if total >= self.hwm:
+            self.hwm = total
+            self.duration = 0
+        else:
+            self.duration += 1
+            self.max_duration = max(self.max_duration, self.duration)
+        self.max_drawdown = max(self.max_drawdown,
+                                (self.hwm - total) / self.initial_capital)
+
+        self.total_sum += total
+        if total:
+            self.gross_exposure = gross / total
+            self.net_exposure = net / total
+
+    def update_fill(self, notional):
+        """
+            Adds the absolute dollar value of a fill to the turnover.
+            """
+        self.traded_notional += abs(notional)
+
+    def total_return(self):
+        """
+            Total return since the start of the run.
+            """
+        return self.last_total / self.initial_capital - 1.0
+
+    def sharpe_ratio(self):
+        """
+            Sharpe ratio of all returns so far.
+            """
+        if self.bars < 2 or self.m2 <= 0.0:
+            return float('nan')
+        return sqrt(self.periods) * self.mean / sqrt(self.m2 / self.bars)
+
+    def sortino_ratio(self):
+        """
+            Sortino ratio, using the downside deviation of all returns so far.
+            """
+        if self.bars < 2 or self.downside_sq <= 0.0:
+            return float('nan')
+        return sqrt(self.periods) * self.mean / sqrt(self.downside_sq / self.bars)
+
+    def rolling_sharpe_ratio(self):
+        """
+            Sharpe ratio of the returns in the rolling window.
+            """
+        n = len(self.window_returns)
+        if n < 2:
+            return float('nan')
+        mean = self.window_sum / n
+        var = self.window_sq / n - mean * mean
+        if var <= 0.0:
+            return float('nan')
+        return sqrt(self.periods) * mean / sqrt(var)
+
+    def calmar_ratio(self):
+        """
+            Annualised return divided by the maximum drawdown.
+            """
+        if self.bars == 0 or self.max_drawdown == 0.0 or self.last_total <= 0.0:
+            return float('nan')
+        growth = self.last_total / self.initial_capital
+        annual_return = growth ** (float(self.periods) / self.bars) - 1.0
+        return annual_return / self.max_drawdown
+
+    def turnover(self):
+        """
+            Traded notional divided by the average portfolio value.
+            """
+        if self.bars == 0:
+            return 0.0
+        return self.traded_notional / (self.total_sum / self.bars)
+
+    def get_stats(self):
+        """
+            Creates a list of the current statistics, in the same form
+            as Portfolio.output_summary_stats.
+            """
+        stats = [("Total Return", "%0.2f%%" % (self.total_return() * 100.0)),
+                 ("Sharpe Ratio", "%0.2f" % self.sharpe_ratio()),
+                 ("Rolling Sharpe Ratio", "%0.2f" % self.rolling_sharpe_ratio()),
+                 ("Sortino Ratio", "%0.2f" % self.sortino_ratio()),
+                 ("Calmar Ratio", "%0.2f" % self.calmar_ratio()),
+                 ("Max Drawdown", "%0.2f%%" % (self.max_drawdown * 100.0)),
+                 ("Drawdown Duration", "%d" % self.max_duration),
+                 ("Turnover", "%0.2f" % self.turnover()),
+                 ("Gross Exposure", "%0.2f%%" % (self.gross_exposure * 100.0)),
+                 ("Net Exposure", "%0.2f%%" % (self.net_exposure * 100.0))]
+        return stats
+
+
+class EquityCurve(object):
+    """
+        The equity curve of a portfolio, built in place bar by bar.
+
+        The totals, returns and cumulative equity are stored in one
+        growable float array (doubled when full), and the drawdown is
+        tracked as the bars arrive, so the summary statistics are
+        available at any point of a run. The equity curve DataFrame is
+        an optional view on the array, not a second copy of the
+        history.
+        """
+
+    COLUMNS = ['total', 'returns', 'equity_curve']
+
+    def __init__(self, initial_capital, start_date=None, capacity=1024):
+        """
+            Initialises the curve with the starting capital as its
+            first entry, whose return is undefined (NaN), as with
+            pct_change.
+
+            Parameters:
+            initial_capital - The starting capital of the portfolio.
+            start_date - The datetime of the first entry.
+            capacity - Number of bars allocated up front.
+            """
+        self.values = np.empty((max(capacity, 1), len(self.COLUMNS)))
+        self.datetimes = []
+        self.size = 0
+        self.equity = 1.0
+
+        # Drawdown, with the same definitions as create_drawdowns
+        self.hwm = 0.0
+        self.drawdown = 0.0
+        self.duration = 0
+        self.max_drawdown = 0.0
+        self.max_duration = 0
+
+        self.append(start_date, initial_capital)
+
+    def append(self, dt, total):
+        """
+            Adds the portfolio total at the close of a new bar and
+            updates its return, equity and drawdown.
+            """
+        if self.size == len(self.values):
+            values = np.empty((2 * len(self.values), len(self.COLUMNS)))
+            values[:self.size] = self.values
+            self.values = values
+
+        if self.size == 0:
+            ret = equity = np.nan
+        else:
+            last = self.values[self.size - 1, 0]
+            ret = total / last - 1.0 if last else np.nan
+            if ret == ret:
+                self.equity *= 1.0 + ret
+            equity = self.equity
+
+            self.hwm = max(self.hwm, equity)
+            self.drawdown = self.hwm - equity
+            self.duration = 0 if self.drawdown == 0 else self.duration + 1
+            self.max_drawdown = max(self.max_drawdown, self.drawdown)
+            self.max_duration = max(self.max_duration, self.duration)
+
+        self.values[self.size] = (total, ret, equity)
+        self.datetimes.append(dt)
+        self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def rows_since(self, n):
+        """
+            Returns the entries from entry n on, in a picklable form
+            for extend_rows, e.g. to checkpoint only the entries
+            appended since the last checkpoint.
+            """
+        return {'values': self.values[n:self.size].copy(),
+                'datetimes': self.datetimes[n:]}
+
+    def extend_rows(self, rows):
+        """
+            Appends the entries returned by rows_since, as they are:
+            the drawdown is that of the curve they were taken from.
+            """
+        n = len(rows['values'])
+        if self.size + n > len(self.values):
+            values = np.empty((max(self.size + n, 2 * len(self.values)),
+                               len(self.COLUMNS)))
+            values[:self.size] = self.values[:self.size]
+            self.values = values
+        self.values[self.size:self.size + n] = rows['values']
+        self.datetimes.extend(rows['datetimes'])
+        self.size += n
+
+    def without_rows(self):
+        """
+            Returns a copy of the curve, with its equity and drawdown,
+            but without its entries, which extend_rows fills again.
+            """
+        curve = copy.copy(self)
+        curve.values = np.empty((1, len(self.COLUMNS)))
+        curve.datetimes = []
+        curve.size = 0
+        return curve
+
+    def totals(self):
+        """
+            Returns a view on the totals so far.
+            """
+        return self.values[:self.size, 0]
+
+    def returns(self):
+        """
+            Returns a view on the returns so far, the first one NaN.
+            """
+        return self.values[:self.size, 1]
+
+    def to_dataframe(self):
+        """
+            Wraps the curve in a DataFrame with total, returns and
+            equity_curve columns indexed by datetime. The DataFrame
+            shares the memory of the curve and is only valid until
+            the next append.
+            """
+        curve = pd.DataFrame(self.values[:self.size], columns=self.COLUMNS,
+                             index=pd.Index(self.datetimes, name='datetime'),
+                             copy=False)
+        return curve
+
+    def get_stats(self, periods=252):
+        """
+            Creates the list of summary statistics of
+            Portfolio.output_summary_stats from the curve so far.
+            """
+        total_return = self.equity if self.size > 1 else np.nan
+        sharpe_ratio = create_sharpe_ratio(self.values[1:self.size, 1], periods) \
+            if self.size > 2 else np.nan
+
+        stats = [("Total Return", "%0.2f%%" % ((total_return - 1.0) * 100.0)),
+                 ("Sharpe Ratio", "%0.2f" % sharpe_ratio),
+                 ("Max Drawdown", "%0.2f%%" % (self.max_drawdown * 100.0)),
+                 ("Drawdown Duration", "%d" % self.max_duration)]
+        return stats
@@ -0,0 +1,109 @@
+# ratelimit.py
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+        A thread-safe token bucket rate limiter.
+
+        Tokens are added continuously at `rate` per second up to
+        `capacity`. Every request consumes tokens, so at most
+        capacity + rate * T requests can go through in any window of
+        T seconds, and bursts are limited to capacity.
+        """
+
+    def __init__(self, rate, capacity, clock=time.time, sleep=time.sleep):
+        """
+            Initialises a full bucket.
+
+            Parameters:
+            rate - Tokens added per second.
+            capacity - Maximum number of tokens (the burst size).
+            clock - Function returning the current time in seconds.
+            sleep - Function used to wait for tokens.
+            """
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self.last = self.clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """
+            Adds the tokens accrued since the last refill.
+            """
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def try_acquire(self, tokens=1):
+        """
+            Takes tokens if they are available, without waiting.
+
+            Returns:
+            True if the tokens were taken.
+            """
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def delay(self, tokens=1):
+        """
+            Returns the number of seconds until tokens are available.
+            """
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """
+            Takes tokens, waiting until they are available.
+            """
+        while not self.try_acquire(tokens):
+            self.sleep(max(self.delay(tokens), 0.001))
+
+
+class SlidingWindowLimit(object):
+    """
+        Limits the number of requests per key (e.g. per contract) in a
+        sliding time window, as IB does for repeated historical data
+        requests on the same contract.
+        """
+
+    def __init__(self, max_requests, period, clock=time.time):
+        """
+            Parameters:
+            max_requests - Requests allowed per key within a window.
+            period - Length of the window in seconds.
+            clock - Function returning the current time in seconds.
+            """
+        self.max_requests = max_requests
+        self.period = period
+        self.clock = clock
+        self.history = {}
+        self.lock = threading.Lock()
+
+    def delay(self, key):
+        """
+            Records a request for key if the window allows it and
+            returns 0.0, otherwise returns the seconds to wait.
+            """
+        with self.lock:
+            now = self.clock()
+            times = [t for t in self.history.get(key, []) if now - t < self.period]
+            if len(times) >= self.max_requests:
+                self.history[key] = times
+                return times[0] + self.period - now
+            times.append(now)
+            self.history[key] = times
+            return 0.0
@@ -0,0 +1,136 @@
+# resample.py
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+def resample_bars(bars_list, rule, bar_length=None):
+    """
+        Resamples a list of bar tuples to a coarser resolution with
+        whole-array operations: open of the first bar of each period,
+        highest high, lowest low, close of the last bar and total
+        volume.
+
+        The periods are fixed intervals for rules such as '5T' or
+        '1H', aligned on multiples of the interval, and calendar
+        periods for the others, e.g. 'W-FRI' (weeks ending on Friday)
+        or 'M'. A coarse bar has closed once a fine bar ending at or
+        after the end of its period has been received, i.e. on the
+        last bar of the period when that bar ends it, and on the first
+        bar of the next period otherwise. The last period has not
+        closed if no such bar exists.
+
+        Parameters:
+        bars_list - List of (symbol, datetime, open, high, low, close,
+                    volume) tuples, in datetime order.
+        rule - A pandas frequency string.
+        bar_length - Duration of one fine bar, defaults to the
+                     shortest time between two bars.
+
+        Returns:
+        times - datetime64 array of the starts of the periods.
+        values - Array of the open, high, low, close and volume of
+                 the coarse bars, one row per bar.
+        visible - Index of the fine bar on which each coarse bar has
+                  closed, len(bars_list) if it has not.
+        """
+    n = len(bars_list)
+    if n == 0:
+        return (np.empty(0, dtype='datetime64[ns]'), np.empty((0, 5)),
+                np.empty(0, dtype=int))
+    index = pd.DatetimeIndex([b[1] for b in bars_list])
+    fine = np.array([b[2:7] for b in bars_list], dtype=float)
+
+    offset = pd.tseries.frequencies.to_offset(rule)
+    if isinstance(offset, pd.tseries.offsets.Tick):
+        starts = index.floor(offset)
+        ends = starts + offset
+    else:
+        periods = index.to_period(rule)
+        starts = periods.start_time
+        ends = periods.end_time + pd.Timedelta(1, 'ns')
+    starts, ends = starts.values, ends.values
+
+    if bar_length is None:
+        spacing = np.diff(index.values)
+        spacing = spacing[spacing > np.timedelta64(0)]
+        bar_length = spacing.min() if len(spacing) else np.timedelta64(0)
+    else:
+        bar_length = pd.Timedelta(bar_length).to_timedelta64()
+
+    first = np.r_[0, np.flatnonzero(starts[1:] != starts[:-1]) + 1]
+    last = np.r_[first[1:], n] - 1
+    values = np.empty((len(first), 5))
+    values[:, 0] = fine[first, 0]
+    values[:, 1] = np.maximum.reduceat(fine[:, 1], first)
+    values[:, 2] = np.minimum.reduceat(fine[:, 2], first)
+    values[:, 3] = fine[last, 3]
+    values[:, 4] = np.add.reduceat(fine[:, 4], first)
+
+    visible = np.searchsorted(index.values + bar_length, ends[first], 'left')
+    return starts[first], values, visible
+
+
+class ResampleCache(object):
+    """
+        Caches the bars of each (symbol, resolution) resampled from
+        the full history of a data handler, evicting the least
+        recently used ones when their arrays take more than
+        memory_budget bytes.
+
+        As the whole history is resampled at once, a coarse bar is
+        only returned once the fine bar that closes it has been
+        replayed, see resample_bars.
+        """
+
+    def __init__(self, memory_budget=64 * 1024 * 1024):
+        """
+            Parameters:
+            memory_budget - Maximum number of bytes of the cached arrays.
+            """
+        self.memory_budget = memory_budget
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, symbol, rule, bars_list):
+        """
+            Returns the resampled times, values and visible arrays of
+            bars_list, from the cache or computed and cached.
+            """
+        key = (symbol, rule)
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[0] != len(bars_list):
+            # The history has been extended since
+            self.nbytes -= entry[1]
+            entry = None
+        if entry is None:
+            arrays = resample_bars(bars_list, rule)
+            entry = (len(bars_list), sum(a.nbytes for a in arrays), arrays)
+            self.nbytes += entry[1]
+            while self.entries and self.nbytes > self.memory_budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted[1]
+        self.entries[key] = entry
+        return entry[2]
+
+    def get_latest_bars(self, symbol, rule, bars_list, received, N=1):
+        """
+            Returns the last N coarse bars of symbol closed once the
+            first `received` bars of bars_list have been replayed, as
+            bar tuples.
+            """
+        times, values, visible = self.get(symbol, rule, bars_list)
+        end = np.searchsorted(visible, received, 'left')
+        start = max(0, end - N)
+        return [(symbol, pd.Timestamp(times[i]).to_pydatetime()) +
+                tuple(values[i].tolist())
+                for i in range(start, end)]
+
+    def clear(self):
+        """
+            Empties the cache.
+            """
+        self.entries.clear()
+        self.nbytes = 0
@@ -0,0 +1,290 @@
+# risk.py
+
+import calendar
+from collections import deque
+
+
+class PreTradeRiskManager(object):
+    """
+        A pre-trade risk stage sitting between the portfolio and the
+        execution handler. Every OrderEvent is approved or rejected
+        before it reaches the broker, against:
+
+        - a per-symbol position limit (in shares),
+        - gross and net exposure limits (in dollars),
+        - a maximum notional per order,
+        - a fat-finger price band around the last traded price,
+        - a maximum number of orders per minute.
+
+        Positions, pending (approved but unfilled) quantities and the
+        gross/net exposure of both are kept as running aggregates,
+        updated on approvals, fills and price changes, so each check
+        costs O(1) and does not depend on the size of the book. The
+        pending quantity of an order is released when the broker
+        cancels or rejects it (a CancelEvent), or, with pending_bars,
+        once the symbol has had no new order for that many bars.
+        """
+
+    def __init__(self, bars, max_position=None, max_gross_exposure=None,
+                 max_net_exposure=None, max_order_notional=None,
+                 price_band=None, max_orders_per_minute=None,
+                 clock=None, pending_bars=None, max_rejections=1000):
+        """
+            Initialises the risk manager. Any limit left as None is
+            not checked.
+
+            Parameters:
+            bars - The DataHandler object with current market data.
+            max_position - Maximum absolute position per symbol, in
+                           shares, either one number for all symbols
+                           or a dictionary of symbol -> shares.
+            max_gross_exposure - Maximum sum of absolute position values.
+            max_net_exposure - Maximum absolute sum of position values.
+            max_order_notional - Maximum dollar value of one order.
+            price_band - Maximum relative distance of a limit price
+                         from the last price, e.g. 0.05 for 5%.
+            max_orders_per_minute - Maximum orders approved per minute.
+            clock - Function returning the current time in seconds,
+                    e.g. time.time when trading live. By default the
+                    time of the latest bar, so that a backtest counts
+                    the orders per minute of market time.
+            pending_bars - Number of bars after which the unfilled
+                           quantity of the orders of a symbol is
+                           released, e.g. 1 in a backtest, where orders
+                           fill on the bar they are placed. None keeps
+                           it until a fill or a CancelEvent.
+            max_rejections - Number of latest rejections kept.
+            """
+        self.bars = bars
+        self.max_position = max_position
+        self.max_gross_exposure = max_gross_exposure
+        self.max_net_exposure = max_net_exposure
+        self.max_order_notional = max_order_notional
+        self.price_band = price_band
+        self.max_orders_per_minute = max_orders_per_minute
+        self.clock = clock
+        self.pending_bars = pending_bars
+
+        self.positions = {}
+        self.pending = {}
+        self.prices = {}
+        self.gross_exposure = 0.0
+        self.net_exposure = 0.0
+        self.order_times = deque()
+        self.rejections = deque(maxlen=max_rejections)
+
+        # Bar count, time of the latest bar and bar of the latest
+        # order of every symbol with a pending quantity
+        self.bar_count = 0
+        self.bar_time = 0.0
+        self.pending_since = {}
+
+    def _last_price(self, symbol):
+        """
+            Returns the close of the latest bar of symbol.
+            """
+        bars = self.bars.get_latest_bars(symbol, N=1)
+        if not bars:
+            return None
+        return bars[-1][5]
+
+    def _position_limit(self, symbol):
+        """
+            Returns the position limit of symbol, or None.
+            """
+        if isinstance(self.max_position, dict):
+            return self.max_position.get(symbol)
+        return self.max_position
+
+    def load_positions(self, positions):
+        """
+            Seeds the book with existing positions, e.g. those of a
+            portfolio recovered after a restart.
+
+            Parameters:
+            positions - Dictionary of symbol -> signed shares.
+            """
+        for symbol, quantity in positions.items():
+            if quantity != 0:
+                self._add_exposure(symbol, quantity)
+                self.positions[symbol] = self.positions.get(symbol, 0) + quantity
+
+    def _committed(self, symbol):
+        """
+            Returns the position plus the pending quantity of symbol.
+            """
+        return self.positions.get(symbol, 0) + self.pending.get(symbol, 0)
+
+    def update_price(self, symbol, price):
+        """
+            Revalues the exposure of symbol at a new price.
+            """
+        old = self.prices.get(symbol)
+        self.prices[symbol] = price
+        quantity = self._committed(symbol)
+        if quantity != 0 and old is not None:
+            self.gross_exposure += abs(quantity * price) - abs(quantity * old)
+            self.net_exposure += quantity * (price - old)
+
+    def _now(self):
+        """
+            Returns the current time in seconds, of the clock or of
+            the latest bar.
+            """
+        if self.clock is not None:
+            return self.clock()
+        return self.bar_time
+
+    def update_timeindex(self, event):
+        """
+            Revalues the symbols with a position or a pending order at
+            the prices of the new bar, after releasing the pending
+            quantities older than pending_bars. Other symbols are not
+            visited.
+            """
+        self.bar_count += 1
+        latest = self.bars.get_latest_bars(self.bars.symbol_list[0], N=1)
+        if latest:
+            dt = latest[-1][1]
+            self.bar_time = calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+        if self.pending_bars is not None:
+            for symbol, since in self.pending_since.items():
+                if self.bar_count - since >= self.pending_bars:
+                    self._release(symbol, self.pending.get(symbol, 0))
+        for symbol in set(self.positions.keys()) | set(self.pending.keys()):
+            if self._committed(symbol) != 0:
+                price = self._last_price(symbol)
+                if price is not None:
+                    self.update_price(symbol, price)
+
+    def update_fill(self, event):
+        """
+            Moves a filled quantity from pending to the position. The
+            exposure, which already counts pending orders, only
+            changes for fills beyond the pending quantity.
+            """
+        if event.type != 'FILL':
+            return
+        symbol = event.symbol
+        signed = event.quantity if event.direction == 'BUY' else -event.quantity
+        pending = self.pending.get(symbol, 0)
+        matched = 0
+        if pending != 0 and (pending > 0) == (signed > 0):
+            matched = signed if abs(signed) <= abs(pending) else pending
+        unmatched = signed - matched
+        if unmatched != 0:
+            # Not (entirely) an order approved here, e.g. one placed
+            # before a restart
+            self._add_exposure(symbol, unmatched)
+        self.pending[symbol] = pending - matched
+        if self.pending[symbol] == 0:
+            self.pending_since.pop(symbol, None)
+        self.positions[symbol] = self.positions.get(symbol, 0) + signed
+
+    def update_cancel(self, event):
+        """
+            Releases the pending quantity of an order the broker has
+            cancelled or rejected.
+            """
+        if event.type != 'CANCEL':
+            return
+        signed = event.quantity if event.direction == 'BUY' else -event.quantity
+        pending = self.pending.get(event.symbol, 0)
+        if pending != 0 and (pending > 0) == (signed > 0):
+            self._release(event.symbol,
+                          signed if abs(signed) <= abs(pending) else pending)
+
+    def _release(self, symbol, signed):
+        """
+            Removes signed shares of symbol from its pending quantity
+            and from the exposure aggregates.
+            """
+        if signed != 0:
+            self._add_exposure(symbol, -signed)
+            self.pending[symbol] = self.pending.get(symbol, 0) - signed
+        if self.pending.get(symbol, 0) == 0:
+            self.pending_since.pop(symbol, None)
+
+    def _add_exposure(self, symbol, signed):
+        """
+            Adds signed shares of symbol to the exposure aggregates.
+            Must be called before the shares are added to the book.
+            """
+        price = self.prices.get(symbol)
+        if price is None:
+            price = self._last_price(symbol) or 0.0
+            self.prices[symbol] = price
+        old = self._committed(symbol)
+        self.gross_exposure += (abs(old + signed) - abs(old)) * price
+        self.net_exposure += signed * price
+
+    def check_order(self, order):
+        """
+            Checks an OrderEvent against every limit.
+
+            Returns:
+            None if the order is approved, otherwise the reason it
+            is rejected.
+            """
+        symbol = order.symbol
+        signed = order.quantity if order.direction == 'BUY' else -order.quantity
+
+        price = self.prices.get(symbol)
+        last = self._last_price(symbol)
+        if last is not None and last != price:
+            self.update_price(symbol, last)
+            price = last
+        if price is None:
+            return "no price for %s" % symbol
+
+        if self.price_band is not None and order.price is not None:
+            if abs(order.price - price) > self.price_band * price:
+                return "limit price %s outside band of last price %s" % (order.price, price)
+
+        notional = abs(signed) * price
+        if self.max_order_notional is not None and notional > self.max_order_notional:
+            return "order notional %0.2f above %0.2f" % (notional, self.max_order_notional)
+
+        current = self._committed(symbol)
+        projected = current + signed
+        limit = self._position_limit(symbol)
+        if limit is not None and abs(projected) > limit and abs(projected) > abs(current):
+            return "position %d above limit %d" % (projected, limit)
+
+        gross = self.gross_exposure + (abs(projected) - abs(current)) * price
+        if self.max_gross_exposure is not None and gross > self.max_gross_exposure and \
+           abs(projected) > abs(current):
+            return "gross exposure %0.2f above %0.2f" % (gross, self.max_gross_exposure)
+
+        net = self.net_exposure + signed * price
+        if self.max_net_exposure is not None and abs(net) > self.max_net_exposure and \
+           abs(net) > abs(self.net_exposure):
+            return "net exposure %0.2f above %0.2f" % (net, self.max_net_exposure)
+
+        if self.max_orders_per_minute is not None:
+            now = self._now()
+            while self.order_times and now - self.order_times[0] >= 60.0:
+                self.order_times.popleft()
+            if len(self.order_times) >= self.max_orders_per_minute:
+                return "more than %d orders per minute" % self.max_orders_per_minute
+        return None
+
+    def approve_order(self, order):
+        """
+            Checks an OrderEvent and, if it passes, counts it as
+            pending and against the order rate.
+
+            Returns:
+            True if the order may be sent to the broker.
+            """
+        reason = self.check_order(order)
+        if reason is not None:
+            self.rejections.append((order, reason))
+            return False
+        signed = order.quantity if order.direction == 'BUY' else -order.quantity
+        self._add_exposure(order.symbol, signed)
+        self.pending[order.symbol] = self.pending.get(order.symbol, 0) + signed
+        self.pending_since[order.symbol] = self.bar_count
+        if self.max_orders_per_minute is not None:
+            self.order_times.append(self._now())
+        return True
@@ -1,4 +1,4 @@
-from ib.opt import Connection, message
+from ib.opt import message
 from ib.ext.Contract import Contract
 from ib.ext.Order import Order
 import sys
@@ -6,6 +6,8 @@ import sys
 # You need to change this to your directory
 sys.path.append("Users/Simo/Documents/Interactive-Broker/IbPy")
 
+from ibconnection import get_connection
+
 
 def error_handler(msg):
     """Handles the capturing of error messages"""
@@ -24,12 +26,13 @@ def make_contract(symbol, sec_type, exch, prim_exchange, curr):
         exch - The exchange to carry out the contract on
         prim_exch - The primary exchange to carry out the contract on
         curr - The currency in which to purchase the contract"""
-        Contract.m_symbol = symbol
-        Contract.m_secType = sec_type
-        Contract.m_exchange = exch
-        Contract.m_primaryExch = prim_exchange
-        Contract.m_currency = curr
-        return Contract
+    contract = Contract()
+    contract.m_symbol = symbol
+    contract.m_secType = sec_type
+    contract.m_exchange = exch
+    contract.m_primaryExch = prim_exchange
+    contract.m_currency = curr
+    return contract
 
 
 def create_order(order_type, quantity, action):
@@ -64,34 +67,34 @@ def make_order(action,quantity, price = None):
 
 cid = 303
 
-while __name__ == "__main__":
-# Connect to the Trader Workstation (TWS) running on the
-# usual port of 7496, with a clientId of 999
-# (The clientId is chosen by us and we will need
-# separate IDs for both the execution connection and
-# market data connection)
-conn = Connection.create(port=7496, clientId=999)
-conn.connect()
-    
-# Assign the error handling function defined above
-# to the TWS connection
-conn.register(error_handler, 'Error')
-    
-# Assign all of the server reply messages to the
-# reply_handler function defined above
-conn.registerAll(reply_handler)
-
-# Create an order ID which is 'global' for this session. This
-# will need incrementing once new orders are submitted.
-oid = cid
-# Create a contract in Tesla stock via SMART order routing
-cont = make_contract('TSLA', 'STK', 'SMART', 'SMART', 'USD')
-# Go long 200 shares of Tesla
-offer = make_order('BUY', 1, 200)
-
-# Use the connection to the send the order to IB
-conn.placeOrder(oid, cont, offer)
-# Disconnect from TWS
-conn.disconnect()
-x = raw_input('enter to resend')
-cid += 1
+if __name__ == "__main__":
+    # Connect to the Trader Workstation (TWS) running on the
+    # usual port of 7496, with a clientId of 999
+    # (The clientId is chosen by us and we will need
+    # separate IDs for both the execution connection and
+    # market data connection)
+    # The connection is opened once and kept for every order; it is
+    # re-established automatically if TWS drops it.
+    conn = get_connection(client_id=999, port=7496)
+
+    # Assign the error handling function defined above
+    # to the TWS connection
+    conn.register(error_handler, 'Error')
+
+    # Assign all of the server reply messages to the
+    # reply_handler function defined above
+    conn.registerAll(reply_handler)
+
+    # Create an order ID which is 'global' for this session. This
+    # will need incrementing once new orders are submitted.
+    oid = cid
+    while True:
+        # Create a contract in Tesla stock via SMART order routing
+        cont = make_contract('TSLA', 'STK', 'SMART', 'SMART', 'USD')
+        # Go long 200 shares of Tesla
+        offer = make_order('BUY', 1, 200)
+
+        # Use the connection to the send the order to IB
+        conn.placeOrder(oid, cont, offer)
+        x = raw_input('enter to resend')
+        oid += 1
@@ -0,0 +1,199 @@
+# robustness.py
+
+import numpy as np
+
+
+def bootstrap_indices(n, n_samples, block_size=None, random_state=None):
+    """
+        Draws a matrix of resampling indices, one row per resampled
+        path of length n.
+
+        With block_size None (or 1) every index is drawn independently
+        (i.i.d. bootstrap). Otherwise consecutive blocks of block_size
+        observations are drawn from random starting points, wrapping
+        around the end of the series (circular block bootstrap), which
+        preserves short-term autocorrelation of the returns.
+
+        Parameters:
+        n - Length of the original series.
+        n_samples - Number of resampled paths.
+        block_size - Length of the resampled blocks.
+        random_state - A numpy RandomState.
+
+        Returns:
+        An (n_samples, n) integer array.
+        """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    if block_size is None or block_size <= 1:
+        return random_state.randint(0, n, size=(n_samples, n))
+
+    n_blocks = int(np.ceil(float(n) / block_size))
+    starts = random_state.randint(0, n, size=(n_samples, n_blocks))
+    idx = (starts[:, :, np.newaxis] + np.arange(block_size)) % n
+    return idx.reshape(n_samples, n_blocks * block_size)[:, :n]
+
+
+def resampled_path_stats(samples, periods=252):
+    """
+        Calculates the Sharpe ratio, maximum drawdown and terminal
+        wealth of every row of a matrix of resampled returns at once.
+
+        Parameters:
+        samples - An (n_samples, n) array of period returns.
+        periods - Daily (252), Hourly (252*6.5), Minutely(252*6.5*60) etc.
+
+        Returns:
+        sharpe, max_dd, terminal - Three arrays of length n_samples.
+        The drawdowns are absolute, as a fraction of the initial
+        wealth, as in Portfolio.output_summary_stats.
+        """
+    std = samples.std(axis=1)
+    mean = samples.mean(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = np.where(std > 0, np.sqrt(periods) * mean / std, np.nan)
+
+    equity = np.cumprod(1.0 + samples, axis=1)
+    # The high water mark starts at the initial wealth of 1.0
+    hwm = np.maximum(np.maximum.accumulate(equity, axis=1), 1.0)
+    max_dd = (hwm - equity).max(axis=1)
+    terminal = equity[:, -1]
+    return sharpe, max_dd, terminal
+
+
+def bootstrap_statistics(returns, n_samples=10000, block_size=None,
+                         batch_size=1000, periods=252, seed=None):
+    """
+        Resamples a return series n_samples times and calculates the
+        statistics of every resampled path.
+
+        The paths are generated and evaluated batch_size at a time,
+        each batch as a single matrix, which bounds the memory used
+        while keeping all of the work inside numpy.
+
+        Parameters:
+        returns - A sequence (or pandas Series) of period returns.
+        n_samples - Number of resampled paths.
+        block_size - Block length for the block bootstrap, None for i.i.d.
+        batch_size - Number of paths resampled per matrix.
+        periods - Periods per year, used for the Sharpe ratio.
+        seed - Optional seed for reproducible resamples.
+
+        Returns:
+        A dictionary of 'sharpe', 'max_drawdown' and 'terminal_wealth'
+        arrays, one value per resampled path, all NaN when there is
+        no return to resample.
+        """
+    returns = np.asarray(returns, dtype=np.float64)
+    returns = returns[np.isfinite(returns)]
+    n = len(returns)
+    random_state = np.random.RandomState(seed)
+
+    sharpe = np.full(n_samples, np.nan)
+    max_dd = np.full(n_samples, np.nan)
+    terminal = np.full(n_samples, np.nan)
+    if n == 0:
+        return {"sharpe": sharpe,
+                "max_drawdown": max_dd,
+                "terminal_wealth": terminal}
+    for lo in range(0, n_samples, batch_size):
+        hi = min(lo + batch_size, n_samples)
+        idx = bootstrap_indices(n, hi - lo, block_size, random_state)
+        sharpe[lo:hi], max_dd[lo:hi], terminal[lo:hi] = \
+            resampled_path_stats(returns[idx], periods)
+
+    return {"sharpe": sharpe,
+            "max_drawdown": max_dd,
+            "terminal_wealth": terminal}
+
+
+def trade_returns(positions, totals):
+    """
+        Calculates the return of every round trip of a portfolio, a
+        round trip being a run of bars in which it holds a position.
+        Its return runs from the total of the bar before the position
+        is opened to the total of the bar after it is closed (or of
+        the last bar, if it is still open), so that the commissions of
+        both fills are included.
+
+        Parameters:
+        positions - The positions history of the portfolio, a
+                    SparseHistory (all_positions).
+        totals - The portfolio totals of the same bars, e.g.
+                 all_holdings.field('total').
+
+        Returns:
+        An array of trade returns, in the order of the trades.
+        """
+    totals = np.asarray(totals, dtype=np.float64)
+    held = np.diff(np.asarray(positions.offsets)) > 0
+    edges = np.diff(np.r_[0, held.astype(int), 0])
+    starts = np.flatnonzero(edges == 1)
+    ends = np.minimum(np.flatnonzero(edges == -1), len(totals) - 1)
+    return totals[ends] / totals[np.maximum(starts - 1, 0)] - 1.0
+
+
+def confidence_intervals(statistics, confidence=0.95):
+    """
+        Calculates the two-sided percentile confidence interval and
+        the median of each resampled statistic.
+
+        Returns:
+        A dictionary of statistic name -> (lower, median, upper).
+        """
+    tail = (1.0 - confidence) / 2.0 * 100.0
+    intervals = {}
+    for name, values in statistics.items():
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            intervals[name] = (np.nan, np.nan, np.nan)
+        else:
+            intervals[name] = tuple(np.percentile(values, [tail, 50.0, 100.0 - tail]))
+    return intervals
+
+
+def output_robustness_stats(equity_curve, trade_returns=None,
+                            n_samples=10000, block_size=None,
+                            confidence=0.95, periods=252, seed=None):
+    """
+        Creates a list of bootstrap confidence intervals for the
+        statistics reported by Portfolio.output_summary_stats.
+
+        Parameters:
+        equity_curve - The portfolio equity_curve DataFrame (the
+                       'returns' column is resampled).
+        trade_returns - Optional sequence of per-trade returns (see
+                        trade_returns), which are resampled as well
+                        when given.
+        n_samples - Number of resampled paths.
+        block_size - Block length for the block bootstrap, None for i.i.d.
+        confidence - Confidence level of the intervals.
+        periods - Periods per year, used for the Sharpe ratio.
+        seed - Optional seed for reproducible resamples.
+        """
+    label = "%d%% CI" % (confidence * 100)
+    curve = confidence_intervals(
+        bootstrap_statistics(equity_curve['returns'], n_samples, block_size,
+                             periods=periods, seed=seed),
+        confidence
+    )
+    stats = [
+        ("Sharpe Ratio %s" % label,
+         "%0.2f / %0.2f / %0.2f" % curve["sharpe"]),
+        ("Max Drawdown %s" % label,
+         "%0.2f%% / %0.2f%% / %0.2f%%" % tuple(x * 100.0 for x in curve["max_drawdown"])),
+        ("Total Return %s" % label,
+         "%0.2f%% / %0.2f%% / %0.2f%%" % tuple((x - 1.0) * 100.0 for x in curve["terminal_wealth"]))
+    ]
+
+    if trade_returns is not None and len(trade_returns) > 0:
+        trades = confidence_intervals(
+            bootstrap_statistics(trade_returns, n_samples, None,
+                                 periods=periods, seed=seed),
+            confidence
+        )
+        stats.append(("Trade Total Return %s" % label,
+                      "%0.2f%% / %0.2f%% / %0.2f%%" % tuple((x - 1.0) * 100.0 for x in trades["terminal_wealth"])))
+        stats.append(("Trade Max Drawdown %s" % label,
+                      "%0.2f%% / %0.2f%% / %0.2f%%" % tuple(x * 100.0 for x in trades["max_drawdown"])))
+    return stats
@@ -0,0 +1,229 @@
+# screening.py
+
+import numpy as np
+
+
+class UniverseScreener(object):
+    """
+        Keeps rolling per-symbol screening statistics (average dollar
+        volume, price level and return volatility) over the last
+        `window` bars and the subset of the universe currently passing
+        the filters.
+
+        The statistics are running sums over a ring buffer, updated
+        for all symbols at once on every bar and recomputed from the
+        ring every `window` bars so that rounding errors do not build
+        up. When the whole history is known in advance (the historic
+        in-memory handlers), the statistics of every bar are instead
+        computed once with whole-array operations (see precompute) and
+        each bar only indexes them. The eligible subset is
+        re-evaluated every `every` bars (e.g. once per day on minute
+        bars), so the universe can change over time without reloading
+        any data. It is attached to a data handler, see
+        DataHandler.attach_screener.
+        """
+
+    def __init__(self, symbol_list, window=20, min_dollar_volume=None,
+                 min_price=None, max_price=None, min_volatility=None,
+                 max_volatility=None, every=1):
+        """
+            Parameters:
+            symbol_list - The symbols of the universe.
+            window - Number of bars of the rolling statistics.
+            min_dollar_volume - Minimum average close * volume.
+            min_price, max_price - Bounds of the latest close.
+            min_volatility, max_volatility - Bounds of the standard
+                                             deviation of the returns.
+            every - Number of bars between two screenings.
+            """
+        self.symbol_list = list(symbol_list)
+        self.window = window
+        self.min_dollar_volume = min_dollar_volume
+        self.min_price = min_price
+        self.max_price = max_price
+        self.min_volatility = min_volatility
+        self.max_volatility = max_volatility
+        self.every = every
+
+        n = len(self.symbol_list)
+        self.dollar_volume = np.zeros((window, n))
+        self.returns = np.zeros((window, n))
+        self.dollar_volume_sum = np.zeros(n)
+        self.return_sum = np.zeros(n)
+        self.return_sq = np.zeros(n)
+        self.prices = np.full(n, np.nan)
+        self.count = 0
+        self.updates = 0
+        self.eligible = list(self.symbol_list)
+        self.mask = np.ones(n, dtype=bool)
+
+        # Statistics of every bar of the history, see precompute
+        self.precomputed = None
+
+    def __getstate__(self):
+        # The precomputed statistics are rebuilt from the data handler
+        # on restore rather than checkpointed
+        state = self.__dict__.copy()
+        state['precomputed'] = None
+        return state
+
+    def _returns(self, close, previous):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ret = close / previous - 1.0
+        ret[~np.isfinite(ret)] = 0.0
+        return ret
+
+    def precompute(self, close, volume):
+        """
+            Computes the statistics after every bar of a known history
+            at once, for update_at.
+
+            Parameters:
+            close, volume - Arrays of the closes and volumes, one row
+                            per bar and one column per symbol, in
+                            symbol_list order.
+            """
+        close = np.asarray(close, dtype=float)
+        volume = np.asarray(volume, dtype=float)
+        previous = np.vstack([np.full((1, close.shape[1]), np.nan), close[:-1]])
+        ret = self._returns(close, previous)
+        dollar_volume = np.nan_to_num(close * volume)
+
+        def rolling_sum(values):
+            # Sum of the last `window` rows up to each row, from sums
+            # restarted on every block of `window` rows, as the ring
+            # is re-summed, rather than one cumulative sum, whose
+            # rounding errors would grow along the history: the sum
+            # of a row is that of its block so far plus the end of
+            # the previous block
+            w = self.window
+            n = len(values)
+            blocks = np.zeros((-(-n // w) * w,) + values.shape[1:])
+            blocks[:n] = values
+            blocks = blocks.reshape((-1, w) + values.shape[1:])
+            total = np.cumsum(blocks, axis=1)
+            tail = np.cumsum(blocks[:, ::-1], axis=1)[:, ::-1]
+            total[1:, :w - 1] += tail[:-1, 1:]
+            return total.reshape((-1,) + values.shape[1:])[:n]
+
+        self.precomputed = {
+            "dollar_volume_sum": rolling_sum(dollar_volume),
+            "return_sum": rolling_sum(ret),
+            "return_sq": rolling_sum(ret * ret),
+            "prices": close
+        }
+
+    def seek(self, i):
+        """
+            Sets the statistics to those after bar i of the
+            precomputed history, without screening.
+            """
+        for name, values in self.precomputed.items():
+            setattr(self, name, values[i])
+        self.count = min(i + 1, self.window)
+
+    def update_at(self, i):
+        """
+            Moves on to bar i of the precomputed history.
+            """
+        self.seek(i)
+        self.updates += 1
+        if self.updates % self.every == 0:
+            self.screen()
+
+    def warm_up(self, bars):
+        """
+            Feeds the last `window` bars a data handler already holds
+            (its warm-up history), so that the statistics are primed
+            on its first new bar. Symbols with fewer bars are aligned
+            on the latest one.
+            """
+        history = [bars.get_latest_bars(s, self.window + 1) or []
+                   for s in self.symbol_list]
+        length = max([len(h) for h in history] + [0])
+        for k in range(length):
+            close = np.full(len(history), np.nan)
+            volume = np.zeros(len(history))
+            for j, h in enumerate(history):
+                i = k - (length - len(h))
+                if i >= 0:
+                    close[j], volume[j] = h[i][5], h[i][6]
+            self.update_arrays(close, volume)
+
+    def update(self, bars):
+        """
+            Adds the latest bar of every symbol of a data handler.
+            """
+        latest = [bars.get_latest_bars(s) for s in self.symbol_list]
+        close = np.array([b[-1][5] if b else np.nan for b in latest], dtype=float)
+        volume = np.array([b[-1][6] if b else 0.0 for b in latest], dtype=float)
+        self.update_arrays(close, volume)
+
+    def update_arrays(self, close, volume):
+        """
+            Adds one bar of closes and volumes, in symbol_list order.
+            """
+        ret = self._returns(close, self.prices)
+        dollar_volume = np.nan_to_num(close * volume)
+
+        slot = self.updates % self.window
+        self.dollar_volume_sum += dollar_volume - self.dollar_volume[slot]
+        self.return_sum += ret - self.returns[slot]
+        self.return_sq += ret * ret - self.returns[slot] ** 2
+        self.dollar_volume[slot] = dollar_volume
+        self.returns[slot] = ret
+        self.prices = close
+        self.updates += 1
+        self.count = min(self.count + 1, self.window)
+        if self.updates % self.window == 0:
+            self.dollar_volume_sum = self.dollar_volume.sum(axis=0)
+            self.return_sum = self.returns.sum(axis=0)
+            self.return_sq = (self.returns ** 2).sum(axis=0)
+
+        if self.updates % self.every == 0:
+            self.screen()
+
+    def average_dollar_volume(self):
+        """
+            Returns the average dollar volume of each symbol.
+            """
+        return self.dollar_volume_sum / max(self.count, 1)
+
+    def volatility(self):
+        """
+            Returns the standard deviation of the returns of each symbol.
+            """
+        k = float(max(self.count, 1))
+        mean = self.return_sum / k
+        return np.sqrt(np.maximum(self.return_sq / k - mean * mean, 0.0))
+
+    def screen(self):
+        """
+            Re-evaluates the eligible subset. While the window is not
+            full, only the price filters apply.
+            """
+        mask = np.isfinite(self.prices)
+        if self.min_price is not None:
+            mask &= self.prices >= self.min_price
+        if self.max_price is not None:
+            mask &= self.prices <= self.max_price
+        if self.count >= self.window:
+            if self.min_dollar_volume is not None:
+                mask &= self.average_dollar_volume() >= self.min_dollar_volume
+            vol = self.volatility()
+            if self.min_volatility is not None:
+                mask &= vol >= self.min_volatility
+            if self.max_volatility is not None:
+                mask &= vol <= self.max_volatility
+        elif self.min_dollar_volume is not None or \
+             self.min_volatility is not None or self.max_volatility is not None:
+            mask &= False
+        self.mask = mask
+        self.eligible = [s for s, ok in zip(self.symbol_list, mask) if ok]
+
+    def get_eligible_symbols(self):
+        """
+            Returns the symbols currently passing the filters, in
+            symbol_list order.
+            """
+        return self.eligible
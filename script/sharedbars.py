@@ -0,0 +1,390 @@
+# sharedbars.py
+
+import mmap
+import select
+import socket
+import time
+
+import numpy as np
+
+from data import DataHandler, BAR_FIELDS, _to_datetime64
+from event import MarketEvent
+
+
+MAGIC = "BARRING1"
+
+# Datagram sent by a consumer to the server to receive notifications
+SUBSCRIBE = "SUB"
+
+
+def _header_dtype():
+    return np.dtype([('magic', 'S8'), ('n_symbols', '<i8'),
+                     ('capacity', '<i8'), ('count', '<i8')])
+
+
+def _slot_dtype(n_symbols):
+    # seq is 2k+1 while bar k is being written and 2k+2 once written
+    return np.dtype([('seq', '<i8'), ('time', '<i8'),
+                     ('values', '<f8', (n_symbols, len(BAR_FIELDS)))])
+
+
+def _map_views(buf, n_symbols, capacity):
+    """
+        Returns the header, symbol table and slots of a ring buffer,
+        as numpy views on buf.
+        """
+    header = np.frombuffer(buf, _header_dtype(), 1, 0)
+    offset = _header_dtype().itemsize
+    symbols = np.frombuffer(buf, 'S32', n_symbols, offset)
+    offset += symbols.nbytes
+    slots = np.frombuffer(buf, _slot_dtype(n_symbols), capacity, offset)
+    return header, symbols, slots
+
+
+def _to_micros(dt):
+    return int(np.datetime64(dt, 'us').astype('<i8'))
+
+
+def _from_micros(us):
+    return np.datetime64(int(us), 'us').astype(object)
+
+
+class SharedBarServer(object):
+    """
+        Publishes the bars of a feed into a ring buffer of the last
+        `capacity` bars of every symbol, in a memory-mapped file which
+        any number of local processes map read-only (see
+        SharedMemoryDataHandler). The feed is polled once and the bar
+        history kept once, however many strategies run on the box.
+
+        Every bar is one slot holding the time and the open, high,
+        low, close and volume of all the symbols. A slot is guarded by
+        a sequence number (a seqlock): odd while it is being written,
+        so that readers retry, and changed again when the slot is
+        reused, so that readers detect overwritten bars.
+
+        After each bar, a small UDP datagram is sent to the consumers
+        that subscribed to the server's port, which wakes them up;
+        consumers that are gone are dropped.
+        """
+
+    def __init__(self, path, symbol_list, capacity=4096, port=47000,
+                 host="127.0.0.1"):
+        """
+            Creates the ring buffer file and the notification socket.
+
+            Parameters:
+            path - Path of the memory-mapped file, e.g. in /dev/shm.
+            symbol_list - The symbols published.
+            capacity - Number of bars kept.
+            port - UDP port receiving the subscriptions.
+            host - Address of the notification socket.
+            """
+        self.path = path
+        self.symbol_list = list(symbol_list)
+        self.capacity = capacity
+        n = len(self.symbol_list)
+        size = (_header_dtype().itemsize + 32 * n +
+                _slot_dtype(n).itemsize * capacity)
+
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        self.header, symbols, self.slots = _map_views(self.mm, n, capacity)
+        symbols[:] = self.symbol_list
+        self.header['n_symbols'] = n
+        self.header['capacity'] = capacity
+        self.header['count'] = 0
+        # Written last: consumers wait for the magic
+        self.header['magic'] = MAGIC
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.subscribers = set()
+
+    def publish(self, dt, values):
+        """
+            Appends one bar of all the symbols and notifies the
+            consumers.
+
+            Parameters:
+            dt - Datetime of the bar.
+            values - Array of the BAR_FIELDS of the bar, one row per
+                     symbol of symbol_list.
+            """
+        k = int(self.header['count'][0])
+        slot = self.slots[k % self.capacity:k % self.capacity + 1]
+        slot['seq'] = 2 * k + 1
+        slot['time'] = _to_micros(dt)
+        slot['values'] = values
+        slot['seq'] = 2 * k + 2
+        self.header['count'] = k + 1
+        self.notify(k + 1)
+
+    def publish_bars(self, bars):
+        """
+            Publishes the latest bar of every symbol of a data handler.
+            """
+        latest = [bars.get_latest_bars(s)[-1] for s in self.symbol_list]
+        self.publish(latest[0][1], [b[2:7] for b in latest])
+
+    def notify(self, count):
+        """
+            Registers the new subscribers, then sends them the number
+            of bars published.
+            """
+        while True:
+            try:
+                message, address = self.sock.recvfrom(64)
+            except socket.error:
+                break
+            if message == SUBSCRIBE:
+                self.subscribers.add(address)
+        message = str(count)
+        for address in list(self.subscribers):
+            try:
+                self.sock.sendto(message, address)
+            except socket.error:
+                self.subscribers.discard(address)
+
+    def serve(self, bars, heartbeat=60.0):
+        """
+            Polls a data handler (e.g. data.RealTimeDataHandler) at
+            every bar close, i.e. on the multiples of heartbeat
+            seconds, and publishes its bars, forever. The wait is taken
+            from the clock at each bar, so that the time spent polling
+            does not make the bars drift.
+            """
+        while True:
+            time.sleep(heartbeat - time.time() % heartbeat)
+            bars.update_bars()
+            # Nothing trades in the server: drop the market events
+            while not bars.events.empty():
+                bars.events.get(False)
+            self.publish_bars(bars)
+
+    def close(self):
+        self.sock.close()
+        self.header = self.slots = None
+        self.mm.close()
+        self.file.close()
+
+
+class SharedMemoryDataHandler(DataHandler):
+    """
+        SharedMemoryDataHandler reads the bars published by a
+        SharedBarServer, from its ring buffer mapped read-only, so
+        that strategy processes share one feed and one history.
+
+        The bars published before the handler was created are its
+        history; update_bars moves on by one published bar, waiting
+        for the server's notification when there is none. In live
+        trading, live.LiveRunner blocks in wait_bars on a worker
+        thread, and moves on by one bar per burst of events until it
+        has caught up with the last bar published. The bars
+        are read from the ring on demand and never copied into
+        per-process lists, and none after the current bar is returned.
+        A read copies only the requested bars of the requested symbol,
+        through a strided view of its column of the ring.
+        """
+
+    def __init__(self, events, path, symbol_list=None,
+                 server=("127.0.0.1", 47000), timeout=1.0):
+        """
+            Parameters:
+            events - The Event Queue.
+            path - Path of the server's memory-mapped file.
+            symbol_list - The symbols used, all those published by
+                          default.
+            server - UDP address of the server, to subscribe to the
+                     notifications.
+            timeout - Longest wait for a new bar in update_bars.
+            """
+        self.events = events
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = np.frombuffer(self.mm, _header_dtype(), 1, 0)
+        if header['magic'][0] != MAGIC:
+            raise ValueError("%s is not a bar ring buffer" % path)
+        n, capacity = int(header['n_symbols'][0]), int(header['capacity'][0])
+        self.header, symbols, self.slots = _map_views(self.mm, n, capacity)
+        self.capacity = capacity
+
+        published = symbols.tolist()
+        if symbol_list is None:
+            symbol_list = published
+        self.symbol_list = symbol_list
+        # Strided view of the bars of each symbol, one row per slot
+        self.columns = dict((s, self.slots['values'][:, published.index(s), :])
+                            for s in symbol_list)
+
+        self.cursor = self.count()
+        self.continue_backtest = True
+        self.server = server
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.sendto(SUBSCRIBE, server)
+
+    def count(self):
+        """
+            Returns the number of bars published so far.
+            """
+        return int(self.header['count'][0])
+
+    def _oldest(self):
+        """
+            Returns the number of the oldest bar still in the ring.
+            """
+        return max(self.count() - self.capacity, 0)
+
+    def _read(self, symbol, start, end):
+        """
+            Copies the published bars [start, end) of symbol out of
+            the ring, retrying while the server writes one of their
+            slots.
+
+            Returns:
+            times, values - int64 microseconds and the BAR_FIELDS of
+            the bars, one row per bar. Bars overwritten since are
+            left out.
+            """
+        column = self.columns[symbol]
+        while True:
+            start = max(start, self._oldest())
+            k = np.arange(start, end)
+            slot = k % self.capacity
+            expected = 2 * k + 2
+            # Seqlock: the copy is valid if the sequence numbers were
+            # those of the bars before and are still after it
+            before = self.slots['seq'][slot]
+            times, values = self.slots['time'][slot], column[slot]
+            if (before == expected).all() and \
+               (self.slots['seq'][slot] == expected).all():
+                return times, values
+
+    def _search(self, ts, side):
+        """
+            Binary search of ts in the times of the bars up to the
+            current one still in the ring, reading one slot per step.
+
+            Returns:
+            The number of the first bar with a time after ts ('right')
+            or at or after it ('left'), and the oldest bar searched.
+            """
+        us = _to_datetime64(ts).astype('datetime64[us]').astype('<i8')
+        times = self.slots['time']
+        while True:
+            oldest = lo = self._oldest()
+            hi = self.cursor
+            while lo < hi:
+                mid = (lo + hi) // 2
+                t = times[mid % self.capacity]
+                if t < us or (side == 'right' and t == us):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            # Retry if the server has since overwritten a slot searched
+            if self._oldest() <= oldest:
+                return lo, oldest
+
+    def _wait(self):
+        """
+            Waits for a notification from the server, subscribing
+            again if none comes (e.g. after a server restart).
+            """
+        readable, _, _ = select.select([self.sock], [], [], self.timeout)
+        if not readable:
+            self.sock.sendto(SUBSCRIBE, self.server)
+            return
+        while True:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                break
+            self.sock.recv(64)
+
+    def update_bars(self):
+        """
+            Moves on to the next published bar and puts a MarketEvent,
+            or waits up to timeout for one. A consumer that has fallen
+            more than capacity bars behind skips to the oldest bar
+            still in the ring.
+            """
+        if not self.bars_pending():
+            self.wait_bars()
+        self.push_bars()
+
+    def bars_pending(self):
+        """
+            Returns True if bars were published after the current one.
+            """
+        return self.cursor < self.count()
+
+    def wait_bars(self):
+        """
+            Waits up to timeout for the server's next notification,
+            without moving on, so that it can block on another thread
+            than the one reading the bars (see live.LiveRunner).
+            """
+        self._wait()
+
+    def push_bars(self, new_bars=None):
+        """
+            Moves on to the next published bar, if any, and puts a
+            MarketEvent.
+            """
+        count = self.count()
+        if self.cursor < count:
+            self.cursor = max(self.cursor + 1, count - self.capacity + 1)
+            if self.screener is not None:
+                self.screener.update(self)
+            self.events.put(MarketEvent())
+
+    def get_latest_bars(self, symbol, N=1, resolution=None):
+        """
+            Returns the last N bars up to the current one, or fewer if
+            less are available, as bar tuples.
+            """
+        self.check_resolution(resolution)
+        if symbol not in self.columns:
+            print "That symbol is not available in the shared data."
+            return None
+        times, values = self._read(symbol, self.cursor - N, self.cursor)
+        return [(symbol, _from_micros(t)) + tuple(v)
+                for t, v in zip(times, values.tolist())]
+
+    def get_bars_between(self, symbol, start=None, end=None):
+        """
+            Returns the bars of symbol with start <= datetime <= end,
+            among the bars up to the current one still in the ring.
+
+            Returns:
+            times, values - The datetime64 index and the BAR_FIELDS of
+            the bars, one row per bar.
+            """
+        lo = self._oldest() if start is None else self._search(start, 'left')[0]
+        hi = self.cursor if end is None else self._search(end, 'right')[0]
+        times, values = self._read(symbol, lo, max(lo, hi))
+        return times.astype('datetime64[us]'), values
+
+    def get_bar_at(self, symbol, ts):
+        """
+            Returns the bar of symbol in effect at ts, or None.
+            """
+        i, oldest = self._search(ts, 'right')
+        if i == oldest:
+            return None
+        times, values = self._read(symbol, i - 1, i)
+        if len(times) == 0:
+            # Overwritten since the search
+            return None
+        return (symbol, _from_micros(times[0])) + tuple(values[0].tolist())
+
+    def close(self):
+        self.sock.close()
+        self.header = self.slots = None
+        self.mm.close()
+        self.file.close()
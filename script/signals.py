@@ -0,0 +1,160 @@
+# signals.py
+
+import Queue
+
+import numpy as np
+
+from event import SignalEvent
+from strategy import Strategy
+
+
+# Codes of the signal types in a SignalMatrix, 0 meaning no signal
+SIGNAL_CODES = {'LONG': 1, 'SHORT': -1, 'EXIT': 2}
+SIGNAL_TYPES = dict((v, k) for k, v in SIGNAL_CODES.items())
+
+
+class SignalMatrix(object):
+    """
+        The signals of a strategy over a history, stored as two small
+        integer arrays of (market event x symbol): the signal type and
+        the signal strength, as an index into a list of strengths.
+
+        A strategy only reads bars, so its signals do not depend on the
+        portfolio or execution model. Recording them once and replaying
+        them (SignalReplayStrategy) lets any number of portfolio and
+        execution variants be run without evaluating the strategy.
+        """
+
+    def __init__(self, symbol_list, times, types, strengths, strength_names):
+        """
+            Parameters:
+            symbol_list - The symbols of the columns.
+            times - datetime64 array, the latest bar time of each row.
+            types - int8 array of signal type codes (SIGNAL_CODES).
+            strengths - int8 array of indices into strength_names.
+            strength_names - The list of signal strengths.
+            """
+        self.symbol_list = list(symbol_list)
+        self.times = times
+        self.types = types
+        self.strengths = strengths
+        self.strength_names = list(strength_names)
+
+    @classmethod
+    def record(cls, bars, strategy):
+        """
+            Runs a strategy over all the bars of a data handler and
+            records its signals, one row per MarketEvent.
+
+            Parameters:
+            bars - The DataHandler object, at the start of its bars.
+            strategy - The Strategy object, built over bars and the
+                       event queue of bars.
+            """
+        events = bars.events
+        symbol_index = dict((s, i) for i, s in enumerate(bars.symbol_list))
+        strength_index = {}
+        times, rows = [], []
+
+        while bars.continue_backtest:
+            bars.update_bars()
+            while True:
+                try:
+                    event = events.get(False)
+                except Queue.Empty:
+                    break
+                if event is None:
+                    continue
+                if event.type == 'MARKET':
+                    times.append(bars.get_latest_bars(bars.symbol_list[0])[-1][1])
+                    rows.append([])
+                    strategy.calculate_signals(event)
+                elif event.type == 'SIGNAL':
+                    if event.strength not in strength_index:
+                        strength_index[event.strength] = len(strength_index)
+                    rows[-1].append((symbol_index[event.symbol],
+                                     SIGNAL_CODES[event.signal_type],
+                                     strength_index[event.strength]))
+
+        types = np.zeros((len(rows), len(bars.symbol_list)), dtype=np.int8)
+        strengths = np.zeros(types.shape, dtype=np.int8)
+        for i, row in enumerate(rows):
+            for col, code, strength in row:
+                types[i, col] = code
+                strengths[i, col] = strength
+        strength_names = sorted(strength_index, key=strength_index.get)
+        return cls(bars.symbol_list, np.array(times, dtype='datetime64[us]'),
+                   types, strengths, strength_names)
+
+    def save(self, path):
+        """
+            Saves the matrix to a compressed .npz file.
+            """
+        np.savez_compressed(path, symbol_list=np.array(self.symbol_list),
+                            times=self.times, types=self.types,
+                            strengths=self.strengths,
+                            strength_names=np.array(self.strength_names))
+
+    @classmethod
+    def load(cls, path):
+        """
+            Loads a matrix saved with save().
+            """
+        f = np.load(path)
+        try:
+            return cls(f['symbol_list'].tolist(), f['times'], f['types'],
+                       f['strengths'], f['strength_names'].tolist())
+        finally:
+            f.close()
+
+    def __len__(self):
+        return len(self.times)
+
+
+class SignalReplayStrategy(Strategy):
+    """
+        Replays a SignalMatrix: on the n-th MarketEvent it puts the
+        signals recorded on the n-th MarketEvent of the original run,
+        in symbol order, as the original strategy did. No indicator is
+        evaluated.
+        """
+
+    def __init__(self, bars, events, matrix):
+        """
+            Parameters:
+            bars - The DataHandler object, replaying the same bars as
+                   the recorded run.
+            events - The Event Queue object.
+            matrix - A SignalMatrix, or the path of a saved one.
+            """
+        self.bars = bars
+        self.symbol_list = self.bars.symbol_list
+        self.events = events
+        if not isinstance(matrix, SignalMatrix):
+            matrix = SignalMatrix.load(matrix)
+        self.matrix = matrix
+        self.row = 0
+
+        columns = dict((s, i) for i, s in enumerate(matrix.symbol_list))
+        self.columns = np.array([columns[s] for s in self.symbol_list])
+
+    def calculate_signals(self, event):
+        """
+            Puts the signals of the next recorded row.
+            """
+        if event.type != 'MARKET':
+            return
+        if self.row >= len(self.matrix):
+            raise ValueError("More market events than recorded rows")
+        dt = self.bars.get_latest_bars(self.symbol_list[0])[-1][1]
+        if np.datetime64(dt, 'us') != self.matrix.times[self.row]:
+            raise ValueError("Bar %s does not match the recorded %s"
+                             % (dt, self.matrix.times[self.row]))
+
+        types = self.matrix.types[self.row, self.columns]
+        for i in np.flatnonzero(types):
+            strength = self.matrix.strengths[self.row, self.columns[i]]
+            self.events.put(SignalEvent(self.symbol_list[i], dt,
+                                        SIGNAL_TYPES[types[i]],
+                                        self.matrix.strength_names[strength]))
+        self.row += 1
@@ -0,0 +1,155 @@
+# sizing.py
+
+from math import floor
+
+import numpy as np
+
+
+def inverse_volatility_weights(vol):
+    """
+        Weights proportional to the inverse volatility of each name,
+        summing to one. Names without volatility get no weight.
+        """
+    with np.errstate(divide='ignore'):
+        w = np.where(vol > 0, 1.0 / vol, 0.0)
+    total = w.sum()
+    return w / total if total > 0 else w
+
+
+def risk_parity_weights(cov, iterations=50, tol=1e-8):
+    """
+        Long-only weights, summing to one, whose contributions to the
+        portfolio variance, w_i * (cov w)_i, are equal.
+
+        Solved by the fixed point iteration w_i <- w_i * sqrt(b / rc_i),
+        starting from the inverse volatility weights.
+        """
+    n = len(cov)
+    w = inverse_volatility_weights(np.sqrt(np.maximum(np.diag(cov), 0.0)))
+    if n == 1 or not w.any():
+        return w
+    for i in range(iterations):
+        rc = w * cov.dot(w)
+        total = rc.sum()
+        if total <= 0:
+            break
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.sqrt(np.where(rc > 0, total / n / rc, 1.0))
+        w_new = w * step
+        w_new /= w_new.sum()
+        if np.abs(w_new - w).max() < tol:
+            return w_new
+        w = w_new
+    return w
+
+
+def scale_to_volatility(cov, w, target_vol, periods=252):
+    """
+        Scales a weight vector so that the annualised volatility of the
+        portfolio is target_vol.
+        """
+    var = w.dot(cov).dot(w)
+    if var <= 0:
+        return w
+    return w * target_vol / np.sqrt(var * periods)
+
+
+class CovarianceSizer(object):
+    """
+        Sizes the orders of a portfolio from the covariance of the
+        returns of its book (see covariance.RollingCovariance), rather
+        than each name in isolation.
+
+        On a signal, the book is the names with a position plus the
+        signalled name, each long or short. The weights of the book are
+        computed with one of these methods and then scaled so that the
+        book hits the target volatility:
+
+        - 'volatility': inverse volatility weights (volatility target),
+        - 'risk_parity': equal contributions to the book's risk.
+
+        Only the signalled name is traded to its target.
+        """
+
+    def __init__(self, cov, method='risk_parity', target_vol=0.10,
+                 max_gross=1.0, max_weight=0.4, periods=252):
+        """
+            Parameters:
+            cov - The RollingCovariance of the universe.
+            method - 'volatility' or 'risk_parity'.
+            target_vol - The annualised volatility of the book.
+            max_gross - Maximum sum of absolute weights.
+            max_weight - Maximum absolute weight of one name.
+            periods - Daily (252), Hourly (252*6.5), Minutely(252*6.5*60) etc.
+            """
+        if method not in ('volatility', 'risk_parity'):
+            raise ValueError("Unknown sizing method %s" % method)
+        self.cov = cov
+        self.method = method
+        self.target_vol = target_vol
+        self.max_gross = max_gross
+        self.max_weight = max_weight
+        self.periods = periods
+
+    def update(self, bars):
+        """
+            Adds the latest bars to the covariance.
+            """
+        self.cov.update_bars(bars)
+
+    def target_weights(self, sides):
+        """
+            Returns the target weights of a book.
+
+            Parameters:
+            sides - Dictionary of symbol -> 1 (long) or -1 (short).
+
+            Returns:
+            A dictionary of symbol -> signed weight, None while the
+            covariance is not ready.
+            """
+        if not self.cov.ready():
+            return None
+        symbols = sorted(sides)
+        sign = np.array([sides[s] for s in symbols], dtype=float)
+        # Covariance of the signed returns, so that the weights are
+        # those of a long-only book
+        cov = self.cov.sub_covariance(symbols) * np.outer(sign, sign)
+
+        if self.method == 'volatility':
+            w = inverse_volatility_weights(np.sqrt(np.maximum(np.diag(cov), 0.0)))
+        else:
+            w = risk_parity_weights(cov)
+        if not w.any():
+            return None
+        w = scale_to_volatility(cov, w, self.target_vol, self.periods)
+        w = np.minimum(w, self.max_weight)
+        if w.sum() > self.max_gross:
+            w *= self.max_gross / w.sum()
+        return dict(zip(symbols, w * sign))
+
+    def order_quantity(self, portfolio, signal):
+        """
+            Returns the signed quantity to trade in the signalled name
+            to reach its target, or None while the covariance is not
+            ready.
+            """
+        if signal.signal_type not in ('LONG', 'SHORT'):
+            return None
+        # The names with a position, visiting only the active ones
+        active = set(portfolio.market_values) | portfolio.dirty_symbols
+        sides = {}
+        for s in active:
+            q = portfolio.current_positions[s]
+            if q != 0:
+                sides[s] = 1 if q > 0 else -1
+        sides[signal.symbol] = 1 if signal.signal_type == 'LONG' else -1
+        weights = self.target_weights(sides)
+        if weights is None:
+            return None
+
+        price = portfolio.bars.get_latest_bars(signal.symbol)[-1][5]
+        capital = portfolio.all_holdings.get(-1, 'total')
+        target = weights[signal.symbol] * capital / price
+        target = floor(target) if target > 0 else -floor(-target)
+        return target - portfolio.current_positions[signal.symbol]
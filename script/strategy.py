@@ -78,7 +78,7 @@ class BuyAndHoldStrategy(Strategy):
             event - A MarketEvent object.
             """
         if event.type == 'MARKET':
-            for s in self.symbol_list:
+            for s in self.bars.get_eligible_symbols():
                 bars = self.bars.get_latest_bars(s, N=1)
                 if bars is not None and bars != []:
                     if self.bought[s] == False:
@@ -0,0 +1,199 @@
+# throttle.py
+
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from ratelimit import TokenBucket
+
+
+# TWS disconnects API clients sending more than 50 messages per
+# second. A bucket of capacity C refilled at rate R lets through at
+# most C + R messages in any second, so it is tuned to 5 + 44,
+# keeping one message per second of margin.
+IB_MESSAGE_RATE = 44.0
+IB_MESSAGE_BURST = 5
+
+# Priority lanes, lowest value sent first
+PRIORITY_CANCEL = 0
+PRIORITY_ORDER = 1
+PRIORITY_OTHER = 2
+
+
+class OutboundScheduler(object):
+    """
+        Schedules the messages sent to TWS so that the inbound message
+        rate limit of TWS is never exceeded, while staying close to it.
+
+        Messages wait in priority lanes (cancels go before new orders)
+        and a background thread sends them as fast as a token bucket
+        allows. New orders are first staged until release() is called,
+        normally once per bar: the staged orders for the same symbol,
+        order type and limit price are netted into a single order, so
+        a bar that generates several orders for a name sends at most
+        one.
+        """
+
+    def __init__(self, place_order, send=None, rate=IB_MESSAGE_RATE,
+                 burst=IB_MESSAGE_BURST, coalesce=True, bucket=None):
+        """
+            Parameters:
+            place_order - Function sending an OrderEvent to TWS.
+            send - Function (name, args) sending any other message,
+                   e.g. a cancelOrder.
+            rate - Sustained messages per second.
+            burst - Maximum burst of messages.
+            coalesce - Whether to stage and net the orders of a bar.
+            bucket - Optional TokenBucket, in place of rate and burst.
+            """
+        self.place_order = place_order
+        self.send = send
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+        self.bucket = bucket
+        self.coalesce = coalesce
+
+        self.staged = {}
+        self.staged_keys = []
+        self.lanes = []
+        self.counter = itertools.count()
+        self.sent = 0
+        self.failed = 0
+        # Messages popped from the lanes but not sent yet
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _push(self, priority, item):
+        """
+            Adds an item to its lane and wakes up the sender.
+            Must be called with the condition held.
+            """
+        heapq.heappush(self.lanes, (priority, next(self.counter), item))
+        # join() may be waiting on the condition as well
+        self.condition.notify_all()
+
+    def submit_order(self, event):
+        """
+            Schedules an OrderEvent. With coalescing on, it is staged
+            until the next release().
+            """
+        with self.condition:
+            if not self.coalesce:
+                self._push(PRIORITY_ORDER, ('order', event))
+                return
+            key = (event.symbol, event.order_type, event.price)
+            sign = 1 if event.direction == 'BUY' else -1
+            if key not in self.staged:
+                self.staged[key] = [0, event]
+                self.staged_keys.append(key)
+            self.staged[key][0] += sign * event.quantity
+
+    def submit_cancel(self, order_id):
+        """
+            Schedules a cancelOrder ahead of any new order.
+            """
+        with self.condition:
+            self._push(PRIORITY_CANCEL, ('cancelOrder', (order_id,)))
+
+    def submit(self, name, *args):
+        """
+            Schedules any other TWS request, after the orders.
+            """
+        with self.condition:
+            self._push(PRIORITY_OTHER, (name, args))
+
+    def release(self):
+        """
+            Nets the staged orders of each symbol, order type and limit
+            price into one order and moves them to the order lane.
+            """
+        with self.condition:
+            for key in self.staged_keys:
+                quantity, event = self.staged[key]
+                if quantity == 0:
+                    continue
+                event.quantity = abs(quantity)
+                event.direction = 'BUY' if quantity > 0 else 'SELL'
+                self._push(PRIORITY_ORDER, ('order', event))
+            self.staged = {}
+            self.staged_keys = []
+
+    def pending(self):
+        """
+            Returns the number of messages waiting to be sent.
+            """
+        with self.condition:
+            return len(self.lanes)
+
+    def _run(self):
+        """
+            Sends the queued messages, highest priority first, as the
+            token bucket allows.
+            """
+        while True:
+            with self.condition:
+                while self.running and not self.lanes:
+                    self.condition.wait(0.5)
+                if not self.running:
+                    return
+            self.bucket.acquire()
+            with self.condition:
+                if not self.lanes:
+                    continue
+                priority, _, (name, payload) = heapq.heappop(self.lanes)
+                self.in_flight += 1
+            # A message that cannot be sent is reported and skipped,
+            # the thread must keep sending the others
+            try:
+                if name == 'order':
+                    self.place_order(payload)
+                else:
+                    self.send(name, payload)
+            except Exception:
+                failed = True
+                print "Failed to send %s %r:" % (name, payload)
+                traceback.print_exc()
+            else:
+                failed = False
+            with self.condition:
+                if failed:
+                    self.failed += 1
+                else:
+                    self.sent += 1
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def join(self, timeout=None):
+        """
+            Waits until every queued message has been sent, including
+            the one being sent.
+
+            Returns:
+            False if timeout seconds passed first.
+            """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.lanes or self.in_flight:
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0.0:
+                        return False
+                    self.condition.wait(remaining)
+        return True
+
+    def stop(self):
+        """
+            Stops the sender thread.
+            """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
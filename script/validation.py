@@ -0,0 +1,184 @@
+# validation.py
+
+import numpy as np
+import pandas as pd
+
+
+PRICE_FIELDS = ['open', 'high', 'low', 'close']
+
+# Checks in the order they are run
+CHECKS = ['columns', 'order', 'duplicates', 'prices', 'ohlc', 'volume', 'gaps']
+
+
+class DataValidator(object):
+    """
+        Checks the bars of each symbol when they are loaded (see
+        data.load_csv_bars), with whole-array operations on the
+        DataFrame of the symbol, and repairs them if asked to.
+
+        The checks are:
+
+        - 'columns': high and low swapped, i.e. high below low on
+          most bars. Repaired by swapping them back.
+        - 'order': timestamps earlier than the previous one.
+          Repaired by sorting.
+        - 'duplicates': repeated timestamps. Repaired by keeping the
+          last bar.
+        - 'prices': missing or non-positive prices. Repaired by the
+          previous valid price, dropping the bars before the first one.
+        - 'ohlc': open or close outside [low, high]. Repaired by
+          widening high and low.
+        - 'volume': volume above volume_spike times the median volume
+          of the previous volume_window bars. Repaired by clipping it
+          to that level.
+        - 'gaps': more time between two bars than max_gap, or
+          gap_factor times the median spacing. Only reported.
+
+        The issues are kept in self.report, as symbol -> check ->
+        timestamps of the offending bars.
+        """
+
+    def __init__(self, repair=('columns', 'order', 'duplicates', 'prices', 'ohlc'),
+                 volume_spike=10.0, volume_window=20, gap_factor=4.0,
+                 max_gap=None):
+        """
+            Parameters:
+            repair - The checks whose issues are repaired, the others
+                     are only reported.
+            volume_spike - Multiple of the median volume flagged.
+            volume_window - Number of bars of the median volume.
+            gap_factor - Multiple of the median spacing flagged as a
+                         gap, when max_gap is None.
+            max_gap - Largest time allowed between two bars, as a
+                      Timedelta or a string such as '4D'.
+            """
+        unknown = set(repair) - set(CHECKS)
+        if unknown:
+            raise ValueError("Unknown checks %s" % ", ".join(sorted(unknown)))
+        self.repair = set(repair)
+        self.volume_spike = volume_spike
+        self.volume_window = volume_window
+        self.gap_factor = gap_factor
+        self.max_gap = None if max_gap is None else pd.Timedelta(max_gap)
+        self.report = {}
+
+    def validate(self, symbol, frame):
+        """
+            Runs the checks on the bars of one symbol.
+
+            Parameters:
+            symbol - The ticker symbol, the key of the report.
+            frame - DataFrame of the bars, on a DatetimeIndex, with
+                    at least the open, high, low, close and volume
+                    columns.
+
+            Returns:
+            The DataFrame, or a repaired copy of it.
+            """
+        issues = {}
+        index = frame.index
+        t = index.values
+        prices = frame[PRICE_FIELDS].values.astype(float)
+        volume = frame['volume'].values.astype(float)
+        # Rows of frame kept, in their repaired order
+        rows = np.arange(len(frame))
+        repaired = set()
+
+        # High and low swapped, on the whole column
+        if len(t) and np.mean(prices[:, 1] < prices[:, 2]) > 0.5:
+            issues['columns'] = index
+            if 'columns' in self.repair:
+                prices[:, [1, 2]] = prices[:, [2, 1]]
+                repaired.add('columns')
+
+        bad = np.zeros(len(t), dtype=bool)
+        bad[1:] = t[1:] < t[:-1]
+        if bad.any():
+            issues['order'] = index[rows[bad]]
+            if 'order' in self.repair:
+                perm = np.argsort(t, kind='mergesort')
+                t, prices, volume, rows = t[perm], prices[perm], volume[perm], rows[perm]
+                repaired.add('order')
+
+        bad = pd.Index(t).duplicated(keep='last')
+        if bad.any():
+            issues['duplicates'] = index[rows[bad]]
+            if 'duplicates' in self.repair:
+                keep = ~bad
+                t, prices, volume, rows = t[keep], prices[keep], volume[keep], rows[keep]
+                repaired.add('duplicates')
+
+        with np.errstate(invalid='ignore'):
+            valid = prices > 0
+        bad = ~valid.all(axis=1)
+        if bad.any():
+            issues['prices'] = index[rows[bad]]
+            if 'prices' in self.repair:
+                # Forward fill each column from its last valid price
+                last = np.where(valid, np.arange(len(t))[:, None], 0)
+                np.maximum.accumulate(last, axis=0, out=last)
+                prices = prices[last, np.arange(len(PRICE_FIELDS))]
+                keep = np.maximum.accumulate(valid, axis=0).all(axis=1)
+                t, prices, volume, rows = t[keep], prices[keep], volume[keep], rows[keep]
+                repaired.add('prices')
+
+        o, h, l, c = prices.T
+        with np.errstate(invalid='ignore'):
+            bad = (l > np.minimum(o, c)) | (h < np.maximum(o, c))
+        if bad.any():
+            issues['ohlc'] = index[rows[bad]]
+            if 'ohlc' in self.repair:
+                prices[:, 1] = np.nanmax(prices, axis=1)
+                prices[:, 2] = np.nanmin(prices, axis=1)
+                repaired.add('ohlc')
+
+        w = self.volume_window
+        if len(volume) > w:
+            # Median of the w bars before each bar, over a strided view
+            windows = np.lib.stride_tricks.as_strided(
+                volume, shape=(len(volume) - w, w),
+                strides=(volume.strides[0], volume.strides[0]))
+            limit = np.full(len(volume), np.inf)
+            limit[w:] = self.volume_spike * np.median(windows, axis=1)
+            with np.errstate(invalid='ignore'):
+                bad = volume > limit
+            if bad.any():
+                issues['volume'] = index[rows[bad]]
+                if 'volume' in self.repair:
+                    volume = np.where(bad, limit, volume)
+                    repaired.add('volume')
+
+        if len(t) > 1:
+            spacing = np.diff(t)
+            if self.max_gap is not None:
+                limit = self.max_gap.to_timedelta64()
+            else:
+                limit = self.gap_factor * np.sort(spacing)[len(spacing) // 2]
+            bad = np.zeros(len(t), dtype=bool)
+            bad[1:] = spacing > limit
+            if bad.any():
+                issues['gaps'] = index[rows[bad]]
+
+        if repaired:
+            frame = frame.iloc[rows].copy()
+            frame[PRICE_FIELDS] = prices
+            if 'volume' in repaired:
+                frame['volume'] = volume
+
+        self.report[symbol] = issues
+        return frame
+
+    def summary(self):
+        """
+            Creates a list of the number of issues of every symbol and
+            check, in the same form as Portfolio.output_summary_stats.
+            """
+        stats = []
+        for symbol in sorted(self.report):
+            issues = self.report[symbol]
+            for check in CHECKS:
+                if check in issues:
+                    repaired = " (repaired)" if check in self.repair and check != 'gaps' else ""
+                    stats.append(("%s %s" % (symbol, check),
+                                  "%d%s" % (len(issues[check]), repaired)))
+        return stats
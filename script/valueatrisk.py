@@ -0,0 +1,163 @@
+# valueatrisk.py
+
+from math import exp, log, pi, sqrt
+
+import numpy as np
+
+from covariance import RollingCovariance
+
+
+def norm_ppf(p):
+    """
+        Inverse of the standard normal distribution function, with
+        Acklam's rational approximation (relative error below 1.2e-9).
+        """
+    a = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+         1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+    b = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+         6.680131188771972e+01, -1.328068155288572e+01]
+    c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+         -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+    d = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+         3.754408661907416e+00]
+    if p <= 0.0 or p >= 1.0:
+        raise ValueError("p must be in (0, 1)")
+    if p < 0.02425:
+        q = sqrt(-2.0 * log(p))
+        return (((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5]) / \
+               ((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1.0)
+    if p > 1.0 - 0.02425:
+        return -norm_ppf(1.0 - p)
+    q = p - 0.5
+    r = q * q
+    return (((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5]) * q / \
+           (((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1.0)
+
+
+class VaREngine(object):
+    """
+        Computes the one-bar Value at Risk and Expected Shortfall of
+        the current positions of a portfolio, by historical simulation
+        and parametrically (normal, zero mean), both in dollars.
+
+        The return scenarios come from the window of a rolling
+        RollingCovariance over the aligned close returns of the
+        universe, which may be shared with a sizer. The P&L of every
+        scenario is one matrix product of the scenario returns with the
+        market values of the names held, and the parametric variance of
+        the book under the window covariance is the sample variance of
+        that P&L, so it costs nothing more.
+
+        Results are cached, and only recomputed when the positions
+        (market values) or the window have changed.
+        """
+
+    def __init__(self, cov=None, symbol_list=None, window=500,
+                 confidence=0.99):
+        """
+            Parameters:
+            cov - A rolling window RollingCovariance. If None, one is
+                  created over symbol_list and window, and update()
+                  feeds it.
+            symbol_list - The universe, when cov is None.
+            window - The number of scenarios, when cov is None.
+            confidence - The confidence level, e.g. 0.99.
+            """
+        if cov is None:
+            cov = RollingCovariance(symbol_list, window=window)
+            self.owns_cov = True
+        else:
+            self.owns_cov = False
+        if cov.window is None:
+            raise ValueError("Historical VaR needs a rolling window covariance")
+        self.cov = cov
+        self.confidence = confidence
+        self.z = norm_ppf(confidence)
+        self.es_factor = exp(-0.5 * self.z * self.z) / sqrt(2.0 * pi) / (1.0 - confidence)
+
+        self.cache_key = None
+        self.cache = None
+
+    def update(self, bars):
+        """
+            Adds the latest bars to the scenarios, when the covariance
+            is not updated elsewhere.
+            """
+        if self.owns_cov:
+            self.cov.update_bars(bars)
+
+    def scenarios(self):
+        """
+            Returns the scenario returns available so far.
+            """
+        if self.cov.count < self.cov.window:
+            return self.cov.returns[:self.cov.count]
+        return self.cov.returns
+
+    def measure(self, portfolio):
+        """
+            Returns the risk measures of the current positions of a
+            portfolio, valued by its market_values.
+            """
+        return self.measure_exposures(portfolio.market_values)
+
+    def measure_exposures(self, exposures):
+        """
+            Returns the risk measures of a book.
+
+            Parameters:
+            exposures - Dictionary of symbol -> signed market value.
+
+            Returns:
+            A dictionary with historical_var, historical_es,
+            parametric_var and parametric_es, as positive dollar losses.
+            """
+        symbols = sorted(s for s, v in exposures.items() if v != 0)
+        values = np.array([exposures[s] for s in symbols], dtype=float)
+        key = (self.cov.updates, tuple(symbols), values.tostring())
+        if key == self.cache_key:
+            return self.cache
+
+        result = {"historical_var": 0.0, "historical_es": 0.0,
+                  "parametric_var": 0.0, "parametric_es": 0.0}
+        scenarios = self.scenarios()
+        if symbols and len(scenarios) >= 2:
+            idx = np.array([self.cov.symbol_index[s] for s in symbols], dtype=int)
+
+            # Historical simulation: the P&L of every scenario at once.
+            # A large book is multiplied as a dense vector, which saves
+            # copying the columns of the names held.
+            if len(idx) * 8 > len(self.cov.symbol_list):
+                dense = np.zeros(len(self.cov.symbol_list))
+                dense[idx] = values
+                pnl = scenarios.dot(dense)
+            else:
+                pnl = scenarios[:, idx].dot(values)
+            k = max(int(np.floor((1.0 - self.confidence) * len(pnl))), 1)
+            tail = np.partition(pnl, k - 1)[:k]
+            result["historical_var"] = max(-tail.max(), 0.0)
+            result["historical_es"] = max(-tail.mean(), 0.0)
+
+            # Parametric: the variance of the book under the rolling
+            # covariance, values' * cov * values, is the sample
+            # variance of the scenario P&L, already computed
+            sigma = sqrt(max(pnl.var(ddof=1), 0.0))
+            result["parametric_var"] = self.z * sigma
+            result["parametric_es"] = self.es_factor * sigma
+
+        self.cache_key = key
+        self.cache = result
+        return result
+
+    def get_stats(self, portfolio):
+        """
+            Creates a list of the risk measures of a portfolio, in the
+            same form as Portfolio.output_summary_stats.
+            """
+        result = self.measure(portfolio)
+        level = self.confidence * 100.0
+        stats = [("Historical VaR %g%%" % level, "%0.2f" % result["historical_var"]),
+                 ("Historical ES %g%%" % level, "%0.2f" % result["historical_es"]),
+                 ("Parametric VaR %g%%" % level, "%0.2f" % result["parametric_var"]),
+                 ("Parametric ES %g%%" % level, "%0.2f" % result["parametric_es"])]
+        return stats
@@ -0,0 +1,287 @@
+# walkforward.py
+
+import inspect
+import itertools
+import multiprocessing
+import Queue
+
+import numpy as np
+import pandas as pd
+
+from backtest import run_backtest
+from data import InMemoryDataHandler, load_csv_bars
+from execution import SimulatedExecutionHandler
+from performance import create_sharpe_ratio, create_drawdowns
+from PortfolioWithSimpleRM import SimplePortfolio
+
+
+# Bar lists shared by every window run inside one worker process.
+# They are handed over once per worker by the pool initializer, so the
+# history is never re-parsed or re-sent for each window.
+_shared_bars = {}
+
+
+def _init_worker(symbol_bars):
+    """
+        Pool initializer, stores the loaded bar lists in the worker.
+        """
+    global _shared_bars
+    _shared_bars = symbol_bars
+
+
+def walk_forward_windows(num_bars, in_sample, out_of_sample, step=None):
+    """
+        Splits a history of num_bars bars into rolling in-sample and
+        out-of-sample windows.
+
+        Parameters:
+        num_bars - Total number of bars in the history.
+        in_sample - Number of bars in each in-sample window.
+        out_of_sample - Number of bars in each out-of-sample window.
+        step - Bars to roll forward between windows (defaults to
+               out_of_sample, so the out-of-sample windows tile).
+
+        Returns:
+        A list of (is_start, is_end, oos_start, oos_end) index tuples.
+        """
+    if step is None:
+        step = out_of_sample
+    windows = []
+    start = 0
+    while start + in_sample < num_bars:
+        is_end = start + in_sample
+        oos_end = min(is_end + out_of_sample, num_bars)
+        windows.append((start, is_end, is_end, oos_end))
+        start += step
+    return windows
+
+
+def parameter_grid(param_grid):
+    """
+        Expands a dictionary of parameter name -> list of values into
+        a list of parameter dictionaries, one per combination.
+        """
+    names = sorted(param_grid.keys())
+    return [dict(zip(names, values))
+            for values in itertools.product(*[param_grid[n] for n in names])]
+
+
+def run_window(strategy_class, params, start, end, warmup,
+               initial_capital=100000.0, symbol_bars=None):
+    """
+        Runs a single backtest of strategy_class with params over the
+        [start, end) window of the shared bar lists.
+
+        Returns:
+        datetimes, totals - The bar timestamps and portfolio totals,
+        the first entry being the initial capital, timestamped with
+        the bar before the window so that no timestamp is repeated.
+        """
+    if symbol_bars is None:
+        symbol_bars = _shared_bars
+    events = Queue.Queue()
+    bars = InMemoryDataHandler(events, symbol_bars, start=start, end=end,
+                               warmup=warmup)
+    strategy = strategy_class(bars, events, **params)
+    start_date = symbol_bars[bars.symbol_list[0]][max(start - 1, 0)][1]
+    port = SimplePortfolio(bars, events, start_date, initial_capital)
+    broker = SimulatedExecutionHandler(events)
+    run_backtest(events, bars, strategy, port, broker)
+    datetimes = list(port.equity.datetimes)
+    totals = port.equity.totals().tolist()
+    # The data handler puts a last MarketEvent once it runs out of
+    # bars, which repeats the last bar: keep its final total only
+    keep = [i for i in range(len(datetimes))
+            if i + 1 == len(datetimes) or datetimes[i + 1] != datetimes[i]]
+    return [datetimes[i] for i in keep], [totals[i] for i in keep]
+
+
+def _sharpe_of_totals(totals, periods):
+    """
+        Sharpe ratio of a list of portfolio totals, -inf when it is
+        undefined (e.g. the strategy never traded).
+        """
+    returns = pd.Series(totals).pct_change().dropna()
+    if len(returns) < 2 or np.std(returns) == 0:
+        return -np.inf
+    return create_sharpe_ratio(returns, periods)
+
+
+def optimise_window(args):
+    """
+        Optimises the parameters on the in-sample part of one window
+        and runs the best ones over its out-of-sample part.
+
+        Parameters:
+        args - A tuple of (window, strategy_class, grid, warmup,
+               initial_capital, periods), packed for Pool.map.
+
+        Returns:
+        A dictionary with the window, the chosen parameters, their
+        in-sample Sharpe and the out-of-sample datetimes and totals.
+        """
+    window, strategy_class, grid, warmup, initial_capital, periods = args
+    is_start, is_end, oos_start, oos_end = window
+
+    best_params, best_sharpe = None, -np.inf
+    for params in grid:
+        _, totals = run_window(strategy_class, params, is_start, is_end,
+                               warmup, initial_capital)
+        sharpe = _sharpe_of_totals(totals, periods)
+        if best_params is None or sharpe > best_sharpe:
+            best_params, best_sharpe = params, sharpe
+
+    # The out-of-sample run is warmed up on the end of the in-sample
+    # bars, which are already in memory
+    datetimes, totals = run_window(strategy_class, best_params, oos_start,
+                                   oos_end, warmup, initial_capital)
+    return {
+        "window": window,
+        "params": best_params,
+        "in_sample_sharpe": best_sharpe,
+        "datetimes": datetimes,
+        "totals": totals
+    }
+
+
+class WalkForwardOptimiser(object):
+    """
+        Walk-forward optimisation of a strategy's parameters.
+
+        The history is loaded once and split into rolling in-sample
+        and out-of-sample windows. In each in-sample window every
+        parameter combination of the grid is backtested and the one
+        with the best Sharpe ratio is then traded over the following
+        out-of-sample window. The out-of-sample equity curves are
+        chained into a single equity curve.
+
+        Windows are optimised in parallel across processes.
+        """
+
+    def __init__(self, symbol_bars, strategy_class, param_grid,
+                 in_sample, out_of_sample, step=None,
+                 initial_capital=100000.0, periods=252, processes=None,
+                 warmup=None):
+        """
+            Initialises the optimiser.
+
+            Parameters:
+            symbol_bars - A dictionary of symbol -> list of bar tuples,
+                          e.g. as returned by data.load_csv_bars.
+            strategy_class - The Strategy class, e.g. Mean_Reversion.
+            param_grid - Dictionary of parameter name -> candidate values.
+            in_sample - Number of bars in each in-sample window.
+            out_of_sample - Number of bars in each out-of-sample window.
+            step - Bars to roll forward between windows.
+            initial_capital - The starting capital of each window.
+            periods - Bars per year, used for the Sharpe ratio.
+            processes - Number of worker processes (defaults to cores).
+            warmup - Bars of history before each window needed by the
+                     strategy's indicators, by default the largest
+                     'periods' of the grid or of the strategy's
+                     defaults, plus one.
+            """
+        self.symbol_bars = symbol_bars
+        self.strategy_class = strategy_class
+        self.grid = parameter_grid(param_grid)
+        self.in_sample = in_sample
+        self.out_of_sample = out_of_sample
+        self.step = step
+        self.initial_capital = initial_capital
+        self.periods = periods
+        self.processes = processes
+
+        if warmup is None:
+            warmup = self._default_warmup()
+        self.warmup = warmup
+        self.results = []
+
+    def _default_warmup(self):
+        """
+            Enough history before each window to prime the largest
+            indicator lookback (RSI needs periods+1 bars), taken from
+            the grid or else from the default of the strategy.
+            """
+        if all("periods" in p for p in self.grid):
+            return max(p["periods"] for p in self.grid) + 1
+        spec = inspect.getargspec(self.strategy_class.__init__)
+        defaults = dict(zip(spec.args[-len(spec.defaults or ()):],
+                            spec.defaults or ()))
+        if "periods" not in defaults:
+            raise ValueError("The lookback of %s is unknown, pass warmup"
+                             % self.strategy_class.__name__)
+        return max([p.get("periods", defaults["periods"])
+                    for p in self.grid]) + 1
+
+    @classmethod
+    def from_csv(cls, csv_dir, symbol_list, strategy_class, param_grid,
+                 in_sample, out_of_sample, **kwargs):
+        """
+            Creates an optimiser over the 'symbol.csv' files in csv_dir.
+            """
+        _, symbol_bars = load_csv_bars(csv_dir, symbol_list)
+        return cls(symbol_bars, strategy_class, param_grid,
+                   in_sample, out_of_sample, **kwargs)
+
+    def run(self):
+        """
+            Optimises every window and chains the out-of-sample
+            equity curves.
+
+            Returns:
+            results - A list with one dictionary per window.
+            """
+        num_bars = min(len(b) for b in self.symbol_bars.values())
+        windows = walk_forward_windows(num_bars, self.in_sample,
+                                       self.out_of_sample, self.step)
+        tasks = [(w, self.strategy_class, self.grid, self.warmup,
+                  self.initial_capital, self.periods) for w in windows]
+
+        if self.processes == 1:
+            _init_worker(self.symbol_bars)
+            self.results = map(optimise_window, tasks)
+        else:
+            pool = multiprocessing.Pool(self.processes, _init_worker,
+                                        (self.symbol_bars,))
+            try:
+                self.results = pool.map(optimise_window, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        self.create_equity_curve_dataframe()
+        return self.results
+
+    def create_equity_curve_dataframe(self):
+        """
+            Chains the out-of-sample returns of every window into a
+            single equity curve DataFrame.
+            """
+        datetimes, returns = [], []
+        for result in self.results:
+            window_returns = pd.Series(result["totals"]).pct_change()
+            datetimes.extend(result["datetimes"][1:])
+            returns.extend(window_returns[1:])
+        curve = pd.DataFrame({"returns": returns}, index=datetimes)
+        curve.index.name = 'datetime'
+        curve['equity_curve'] = (1.0+curve['returns']).cumprod()
+        self.equity_curve = curve
+
+    def output_summary_stats(self):
+        """
+            Creates a list of summary statistics for the chained
+            out-of-sample equity curve, in the same form as
+            SimplePortfolio.output_summary_stats.
+            """
+        total_return = self.equity_curve['equity_curve'][-1]
+        returns = self.equity_curve['returns']
+        pnl = self.equity_curve['equity_curve']
+
+        sharpe_ratio = create_sharpe_ratio(returns, self.periods)
+        max_dd, dd_duration = create_drawdowns(pnl)
+
+        stats = [("Total Return", "%0.2f%%" % ((total_return - 1.0) * 100.0)),
+                 ("Sharpe Ratio", "%0.2f" % sharpe_ratio),
+                 ("Max Drawdown", "%0.2f%%" % (max_dd * 100.0)),
+                 ("Drawdown Duration", "%d" % dd_duration),
+                 ("Windows", "%d" % len(self.results))]
+        return stats